@@ -24,7 +24,13 @@
 
     # always loaded
     'data': [
-        # 'security/ir.model.access.csv',
+        'security/ir.model.access.csv',
+        'data/ir_cron.xml',
+        'views/shopify_webhook.xml',
+        'views/shopify_sync_job.xml',
+        'views/shopify_sync_run.xml',
+        'views/shopify_dead_letter.xml',
+        'views/shopify_sync_shard.xml',
         'views/shopify_instance.xml',
         'views/templates.xml',
         'wizard/operation_view.xml',
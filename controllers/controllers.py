@@ -1,21 +1,46 @@
 # -*- coding: utf-8 -*-
-# from odoo import http
-
-
-# class Wsem(http.Controller):
-#     @http.route('/wsem/wsem', auth='public')
-#     def index(self, **kw):
-#         return "Hello, world"
-
-#     @http.route('/wsem/wsem/objects', auth='public')
-#     def list(self, **kw):
-#         return http.request.render('wsem.listing', {
-#             'root': '/wsem/wsem',
-#             'objects': http.request.env['wsem.wsem'].search([]),
-#         })
-
-#     @http.route('/wsem/wsem/objects/<model("wsem.wsem"):obj>', auth='public')
-#     def object(self, obj, **kw):
-#         return http.request.render('wsem.object', {
-#             'object': obj
-#         })
+import hmac
+
+from odoo import http
+from odoo.http import request, Response
+
+from ..models.shopify_webhook import WEBHOOK_TOPICS
+
+import logging
+
+_logger = logging.getLogger(__name__)
+
+
+class ShopifyWebhookController(http.Controller):
+
+    @http.route('/shopify/webhook/<int:instance_id>', type='http', auth='public', methods=['POST'], csrf=False)
+    def shopify_webhook(self, instance_id, **kw):
+        """
+        Recibe los webhooks de Shopify. Solo verifica el HMAC y guarda el payload en bruto;
+        el procesamiento se hace fuera de la petición para contestar a Shopify en milisegundos.
+        """
+        httprequest = request.httprequest
+        raw_payload = httprequest.get_data()
+        topic = httprequest.headers.get('X-Shopify-Topic')
+        instance = request.env['shopify.instance'].sudo().browse(instance_id).exists()
+        if not instance or not instance._verify_webhook_hmac(raw_payload, httprequest.headers.get('X-Shopify-Hmac-Sha256')):
+            _logger.warning("WSSH Webhook %s rechazado para la instancia %s: HMAC no válido", topic, instance_id)
+            return Response(status=401)
+        if topic in WEBHOOK_TOPICS:
+            request.env['shopify.webhook.event'].sudo()._store_webhook(
+                instance, topic, httprequest.headers.get('X-Shopify-Webhook-Id'), raw_payload)
+        return Response(status=200)
+
+    @http.route('/shopify/metrics', type='http', auth='public', methods=['GET'], csrf=False)
+    def shopify_metrics(self, token=None, **kw):
+        """
+        Métricas de sincronización en formato Prometheus. Requiere el token del parámetro de sistema
+        ws_shopify_split_color.metrics_token, en la cabecera Authorization (Bearer) o en ?token=.
+        """
+        expected = request.env['ir.config_parameter'].sudo().get_param('ws_shopify_split_color.metrics_token')
+        authorization = request.httprequest.headers.get('Authorization') or ''
+        provided = authorization[7:] if authorization.startswith('Bearer ') else token
+        if not expected or not provided or not hmac.compare_digest(expected, provided):
+            return Response(status=403)
+        body = request.env['shopify.metric.counter'].sudo()._render_prometheus()
+        return Response(body, status=200, content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -1,3 +1,3 @@
 # -*- coding: utf-8 -*-
 
-from . import product_split,res_partner,shopinstance,sale_order
\ No newline at end of file
+from . import product_split,res_partner,shopinstance,sale_order,shopify_webhook,shopify_sync_job,shopify_sync_run,shopify_metric,product_bulk_load,shopify_sync_schedule,shopify_product_image,product_dirty,product_price_sync,shopify_id_map,shopify_reconcile,shopify_inventory_audit,shopify_mapping_backfill,shopify_dead_letter,shopify_sync_shard,shopify_export_state
\ No newline at end of file
@@ -0,0 +1,339 @@
+# -*- coding: utf-8 -*-
+import base64
+import json
+import tempfile
+
+from odoo import api, fields, models, _
+from odoo.exceptions import UserError
+
+from .shopify_sync_run import throttle_sleep
+
+import logging
+import requests
+
+_logger = logging.getLogger(__name__)
+
+# Mutación ejecutada por bulkOperationRunMutation para cada línea del JSONL
+PRODUCT_SET_MUTATION = """
+mutation call($input: ProductSetInput!) {
+  productSet(input: $input) {
+    product {
+      id
+      variants(first: 250) { edges { node { id sku price inventoryItem { id } } } }
+    }
+    userErrors { field message }
+  }
+}
+"""
+
+STAGED_UPLOAD_MUTATION = """
+mutation {
+  stagedUploadsCreate(input: [{resource: BULK_MUTATION_VARIABLES, filename: "products.jsonl",
+                               mimeType: "text/jsonl", httpMethod: POST}]) {
+    stagedTargets { url resourceUrl parameters { name value } }
+    userErrors { field message }
+  }
+}
+"""
+
+RUN_MUTATION = """
+mutation run($mutation: String!, $path: String!) {
+  bulkOperationRunMutation(mutation: $mutation, stagedUploadPath: $path) {
+    bulkOperation { id status }
+    userErrors { field message }
+  }
+}
+"""
+
+BULK_OPERATION_QUERY = """
+query bulk($id: ID!) {
+  node(id: $id) { ... on BulkOperation { id status errorCode objectCount url partialDataUrl } }
+}
+"""
+
+APPLY_BATCH_SIZE = 500
+GRAPHQL_MAX_RETRIES = 3
+
+
+def shopify_gid_to_id(gid):
+    """'gid://shopify/Product/123' -> '123'"""
+    return gid.rsplit('/', 1)[-1] if gid else False
+
+
+class ProductTemplateBulkLoad(models.Model):
+    _inherit = 'product.template'
+
+    def _rest_payload_to_product_set_input(self, product_data, variant_data):
+        """
+        Convierte el payload REST que generan _prepare_shopify_*_product_data y
+        _prepare_shopify_variant_data al ProductSetInput de GraphQL, para que la carga masiva
+        publique exactamente lo mismo que la exportación normal.
+        """
+        product = product_data['product']
+        options = sorted(product.get('options') or [], key=lambda o: o.get('position') or 0)
+        option_names = {option.get('position') or idx: option['name'] for idx, option in enumerate(options, 1)}
+        product_options = []
+        for position, name in sorted(option_names.items()):
+            values = []
+            for variant in variant_data:
+                value = variant.get(f'option{position}')
+                if value and value not in values:
+                    values.append(value)
+            product_options.append({'name': name, 'position': position, 'values': [{'name': v} for v in values]})
+        if not product_options:
+            product_options = [{'name': 'Title', 'values': [{'name': 'Default Title'}]}]
+
+        variants = []
+        for variant in variant_data:
+            option_values = [
+                {'optionName': name, 'name': variant.get(f'option{position}')}
+                for position, name in sorted(option_names.items()) if variant.get(f'option{position}')
+            ] or [{'optionName': 'Title', 'name': 'Default Title'}]
+            variants.append({
+                'optionValues': option_values,
+                'price': str(variant.get('price') or 0),
+                'barcode': variant.get('barcode') or None,
+                'inventoryItem': {'sku': variant.get('sku') or None, 'tracked': True},
+            })
+        return {
+            'title': product.get('title'),
+            'descriptionHtml': product.get('body_html') or '',
+            'tags': [tag for tag in (product.get('tags') or '').split(',') if tag],
+            'status': 'DRAFT',
+            'productOptions': product_options,
+            'variants': variants,
+        }
+
+    def _compile_shopify_bulk_load(self, instance_id, jsonl_file):
+        """
+        Escribe en jsonl_file una línea {"input": ProductSetInput} por cada producto de Shopify
+        pendiente de crear (un producto por color si la instancia separa por colores).
+        No hace ninguna llamada a Shopify, por lo que sirve también como simulación.
+
+        :return: manifiesto: lista (por número de línea) de dicts {template_id, ptav_id}
+        """
+        manifest = []
+        products = self.search([('is_published', '=', True), ('is_shopify_product', '=', False)], order='create_date')
+        for product in products:
+            color_line = instance_id.split_products_by_color and self._get_shopify_color_line(product)
+            if color_line:
+                for template_attribute_value, variants, variant_data, product_data in self._plan_shopify_color_units(
+                        product, color_line, instance_id, False):
+                    if template_attribute_value.shopify_product_id:
+                        continue
+                    product_input = self._rest_payload_to_product_set_input(product_data, variant_data)
+                    jsonl_file.write(json.dumps({'input': product_input}) + '\n')
+                    manifest.append({'template_id': product.id, 'ptav_id': template_attribute_value.id})
+            elif not product.shopify_product_id:
+                variant_data = [
+                    self._prepare_shopify_variant_data(variant, instance_id)
+                    for variant in product.product_variant_ids
+                    if variant.default_code
+                ]
+                if not variant_data:
+                    continue
+                product_data = self._prepare_shopify_single_product_data(product)
+                product_input = self._rest_payload_to_product_set_input(product_data, variant_data)
+                jsonl_file.write(json.dumps({'input': product_input}) + '\n')
+                manifest.append({'template_id': product.id, 'ptav_id': False})
+        _logger.info("WSSH Carga inicial: %d productos compilados para %s", len(manifest), instance_id.name)
+        return manifest
+
+    def _apply_shopify_bulk_results(self, instance_id, manifest, result_lines):
+        """
+        Lee en streaming el JSONL de resultados de la operación masiva y guarda los IDs de producto,
+        variante e inventory item. Las variantes se buscan por SKU en bloques de APPLY_BATCH_SIZE líneas.
+
+        :return: (productos creados, líneas con error)
+        """
+        created = failed = 0
+        batch = []
+        # Los payloads se compilaron al crear el manifiesto: los cambios posteriores siguen pendientes
+        export_date = instance_id.bulk_load_manifest_id.create_date or fields.Datetime.now()
+        State = self.env['shopify.export.state']
+
+        def flush(batch):
+            skus = [node['sku'] for line, product in batch for node in product['variant_nodes'] if node.get('sku')]
+            variants_by_sku = {
+                variant.default_code: variant
+                for variant in self.env['product.product'].search([('default_code', 'in', skus)])
+            }
+            pushed_prices = {}
+            for line, product in batch:
+                entry = manifest[line]
+                template = self.browse(entry['template_id'])
+                if entry['ptav_id']:
+                    ptav = self.env['product.template.attribute.value'].browse(entry['ptav_id'])
+                    ptav.shopify_product_id = product['id']
+                    State._set(instance_id, 'product', ptav, export_date)
+                else:
+                    template.shopify_product_id = product['id']
+                for node in product['variant_nodes']:
+                    variant = variants_by_sku.get(node.get('sku'))
+                    if variant:
+                        variant.write({
+                            'shopify_variant_id': shopify_gid_to_id(node['id']),
+                            'shopify_inventory_item_id': shopify_gid_to_id((node.get('inventoryItem') or {}).get('id')),
+                        })
+                        if node.get('price') is not None:
+                            pushed_prices[variant.id] = float(node['price'])
+                template.write({
+                    'is_shopify_product': True,
+                    'shopify_instance_id': instance_id.id,
+                    'is_exported': True,
+                })
+                State._set(instance_id, 'product', template, export_date)
+            # Precio con el que Shopify ha creado cada variante: el envío rápido de precios parte de él
+            State._set(instance_id, 'price', self.env['product.product'].browse(list(pushed_prices)),
+                       export_date, values=pushed_prices)
+
+        for raw_line in result_lines:
+            if not raw_line:
+                continue
+            result = json.loads(raw_line)
+            line = result.get('__lineNumber')
+            payload = (result.get('data') or {}).get('productSet') or {}
+            product = payload.get('product')
+            if line is None or line >= len(manifest) or not product or payload.get('userErrors'):
+                failed += 1
+                _logger.warning("WSSH Carga inicial: línea %s con error: %s", line, payload.get('userErrors') or result.get('errors'))
+                continue
+            batch.append((line, {
+                'id': shopify_gid_to_id(product['id']),
+                'variant_nodes': [edge['node'] for edge in product.get('variants', {}).get('edges', [])],
+            }))
+            created += 1
+            if len(batch) >= APPLY_BATCH_SIZE:
+                flush(batch)
+                batch = []
+                self.env.cr.commit()
+        if batch:
+            flush(batch)
+        return created, failed
+
+
+class ShopifyInstanceBulkLoad(models.Model):
+    _inherit = 'shopify.instance'
+
+    bulk_load_operation_id = fields.Char(string="Bulk Operation ID", copy=False, readonly=True)
+    bulk_load_status = fields.Char(string="Initial Load Status", copy=False, readonly=True)
+    bulk_load_manifest_id = fields.Many2one('ir.attachment', string="Initial Load Manifest", copy=False, readonly=True)
+
+    def _shopify_graphql(self, query, variables=None):
+        self.ensure_one()
+        url = self._get_shopify_api_url('graphql.json')
+        headers = {
+            "X-Shopify-Access-Token": self.shopify_shared_secret,
+            "Content-Type": "application/json"
+        }
+        body = json.dumps({'query': query, 'variables': variables or {}})
+        for attempt in range(GRAPHQL_MAX_RETRIES + 1):
+            response = self._shopify_request('POST', url, headers=headers, data=body)
+            if not response.ok:
+                raise UserError(_("WSSH Error GraphQL %s: %s") % (response.status_code, response.text))
+            result = response.json()
+            errors = result.get('errors') or []
+            # THROTTLED: el bucket de coste de GraphQL está vacío, se espera a que se recupere
+            if attempt < GRAPHQL_MAX_RETRIES and any(
+                    (error.get('extensions') or {}).get('code') == 'THROTTLED' for error in errors if isinstance(error, dict)):
+                throttle_sleep(2 ** attempt)
+                continue
+            if errors:
+                raise UserError(_("WSSH Error GraphQL: %s") % errors)
+            return result.get('data') or {}
+
+    def action_compile_initial_load(self):
+        """Simulación: compila el JSONL de la carga inicial y lo adjunta a la instancia sin llamar a Shopify."""
+        self.ensure_one()
+        with tempfile.TemporaryFile(mode='w+') as jsonl_file:
+            manifest = self.env['product.template']._compile_shopify_bulk_load(self, jsonl_file)
+            jsonl_file.seek(0)
+            self.env['ir.attachment'].create({
+                'name': f'shopify_initial_load_{self.id}.jsonl',
+                'res_model': 'shopify.instance',
+                'res_id': self.id,
+                'mimetype': 'text/plain',
+                'raw': jsonl_file.read().encode('utf-8'),
+            })
+        # Se desglosan los productos sin separación por colores, que siguen otro camino de compilación
+        plain = sum(1 for entry in manifest if not entry['ptav_id'])
+        self.bulk_load_status = _("Dry run: %d productos compilados (%d sin separación por colores)") % (len(manifest), plain)
+        return True
+
+    def action_start_initial_load(self):
+        """
+        Carga inicial del catálogo: compila el JSONL, lo sube con stagedUploadsCreate y lanza
+        bulkOperationRunMutation. El resultado lo recoge _cron_poll_bulk_operations.
+        """
+        self.ensure_one()
+        if self.bulk_load_operation_id:
+            raise UserError(_("Ya hay una carga inicial en curso (%s).") % self.bulk_load_operation_id)
+        with tempfile.TemporaryFile(mode='w+b') as jsonl_file:
+            text_file = _BytesWriter(jsonl_file)
+            manifest = self.env['product.template']._compile_shopify_bulk_load(self, text_file)
+            if not manifest:
+                self.bulk_load_status = _("Nada que cargar")
+                return True
+            staged = self._shopify_graphql(STAGED_UPLOAD_MUTATION)['stagedUploadsCreate']
+            if staged.get('userErrors'):
+                raise UserError(_("WSSH Error en stagedUploadsCreate: %s") % staged['userErrors'])
+            target = staged['stagedTargets'][0]
+            form = {parameter['name']: parameter['value'] for parameter in target['parameters']}
+            jsonl_file.seek(0)
+            # El fichero se envía en streaming desde disco, sin cargarlo en memoria
+            upload = requests.post(target['url'], data=form, files={'file': ('products.jsonl', jsonl_file, 'text/jsonl')})
+            if not upload.ok:
+                raise UserError(_("WSSH Error subiendo el JSONL: %s") % upload.text)
+        result = self._shopify_graphql(RUN_MUTATION, {'mutation': PRODUCT_SET_MUTATION, 'path': form.get('key')})
+        run = result['bulkOperationRunMutation']
+        if run.get('userErrors'):
+            raise UserError(_("WSSH Error en bulkOperationRunMutation: %s") % run['userErrors'])
+        manifest_attachment = self.env['ir.attachment'].create({
+            'name': f'shopify_initial_load_{self.id}_manifest.json',
+            'res_model': 'shopify.instance',
+            'res_id': self.id,
+            'mimetype': 'application/json',
+            'raw': json.dumps(manifest).encode('utf-8'),
+        })
+        self.write({
+            'bulk_load_operation_id': run['bulkOperation']['id'],
+            'bulk_load_status': run['bulkOperation']['status'],
+            'bulk_load_manifest_id': manifest_attachment.id,
+        })
+        _logger.info("WSSH Carga inicial lanzada %s con %d productos", run['bulkOperation']['id'], len(manifest))
+        return True
+
+    @api.model
+    def _cron_poll_bulk_operations(self):
+        for instance in self.search([('bulk_load_operation_id', '!=', False)]):
+            instance._poll_bulk_operation()
+            self.env.cr.commit()
+
+    def _poll_bulk_operation(self):
+        self.ensure_one()
+        operation = self._shopify_graphql(BULK_OPERATION_QUERY, {'id': self.bulk_load_operation_id}).get('node') or {}
+        status = operation.get('status')
+        self.bulk_load_status = status
+        if status in ('CREATED', 'RUNNING', 'CANCELING'):
+            return False
+        url = operation.get('url') or operation.get('partialDataUrl')
+        if url:
+            manifest = json.loads(base64.b64decode(self.bulk_load_manifest_id.datas))
+            response = requests.get(url, stream=True)
+            created, failed = self.env['product.template']._apply_shopify_bulk_results(
+                self, manifest, response.iter_lines(decode_unicode=True))
+            self.bulk_load_status = _("%s: %d productos creados, %d con error") % (status, created, failed)
+        elif status != 'COMPLETED':
+            self.bulk_load_status = _("%s: %s") % (status, operation.get('errorCode'))
+        self.bulk_load_operation_id = False
+        return True
+
+
+class _BytesWriter(object):
+    """Adaptador para escribir texto en un fichero binario (para enviarlo luego como multipart)."""
+
+    def __init__(self, binary_file):
+        self.binary_file = binary_file
+
+    def write(self, text):
+        self.binary_file.write(text.encode('utf-8'))
@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+from odoo import api, fields, models
+
+# Campos que alimentan el payload de Shopify: solo su modificación marca el producto para reexportar
+# (shopify_dirty_date). Cada instancia compara esa fecha con la de su última exportación del registro
+# (shopify.export.state), así que exportar a una tienda no deja sin el cambio a las demás.
+# Las escrituras de la propia sincronización (is_shopify_product, is_exported, IDs...) no cuentan.
+# Los precios no están: se envían por su propia vía (export_prices_to_shopify) sin tocar el producto.
+SHOPIFY_TEMPLATE_FIELDS = {
+    'name', 'description', 'product_tag_ids', 'attribute_line_ids',
+    'default_code', 'barcode', 'is_published',
+}
+SHOPIFY_VARIANT_FIELDS = {'default_code', 'barcode', 'product_template_attribute_value_ids'}
+SHOPIFY_TEMPLATE_VALUE_FIELDS = {'product_attribute_value_id'}
+
+
+def _is_color(template_attribute_value):
+    return template_attribute_value.attribute_id.name.lower() == 'color'
+
+
+def _shopify_stale(records, instance):
+    """
+    Registros pendientes para la instancia: modificados desde su última exportación a ella, nunca
+    exportados (salvo los creados desde Shopify) o devueltos a pendiente (estado sin fecha).
+    """
+    if not records:
+        return records
+    exported = records.env['shopify.export.state']._get(instance, 'product', records)
+
+    def stale(record):
+        if record.id not in exported:
+            return bool(record.shopify_dirty_date)
+        date_exported = exported[record.id][0]
+        # Las fechas van por segundos: un cambio en el mismo segundo que la exportación se vuelve a enviar
+        return not date_exported or bool(record.shopify_dirty_date and date_exported <= record.shopify_dirty_date)
+    return records.filtered(stale)
+
+
+class ProductTemplateDirty(models.Model):
+    _inherit = 'product.template'
+
+    shopify_dirty_date = fields.Datetime(string="Shopify Data Changed On", default=fields.Datetime.now,
+                                         copy=False, index=True,
+                                         help="Última modificación de algún dato que se envía a Shopify.")
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        if self.env.context.get('shopify_sync'):
+            # Productos creados desde Shopify: no hay nada que devolver
+            vals_list = [dict(vals, shopify_dirty_date=False) for vals in vals_list]
+        return super().create(vals_list)
+
+    def write(self, vals):
+        if SHOPIFY_TEMPLATE_FIELDS.intersection(vals) and 'shopify_dirty_date' not in vals \
+                and not self.env.context.get('shopify_sync'):
+            vals = dict(vals, shopify_dirty_date=fields.Datetime.now())
+        return super().write(vals)
+
+    def _shopify_export_domain(self, instance):
+        """
+        Templates publicados con cambios pendientes para la instancia, ya sea en todo el template o en
+        algún color: fecha de cambio posterior a la de su última exportación a esa instancia.
+        """
+        self.flush_model(['shopify_dirty_date', 'is_published'])
+        self.env['product.template.attribute.value'].flush_model(['shopify_dirty_date', 'ptav_active', 'product_tmpl_id'])
+        self.env.cr.execute("""
+            SELECT t.id FROM product_template t
+              LEFT JOIN shopify_export_state s
+                ON s.shopify_instance_id = %(instance)s AND s.kind = 'product'
+               AND s.res_model = 'product.template' AND s.res_id = t.id
+             WHERE t.is_published
+               AND CASE WHEN s.id IS NULL THEN t.shopify_dirty_date IS NOT NULL
+                        ELSE s.date_exported IS NULL OR s.date_exported <= t.shopify_dirty_date END
+            UNION
+            SELECT t.id FROM product_template_attribute_value v
+              JOIN product_template t ON t.id = v.product_tmpl_id
+              LEFT JOIN shopify_export_state s
+                ON s.shopify_instance_id = %(instance)s AND s.kind = 'product'
+               AND s.res_model = 'product.template.attribute.value' AND s.res_id = v.id
+             WHERE t.is_published AND v.ptav_active
+               AND CASE WHEN s.id IS NULL THEN v.shopify_dirty_date IS NOT NULL
+                        ELSE s.date_exported IS NULL OR s.date_exported <= v.shopify_dirty_date END
+        """, {'instance': instance.id})
+        return [('id', 'in', [row[0] for row in self.env.cr.fetchall()])]
+
+    def _shopify_stale(self, instance):
+        return _shopify_stale(self, instance)
+
+    def _clear_shopify_dirty(self, instance, date):
+        """Registra la exportación a la instancia de los templates y sus valores de atributo con los datos de date."""
+        State = self.env['shopify.export.state']
+        State._set(instance, 'product', self, date)
+        State._set(instance, 'product', self.attribute_line_ids.product_template_value_ids, date)
+
+
+class ProductProductDirty(models.Model):
+    _inherit = 'product.product'
+
+    def write(self, vals):
+        res = super().write(vals)
+        if SHOPIFY_VARIANT_FIELDS.intersection(vals) and not self.env.context.get('shopify_sync'):
+            self._mark_shopify_dirty()
+        return res
+
+    def _mark_shopify_dirty(self):
+        """Marca el color de la variante (un único producto en Shopify) o, si no tiene color, su template."""
+        now = fields.Datetime.now()
+        colors = self.product_template_attribute_value_ids.filtered(_is_color)
+        colors.sudo().write({'shopify_dirty_date': now})
+        without_color = self.filtered(lambda p: not p.product_template_attribute_value_ids.filtered(_is_color))
+        without_color.product_tmpl_id.sudo().write({'shopify_dirty_date': now})
+
+
+class ProductTemplateAttributeValueDirty(models.Model):
+    _inherit = 'product.template.attribute.value'
+
+    shopify_dirty_date = fields.Datetime(string="Shopify Data Changed On", default=fields.Datetime.now,
+                                         copy=False, index=True)
+
+    def write(self, vals):
+        res = super().write(vals)
+        if SHOPIFY_TEMPLATE_VALUE_FIELDS.intersection(vals) and 'shopify_dirty_date' not in vals \
+                and not self.env.context.get('shopify_sync'):
+            self._mark_shopify_dirty()
+        return res
+
+    def _mark_shopify_dirty(self):
+        """Un color afecta solo a su producto de Shopify; el resto de atributos (tallas) a todo el template."""
+        now = fields.Datetime.now()
+        self.filtered(_is_color).sudo().write({'shopify_dirty_date': now})
+        self.filtered(lambda v: not _is_color(v)).product_tmpl_id.sudo().write({'shopify_dirty_date': now})
+
+    def _shopify_stale(self, instance):
+        return _shopify_stale(self, instance)
+
+    def _clear_shopify_dirty(self, instance, date):
+        self.env['shopify.export.state']._set(instance, 'product', self, date)
+
+
+class ProductAttributeValueDirty(models.Model):
+    _inherit = 'product.attribute.value'
+
+    def write(self, vals):
+        res = super().write(vals)
+        if 'name' in vals:
+            self.env['product.template.attribute.value'].sudo().search(
+                [('product_attribute_value_id', 'in', self.ids)])._mark_shopify_dirty()
+        return res
+
+
+class ProductTagDirty(models.Model):
+    _inherit = 'product.tag'
+
+    def write(self, vals):
+        res = super().write(vals)
+        if 'name' in vals:
+            self.sudo().product_template_ids.write({'shopify_dirty_date': fields.Datetime.now()})
+        return res
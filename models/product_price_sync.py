@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+from collections import defaultdict
+
+from odoo import api, fields, models, _
+from odoo.tools import float_compare
+
+import logging
+
+from .shopify_sync_run import iter_chunked
+
+_logger = logging.getLogger(__name__)
+
+# Productos de Shopify por petición GraphQL (una mutación productVariantsBulkUpdate con alias por producto)
+PRICE_BATCH_PRODUCTS = 25
+PRICE_PREFETCH = (
+    'shopify_variant_id', 'product_tmpl_id.list_price', 'product_tmpl_id.shopify_product_id',
+    'product_template_attribute_value_ids.price_extra',
+    'product_template_attribute_value_ids.shopify_product_id',
+    'product_template_attribute_value_ids.attribute_id.name',
+)
+
+
+class ProductProductPrice(models.Model):
+    _inherit = 'product.product'
+
+    def _set_shopify_pushed_price(self, instance, price=None):
+        """Registra el último precio enviado a la instancia (por defecto, el lst_price actual de cada variante)."""
+        self.env['shopify.export.state']._set(instance, 'price', self, values={
+            variant.id: variant.lst_price if price is None else price for variant in self})
+
+
+class ProductTemplatePriceSync(models.Model):
+    _inherit = 'product.template'
+
+    def _get_shopify_variant_product_id(self, variant, instance_id):
+        """ID del producto de Shopify que contiene la variante (el del color si se separa por colores)."""
+        if instance_id.split_products_by_color:
+            color = variant.product_template_attribute_value_ids.filtered(
+                lambda v: v.attribute_id.name.lower() == 'color')
+            if color:
+                return color[:1].shopify_product_id
+        return variant.product_tmpl_id.shopify_product_id
+
+    def export_prices_to_shopify(self, shopify_instance_ids):
+        """
+        Envío rápido de precios: detecta las variantes de la instancia cuyo lst_price difiere del último
+        precio enviado a ella y manda solo el precio, agrupando las variantes por producto de Shopify y
+        varios productos por petición. No se envía ni se modifica nada del resto del producto.
+        """
+        Variant = self.env['product.product']
+        State = self.env['shopify.export.state']
+        for instance_id in shopify_instance_ids:
+            with self.env['shopify.sync.run']._track(instance_id, 'export_prices') as run:
+                # Solo las variantes con ID de Shopify en esta instancia, con ese ID
+                self.env.cr.execute("""
+                    SELECT res_id, shopify_id FROM shopify_id_map
+                     WHERE shopify_instance_id = %s AND resource_type = 'variant'
+                """, (instance_id.id,))
+                shopify_variant_ids = dict(self.env.cr.fetchall())
+                variants = Variant.browse(list(shopify_variant_ids)).exists()
+                run.add(scanned=len(variants))
+                pushed_prices = {res_id: value for res_id, (date_exported, value)
+                                 in State._get(instance_id, 'price', variants).items()}
+                pending = defaultdict(list)
+                for variant in iter_chunked(variants, PRICE_PREFETCH):
+                    price = variant.lst_price
+                    if variant.id in pushed_prices \
+                            and float_compare(price, pushed_prices[variant.id], precision_digits=2) == 0:
+                        continue
+                    shopify_product_id = self._get_shopify_variant_product_id(variant, instance_id)
+                    if shopify_product_id:
+                        pending[str(shopify_product_id)].append((variant.id, str(shopify_variant_ids[variant.id]), price))
+                run.add(skipped=len(variants) - sum(len(lines) for lines in pending.values()))
+                _logger.info("WSSH Precios: %d variantes con cambios en %d productos para %s",
+                             sum(len(lines) for lines in pending.values()), len(pending), instance_id.name)
+
+                items = list(pending.items())
+                for start in range(0, len(items), PRICE_BATCH_PRODUCTS):
+                    self._push_shopify_price_batch(instance_id, items[start:start + PRICE_BATCH_PRODUCTS], run)
+                    self.env.cr.commit()
+
+    def _push_shopify_price_batch(self, instance_id, batch, run):
+        declarations = []
+        mutations = []
+        variables = {}
+        for index, (shopify_product_id, lines) in enumerate(batch):
+            declarations.append(f"$p{index}: ID!, $v{index}: [ProductVariantsBulkInput!]!")
+            mutations.append(f"p{index}: productVariantsBulkUpdate(productId: $p{index}, variants: $v{index}) "
+                             "{ userErrors { field message } }")
+            variables[f"p{index}"] = f"gid://shopify/Product/{shopify_product_id}"
+            variables[f"v{index}"] = [
+                {"id": f"gid://shopify/ProductVariant/{shopify_variant_id}", "price": "%.2f" % price}
+                for variant_id, shopify_variant_id, price in lines
+            ]
+        query = "mutation(%s) { %s }" % (", ".join(declarations), " ".join(mutations))
+        data = instance_id._shopify_graphql(query, variables)
+
+        # Registro de lo enviado en una sola escritura
+        pushed = {}
+        for index, (shopify_product_id, lines) in enumerate(batch):
+            errors = (data.get(f"p{index}") or {}).get('userErrors')
+            if errors:
+                _logger.warning("WSSH Error actualizando precios del producto %s: %s", shopify_product_id, errors)
+                run.add(failed=len(lines))
+                continue
+            run.add(sent=len(lines))
+            for variant_id, shopify_variant_id, price in lines:
+                pushed[variant_id] = price
+        self.env['shopify.export.state']._set(instance_id, 'price', self.env['product.product'].browse(list(pushed)),
+                                              values=pushed)
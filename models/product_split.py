@@ -9,13 +9,35 @@ import requests
 import re
 import time
 
+from .shopify_sync_run import iter_chunked, throttle_sleep
+
 _logger = logging.getLogger(__name__)
 
+# Campos que usan _prepare_shopify_variant_data y los payloads de producto; se precargan por bloque
+PRODUCT_EXPORT_PREFETCH = (
+    'name', 'description', 'shopify_product_id', 'shopify_dirty_date', 'product_tag_ids.name',
+    'attribute_line_ids.attribute_id.name',
+    'attribute_line_ids.product_template_value_ids.name',
+    'attribute_line_ids.product_template_value_ids.shopify_product_id',
+    'attribute_line_ids.product_template_value_ids.shopify_dirty_date',
+    'product_variant_ids.default_code', 'product_variant_ids.barcode',
+    'product_variant_ids.lst_price', 'product_variant_ids.shopify_variant_id',
+    'product_variant_ids.product_template_attribute_value_ids.name',
+    'product_variant_ids.product_template_attribute_value_ids.attribute_id.name',
+)
+STOCK_EXPORT_PREFETCH = ('default_code', 'name', 'shopify_inventory_item_id', 'product_tmpl_id.name')
+
 
 class ProductProduct(models.Model):
     _inherit = 'product.product'
 
     shopify_inventory_item_id = fields.Char(string="Shopify Inventory Item ID")
+    shopify_pushed_qty = fields.Integer(string="Shopify Pushed Quantity", copy=False,
+                                        help="Última cantidad de Odoo enviada a Shopify.")
+    shopify_pushed_qty_date = fields.Datetime(string="Shopify Quantity Pushed On", copy=False)
+
+    def _set_shopify_pushed_qty(self, quantity):
+        self.write({'shopify_pushed_qty': quantity, 'shopify_pushed_qty_date': fields.Datetime.now()})
     
 class ProductTemplateAttributeValue(models.Model):
     _inherit = 'product.template.attribute.value'
@@ -54,9 +76,26 @@ class ProductTemplateSplitColor(models.Model):
 
         return variant_data
 
-    def export_products_to_shopify(self, shopify_instance_ids, update=False):
+    def _shopify_export_candidates(self, instance_id):
+        """Templates pendientes de exportar a la instancia, en el orden en que se envían."""
+        if instance_id.last_export_product:
+            _logger.info(f"WSSH Starting product export por fecha {instance_id.last_export_product} instance {instance_id.name}")
+            # Solo los templates (o colores) con cambios en campos que se envían a Shopify
+            domain = self._shopify_export_domain(instance_id)
+        else:
+            _logger.info("WSSH Starting product export SIN fecha for instance %s", instance_id.name)
+            domain = [
+                    ('is_published', '=', True),
+                    ('is_shopify_product', '=', False)
+            ]
+        return self.search(domain, order='is_shopify_product,create_date')
+
+    def export_products_to_shopify(self, shopify_instance_ids, update=False, shard=None):
         """
-        Exporta productos a Shopify, filtrando por aquellos modificados desde la última exportación.
+        Exporta productos a Shopify. Tras la primera exportación solo se envían los templates, o los
+        colores, con cambios en campos que forman parte del payload desde su última exportación a la instancia.
+        Con shard (shopify.sync.shard) solo se exportan sus templates y la fecha de última exportación
+        no se toca: la actualiza el shard que termina el último.
         """
         color_attribute = None
         for attr in self.env['product.attribute'].search([]):
@@ -66,148 +105,252 @@ class ProductTemplateSplitColor(models.Model):
                 break
 
         for instance_id in shopify_instance_ids:                                                                             
-            # Filtrar productos modificados desde la última exportación
-            if instance_id.last_export_product:
-                _logger.info(f"WSSH Starting product export por fecha {instance_id.last_export_product} instance {instance_id.name} atcolor {color_attribute}") 
-                domain = [
-                    ('is_published', '=', True),
-                    ('write_date', '>', instance_id.last_export_product)
-                ]
-            else:
-                _logger.info("WSSH Starting product export SIN fecha for instance %s", instance_id.name)
-                domain = [
-                        ('is_published', '=', True),
-                        ('is_shopify_product', '=', False)
-                ]
-
-            products_to_export = self.search(domain, order='is_shopify_product,create_date')
+            with self.env['shopify.sync.run']._track(instance_id, 'export_products') as run:
+                # Lo exportado queda registrado con la fecha de inicio: un cambio durante la exportación se reenvía
+                export_date = fields.Datetime.now()
+                # Filtrar productos modificados desde la última exportación
+                if shard:
+                    shard.sync_run_id = run.run_id
+                    products_to_export = shard._records()
+                else:
+                    products_to_export = self._shopify_export_candidates(instance_id)
 
-            product_count = len(products_to_export)
-            _logger.info("WSSH Found %d products to export for instance %s", product_count, instance_id.name)
+                product_count = len(products_to_export)
+                run.add(scanned=product_count)
+                _logger.info("WSSH Found %d products to export for instance %s", product_count, instance_id.name)
         
-            if not products_to_export:
-                _logger.info("WSSH No products to export for instance %s", instance_id.name)
-                continue
+                if not products_to_export:
+                    _logger.info("WSSH No products to export for instance %s", instance_id.name)
+                    continue
 
-            headers = {
-                "X-Shopify-Access-Token": instance_id.shopify_shared_secret,
-                "Content-Type": "application/json"
-            }
+                headers = {
+                    "X-Shopify-Access-Token": instance_id.shopify_shared_secret,
+                    "Content-Type": "application/json"
+                }
 
-            processed_count = 0
-            max_processed = 10  # Limitar a 10 productos exportados por ejecución
+                processed_count = 0
+                max_processed = 10  # Limitar a 10 productos exportados por ejecución
+                # Templates enviados en esta ejecución: solo sus imágenes pueden haber cambiado de producto
+                sent_ids = []
         
-            # Iterar sobre cada producto a exportar
-            for product in products_to_export:                
-                #if 2>1:
-                #    continue
-                if not instance_id.split_products_by_color:
-                    # Si no hay split por colores, exportar el producto normalmente
-                    self._export_single_product(product, instance_id, headers, update)
-                    continue
+                # Iterar sobre cada producto a exportar, por bloques para acotar la memoria
+                for product in iter_chunked(products_to_export, PRODUCT_EXPORT_PREFETCH, commit=True):
+                    #if 2>1:
+                    #    continue
+                    # Buscar la línea de atributo de color (solo si se separa por colores)
+                    color_line = instance_id.split_products_by_color and self._get_shopify_color_line(product)
+
+                    DeadLetter = self.env['shopify.dead.letter']
+                    if not color_line:
+                        # Si no hay split por colores o no hay atributo de color, exportar el producto normalmente.
+                        # Cada registro va en su savepoint: un fallo pasa a la cola de errores y no corta la exportación
+                        ok, result = DeadLetter._run_guarded(
+                            instance_id, 'export_product', product,
+                            lambda: self._export_single_product(product, instance_id, headers, update))
+                        if ok:
+                            product._clear_shopify_dirty(instance_id, export_date)
+                            sent_ids.append(product.id)
+                            run.add(sent=1)
+                        else:
+                            run.add(failed=1)
+                        continue
 
-                # Buscar la línea de atributo de color
-                color_line = product.attribute_line_ids.filtered(
-                    lambda l: l.attribute_id.name.lower() == 'color')
+                    # Exportar cada color como un producto separado
+                    failed = False
+                    template_stale = bool(product._shopify_stale(instance_id))
+                    stale_colors = color_line.product_template_value_ids._shopify_stale(instance_id)
+                    for template_attribute_value, variants, variant_data, product_data in self._plan_shopify_color_units(
+                            product, color_line, instance_id, update):
+                        # Color ya exportado y sin cambios propios ni del template: no se vuelve a enviar
+                        if update and template_attribute_value.shopify_product_id \
+                                and not (template_stale or template_attribute_value in stale_colors):
+                            run.add(skipped=1)
+                            continue
 
-                if not color_line:
-                    # Si no hay atributo de color, procesar normalmente
-                    self._export_single_product(product, instance_id, headers, update)
-                    continue
+                        ok, processed = DeadLetter._run_guarded(
+                            instance_id, 'export_color', template_attribute_value,
+                            lambda: self._export_shopify_color_unit(
+                                product, template_attribute_value, variants, variant_data, product_data,
+                                instance_id, headers, update),
+                            payload=product_data)
+                        if not ok:
+                            failed = True
+                            run.add(failed=1)
+                        elif processed:
+                            processed_count += 1
+                            run.add(sent=1)
+                            if product.id not in sent_ids:
+                                sent_ids.append(product.id)
 
-               
-                # Exportar cada color como un producto separado
-                for template_attribute_value in color_line.product_template_value_ids:
-                    _logger.info(f"WSSH Exporting product: {product.name} (ID:{product.id}) update {update} variante {template_attribute_value.name}")
-                    response = None
-                    # Filtrar variantes para este color
-                    variants = product.product_variant_ids.filtered(
-                        lambda v: template_attribute_value in v.product_template_attribute_value_ids
-                    )
-
-                    if not variants:
-                        _logger.info(f"WSSH No hay variantes con codigo {template_attribute_value.name}")
-                        continue
+                    # Si algún color ha fallado, el template sigue pendiente para la próxima exportación
+                    if not failed:
+                        product._clear_shopify_dirty(instance_id, export_date)
 
-                    # Preparar datos para Shopify
-                    variant_data = [
-                        self._prepare_shopify_variant_data(variant, instance_id, template_attribute_value, True, update)
-                        for variant in variants
-                        if variant.default_code
-                    ]
-                    
-                    # Si no hay variantes con default_code, se salta este producto virtual
-                    if not variant_data:
-                        _logger.info("WSSH Skipping Shopify export for product '%s' with color '%s' because no variant has default_code",
-                                     product.name, template_attribute_value.name)
-                        continue
+                    if processed_count >= max_processed:
+                        _logger.info("WSSH Processed %d products for instance %s. Stopping export for this run.", processed_count, instance_id.name)
+                        break
+                
+                # Actualizar la fecha de la última exportación
+                if not shard:
+                    instance_id.last_export_product = fields.Datetime.now()
+
+            # Etapa de imágenes para los productos enviados (con su propio registro de ejecución)
+            if sent_ids:
+                self.browse(sent_ids).export_images_to_shopify(instance_id)
 
-                    product_data = {
-                        "product": {
-                            "title": f"{product.name} - {template_attribute_value.name}",
-                            "body_html": product.description or "",
-                            "options": [
-                                {
-                                    "name": "Color",
-                                    "position": instance_id.color_option_position,
-                                    "values": sorted(set(v.get(f"option{instance_id.color_option_position}", "") for v in variant_data))
-                                },
-                                {
-                                    "name": "Size",
-                                    "position": instance_id.size_option_position,
-                                    "values": sorted(set(v.get(f"option{instance_id.size_option_position}", "") for v in variant_data))
-                                }
-                            ],
-                            "tags": ','.join(tag.name for tag in product.product_tag_ids)
-                        }
+    def _export_shopify_color_unit(self, product, template_attribute_value, variants, variant_data, product_data,
+                                   instance_id, headers, update):
+        """
+        Crea o actualiza en Shopify el producto de un color. Devuelve True si se ha enviado.
+        Los fallos de las variantes se registran por separado para no perder el ID del producto ya creado.
+        """
+        response = None
+
+        # Si el producto ya existe, solo actualizamos el producto y sus opciones
+        if template_attribute_value.shopify_product_id:  # Acceso correcto al campo
+            if update:
+                product_data["product"]["id"] = template_attribute_value.shopify_product_id
+                url = self.get_products_url(instance_id, f'products/{template_attribute_value.shopify_product_id}.json')
+                response = instance_id._shopify_request('PUT', url, headers=headers, data=json.dumps(product_data))
+                _logger.info(f"WSSH Updating Shopify product {template_attribute_value.shopify_product_id}")
+
+                if response.ok:
+                    # Actualizar las variantes individualmente
+                    for variant in variants:
+                        self._update_shopify_variant_guarded(variant, instance_id, headers)
+            else:
+                _logger.info(f"WSSH Existe variant id pero no Update {template_attribute_value.shopify_product_id}")
+        else:
+            # Si es un nuevo producto, enviamos también las variantes
+            product_data["product"]["variants"] = variant_data
+            product_data["product"]["status"]='draft'
+            url = self.get_products_url(instance_id, 'products.json')
+            response = instance_id._shopify_request('POST', url, headers=headers, data=json.dumps(product_data))
+            _logger.info("WSSHCreating new Shopify product")
+
+            if response.ok:
+                shopify_product = response.json().get('product', {})
+                if shopify_product:
+                    # Guardar el ID del producto y actualizar los IDs de las variantes
+                    template_attribute_value.shopify_product_id = shopify_product.get('id')  # Asignación correcta del campo
+                    self._map_created_shopify_variants_guarded(
+                        product, variants, shopify_product.get('variants', []), instance_id)
+
+        if response is not None and not response.ok:
+            _logger.error(f"WSSH Error exporting product: {response.text}")
+            raise UserError(f"WSSH Error exporting product {product.name} - {template_attribute_value.name}: {response.text}")
+        return response is not None
+
+    def _map_created_shopify_variants(self, product, variants, shopify_variants, instance_id):
+        """Guarda los IDs de las variantes devueltas por Shopify y marca el template como exportado."""
+        self._update_variant_ids(variants, shopify_variants)
+        # Las variantes se han creado con su precio de Odoo
+        variants.filtered('shopify_variant_id')._set_shopify_pushed_price(instance_id)
+        product.is_shopify_product = True
+        product.shopify_instance_id = instance_id.id
+        product.is_exported = True
+
+    def _map_created_shopify_variants_guarded(self, product, variants, shopify_variants, instance_id):
+        """
+        _map_created_shopify_variants en su propio savepoint. El producto ya existe en Shopify y su ID ya
+        está escrito: un fallo aquí no debe deshacerlo (la siguiente exportación crearía un duplicado),
+        así que queda en la cola de errores con las variantes de la respuesta para reintentarlo.
+        """
+        ok, result = self.env['shopify.dead.letter']._run_guarded(
+            instance_id, 'map_variants', product,
+            lambda: self._map_created_shopify_variants(product, variants, shopify_variants, instance_id),
+            payload=shopify_variants)
+        return ok
+
+    def _update_shopify_variant_guarded(self, variant, instance_id, headers):
+        """_update_shopify_variant en su propio savepoint; si falla queda en la cola de errores."""
+        ok, result = self.env['shopify.dead.letter']._run_guarded(
+            instance_id, 'update_variant', variant,
+            lambda: self._update_shopify_variant(variant, instance_id, headers))
+        return ok
+
+    def _get_shopify_color_line(self, product):
+        """Devuelve la línea de atributo de color del template (vacía si no tiene)."""
+        return product.attribute_line_ids.filtered(lambda l: l.attribute_id.name.lower() == 'color')
+
+    def _plan_shopify_color_units(self, product, color_line, instance_id, update):
+        """
+        Genera, para cada color del template, la tupla
+        (template_attribute_value, variants, variant_data, product_data) que se exporta
+        como un producto independiente en Shopify. Los colores sin variantes con
+        default_code se omiten.
+        """
+        for template_attribute_value in color_line.product_template_value_ids:
+            _logger.info(f"WSSH Exporting product: {product.name} (ID:{product.id}) update {update} variante {template_attribute_value.name}")
+            # Filtrar variantes para este color
+            variants = product.product_variant_ids.filtered(
+                lambda v: template_attribute_value in v.product_template_attribute_value_ids
+            )
+
+            if not variants:
+                _logger.info(f"WSSH No hay variantes con codigo {template_attribute_value.name}")
+                continue
+
+            # Preparar datos para Shopify
+            variant_data = [
+                self._prepare_shopify_variant_data(variant, instance_id, template_attribute_value, True, update)
+                for variant in variants
+                if variant.default_code
+            ]
+
+            # Si no hay variantes con default_code, se salta este producto virtual
+            if not variant_data:
+                _logger.info("WSSH Skipping Shopify export for product '%s' with color '%s' because no variant has default_code",
+                             product.name, template_attribute_value.name)
+                continue
+
+            product_data = self._prepare_shopify_color_product_data(product, template_attribute_value, variant_data, instance_id)
+            yield template_attribute_value, variants, variant_data, product_data
+
+    def _prepare_shopify_color_product_data(self, product, template_attribute_value, variant_data, instance_id):
+        """Prepara el producto de Shopify que corresponde a un color del template"""
+        return {
+            "product": {
+                "title": f"{product.name} - {template_attribute_value.name}",
+                "body_html": product.description or "",
+                "options": [
+                    {
+                        "name": "Color",
+                        "position": instance_id.color_option_position,
+                        "values": sorted(set(v.get(f"option{instance_id.color_option_position}", "") for v in variant_data))
+                    },
+                    {
+                        "name": "Size",
+                        "position": instance_id.size_option_position,
+                        "values": sorted(set(v.get(f"option{instance_id.size_option_position}", "") for v in variant_data))
                     }
+                ],
+                "tags": ','.join(tag.name for tag in product.product_tag_ids)
+            }
+        }
 
-                    # Si el producto ya existe, solo actualizamos el producto y sus opciones
-                    if template_attribute_value.shopify_product_id:  # Acceso correcto al campo
-                        if update:
-                            product_data["product"]["id"] = template_attribute_value.shopify_product_id
-                            url = self.get_products_url(instance_id, f'products/{template_attribute_value.shopify_product_id}.json')
-                            response = requests.put(url, headers=headers, data=json.dumps(product_data))
-                            _logger.info(f"WSSH Updating Shopify product {template_attribute_value.shopify_product_id}")
-
-                            if response.ok:
-                                # Actualizar las variantes individualmente
-                                processed_count += 1
-                                for variant in variants:
-                                    self._update_shopify_variant(variant, instance_id, headers)
-                        else:
-                            _logger.info(f"WSSH Existe variant id pero no Update {template_attribute_value.shopify_product_id}")
-                    else:
-                        # Si es un nuevo producto, enviamos también las variantes
-                        product_data["product"]["variants"] = variant_data
-                        product_data["product"]["status"]='draft'
-                        url = self.get_products_url(instance_id, 'products.json')
-                        response = requests.post(url, headers=headers, data=json.dumps(product_data))
-                        _logger.info("WSSHCreating new Shopify product")
-
-                        if response.ok:
-                            processed_count += 1
-                            shopify_product = response.json().get('product', {})
-                            if shopify_product:
-                                # Guardar el ID del producto y actualizar los IDs de las variantes
-                                template_attribute_value.shopify_product_id = shopify_product.get('id')  # Asignación correcta del campo
-                                shopify_variants = shopify_product.get('variants', [])
-                                self._update_variant_ids(variants, shopify_variants)
-
-                                product.is_shopify_product = True
-                                product.shopify_instance_id = instance_id.id
-                                product.is_exported = True
-
-                    if response is not None and not response.ok:
-                        _logger.error(f"WSSH Error exporting product: {response.text}")
-                        raise UserError(f"WSSH Error exporting product {product.name} - {template_attribute_value.name}: {response.text}")
-
-                if processed_count >= max_processed:
-                    _logger.info("WSSH Processed %d products for instance %s. Stopping export for this run.", processed_count, instance_id.name)
-                    break
-                
-            # Actualizar la fecha de la última exportación
-            instance_id.last_export_product = fields.Datetime.now()
+    def _prepare_shopify_single_product_data(self, product):
+        """Prepara el producto de Shopify de un template sin separación por colores"""
+        product_data = {
+            "product": {
+                "title": product.name,
+                "body_html": product.description or "",
+                "tags": ','.join(tag.name for tag in product.product_tag_ids)
+            }
+        }
+
+        # Añadir opciones si hay atributos
+        if product.attribute_line_ids:
+            options = []
+            for idx, attr_line in enumerate(product.attribute_line_ids, 1):
+                if idx <= 3:
+                    options.append({
+                        "name": attr_line.attribute_id.name,
+                        "position": idx,
+                        "values": attr_line.value_ids.mapped('name')
+                    })
+            product_data["product"]["options"] = options
+        return product_data
 
     def _update_variant_ids(self, odoo_variants, shopify_variants):
         """
@@ -240,73 +383,50 @@ class ProductTemplateSplitColor(models.Model):
             if variant.default_code
         ]
 
-        product_data = {
-            "product": {
-                "title": product.name,
-                "body_html": product.description or "",
-                "tags": ','.join(tag.name for tag in product.product_tag_ids)
-            }
-        }
-
-        # Añadir opciones si hay atributos
-        if product.attribute_line_ids:
-            options = []
-            for idx, attr_line in enumerate(product.attribute_line_ids, 1):
-                if idx <= 3:
-                    options.append({
-                        "name": attr_line.attribute_id.name,
-                        "position": idx,
-                        "values": attr_line.value_ids.mapped('name')
-                    })
-            product_data["product"]["options"] = options
+        product_data = self._prepare_shopify_single_product_data(product)
 
         # Si el producto ya existe, solo actualizamos el producto y sus opciones
         if product.shopify_product_id and update:
             product_data["product"]["id"] = product.shopify_product_id
             url = self.get_products_url(instance_id, f'products/{product.shopify_product_id}.json')
-            response = requests.put(url, headers=headers, data=json.dumps(product_data))
+            response = instance_id._shopify_request('PUT', url, headers=headers, data=json.dumps(product_data))
             
             if response.ok:
                 # Actualizar las variantes individualmente
                 for variant in product.product_variant_ids:
                     if variant.default_code:
-                        self._update_shopify_variant(variant, instance_id, headers)
+                        self._update_shopify_variant_guarded(variant, instance_id, headers)
                     
         else:
             # Si es un nuevo producto, enviamos también las variantes
             product_data["product"]["status"]='draft'
             product_data["product"]["variants"] = variant_data
             url = self.get_products_url(instance_id, 'products.json')
-            response = requests.post(url, headers=headers, data=json.dumps(product_data))
+            response = instance_id._shopify_request('POST', url, headers=headers, data=json.dumps(product_data))
 
         if response.ok:
             shopify_product = response.json().get('product')
             if shopify_product:
                 # Actualizar ID del producto y de sus variantes
                 product.shopify_product_id = shopify_product.get('id')
-                shopify_variants = shopify_product.get('variants', [])
-                self._update_variant_ids(product.product_variant_ids, shopify_variants)
-
-                product.is_shopify_product = True
-                product.shopify_instance_id = instance_id.id
-                product.is_exported = True
+                self._map_created_shopify_variants_guarded(
+                    product, product.product_variant_ids, shopify_product.get('variants', []), instance_id)
                 _logger.info(f"WSSH Successfully exported product {product.name}")
         else:
             _logger.error(f"WSSH Error exporting product: {response.text}")
             raise UserError(f"WSSH Error exporting product {product.name}: {response.text}")
 
     def get_products_url(self, instance_id, endpoint):
-        shop_url = "https://{}.myshopify.com/admin/api/{}/{}".format(instance_id.shopify_host,
-                                                                     instance_id.shopify_version, endpoint)
-        return shop_url
+        return instance_id._get_shopify_api_url(endpoint)
         
     def _update_shopify_variant(self, variant, instance_id, headers):
         """Actualiza una variante en Shopify usando el endpoint variants/<id_variant>.json"""
         variant_data = self._prepare_shopify_variant_data(variant, instance_id, is_update=True)
         url = self.get_products_url(instance_id, f'variants/{variant.shopify_variant_id}.json')
-        response = requests.put(url, headers=headers, data=json.dumps({"variant": variant_data}))
+        response = instance_id._shopify_request('PUT', url, headers=headers, data=json.dumps({"variant": variant_data}))
         
         if response.ok:
+            variant._set_shopify_pushed_price(instance_id, variant_data['price'])
             _logger.info(f"WSSH Successfully updated variant {variant.default_code} in Shopify")
         else:
             _logger.error(f"WSSH Error updating variant {variant.default_code}: {response.text}")
@@ -315,55 +435,60 @@ class ProductTemplateSplitColor(models.Model):
     def import_shopify_products(self, shopify_instance_ids, skip_existing_products, from_date, to_date):
         if not shopify_instance_ids:
             shopify_instance_ids = self.env['shopify.instance'].sudo().search([('shopify_active', '=', True)])
-        
+        # Lo que llega de Shopify no debe marcar los productos como pendientes de exportar
+        Template = self.with_context(shopify_sync=True)
+
         for shopify_instance_id in shopify_instance_ids:
-            _logger.info("WSSH Starting product import for instance %s", shopify_instance_id.name)                                                                                                  
-            url = self.get_products_url(shopify_instance_id, endpoint='products.json')
-            access_token = shopify_instance_id.shopify_shared_secret
-            headers = {
-                "X-Shopify-Access-Token": access_token,
-            }
+            with Template.env['shopify.sync.run']._track(shopify_instance_id, 'import_products') as run:
+                _logger.info("WSSH Starting product import for instance %s", shopify_instance_id.name)                                                                                                  
+                url = Template.get_products_url(shopify_instance_id, endpoint='products.json')
+                access_token = shopify_instance_id.shopify_shared_secret
+                headers = {
+                    "X-Shopify-Access-Token": access_token,
+                }
             
-            # Parámetros para la solicitud
-            params = {
-                "limit": 250,  # Ajustar el tamaño de la página según sea necesario
-                "order": "id asc",
-                "page_info": None,
-            }
+                # Parámetros para la solicitud
+                params = {
+                    "limit": 250,  # Ajustar el tamaño de la página según sea necesario
+                    "order": "id asc",
+                    "page_info": None,
+                }
             
-            if from_date and to_date:
-                params.update({
-                    "created_at_min": from_date,
-                    "created_at_max": to_date,
-                })
+                if from_date and to_date:
+                    params.update({
+                        "created_at_min": from_date,
+                        "created_at_max": to_date,
+                    })
             
-            all_products = []
-            while True:
-                #_logger.info("WSSH Shopify POST response JSON: %s", json.dumps(response.json(), indent=4))
-                response = requests.get(url, headers=headers, params=params)                
-                if response.status_code == 200 and response.content:
-                    shopify_products = response.json()
-                    products = shopify_products.get('products', [])
-                    all_products.extend(products)
-                    _logger.info("WSSH All products fetched : %d", len(all_products))
-                    # Verificar si hay más páginas                        
-                    link_header = response.headers.get('Link')
-                    if link_header:
-                        links = shopify_instance_id._parse_link_header(link_header)
-                        if 'next' in links:
-                            url = links['next']
-                            params = None                            
-                            continue
-                break              
-            _logger.info("WSSH Total products fetched from Shopify: %d", len(all_products))
+                all_products = []
+                while True:
+                    #_logger.info("WSSH Shopify POST response JSON: %s", json.dumps(response.json(), indent=4))
+                    response = shopify_instance_id._shopify_request('GET', url, headers=headers, params=params)                
+                    if response.status_code == 200 and response.content:
+                        shopify_products = response.json()
+                        products = shopify_products.get('products', [])
+                        all_products.extend(products)
+                        _logger.info("WSSH All products fetched : %d", len(all_products))
+                        # Verificar si hay más páginas                        
+                        link_header = response.headers.get('Link')
+                        if link_header:
+                            links = shopify_instance_id._parse_link_header(link_header)
+                            if 'next' in links:
+                                url = links['next']
+                                params = None                            
+                                continue
+                    break              
+                _logger.info("WSSH Total products fetched from Shopify: %d", len(all_products))
+                run.add(scanned=len(all_products))
              
-            if all_products:
-                # Procesar los productos importados
-                products = self._process_imported_products(all_products, shopify_instance_id, skip_existing_products)
-                return products
-            else:
-                _logger.info("WSSHProducts not found in Shopify store")
-                return []
+                if all_products:
+                    # Procesar los productos importados
+                    products = Template._process_imported_products(all_products, shopify_instance_id, skip_existing_products)
+                    run.add(sent=len(products))
+                    return products
+                else:
+                    _logger.info("WSSHProducts not found in Shopify store")
+                    return []
 
     def _process_imported_products(self, shopify_products, shopify_instance_id, skip_existing_products):
       product_list = []
@@ -372,9 +497,8 @@ class ProductTemplateSplitColor(models.Model):
           shopify_product_id = shopify_product.get('id')
           
           # Buscar si el producto ya existe en Odoo por shopify_product_id en product.template.attribute.value
-          existing_attribute_value = self.env['product.template.attribute.value'].sudo().search([
-              ('shopify_product_id', '=', shopify_product_id),
-          ], limit=1)
+          mapped_value = self.env['shopify.id.map']._lookup(shopify_instance_id, 'color_product', [shopify_product_id])
+          existing_attribute_value = self.env['product.template.attribute.value'].sudo().browse(list(mapped_value.values()))
           
           if existing_attribute_value:
               # Si el producto ya existe, no hacer nada
@@ -388,11 +512,12 @@ class ProductTemplateSplitColor(models.Model):
               sku = variant.get('sku')
               _logger.info(f"WSSH iterando varian {sku}")
               # Buscar por shopify_variant_id o default_code (SKU)
-              existing_variant = self.env['product.product'].sudo().search([
-                  '|',
-                  ('shopify_variant_id', '=', shopify_variant_id),
-                  ('default_code', '=', sku),  # OR para default_code
-              ], limit=1)
+              mapped_variant = self.env['shopify.id.map']._lookup(shopify_instance_id, 'variant', [shopify_variant_id])
+              if mapped_variant:
+                  existing_variant = self.env['product.product'].sudo().browse(list(mapped_variant.values()))
+              else:
+                  existing_variant = self.env['product.product'].sudo().search([('default_code', '=', sku)], limit=1) if sku \
+                      else self.env['product.product']
               
               if existing_variant:
                   # Filtramos los valores de atributo cuyo atributo sea "color"
@@ -477,7 +602,71 @@ class ProductTemplateSplitColor(models.Model):
         
         return product_template
 
-    def export_stock_to_shopify(self, shopify_instance):
+    def _sync_shopify_inventory_level(self, shopify_instance, inventory_level):
+        """
+        Procesa un webhook inventory_levels/update. Solo se reenvía la cantidad de Odoo si ha cambiado
+        desde la última que se envió: si no, la diferencia viene de Shopify (p.ej. una venta cuyo pedido
+        aún no se ha importado) y revertirla invitaría a vender de más. Esa diferencia solo se registra;
+        la corrige, si procede, la auditoría de inventario.
+        """
+        location = self.env['shopify.location'].sudo().search([('shopify_location_id', '!=', False)], limit=1)
+        if not location or str(location.shopify_location_id) != str(inventory_level.get('location_id')):
+            return False
+        product = self.env['product.product'].sudo().search(
+            [('shopify_inventory_item_id', '=', str(inventory_level.get('inventory_item_id')))], limit=1)
+        if not product:
+            return False
+        quants = self.env['stock.quant'].sudo().search([('product_id', '=', product.id)])
+        available_qty = int(sum(quants.mapped('quantity')))
+        if available_qty == inventory_level.get('available'):
+            if not product.shopify_pushed_qty_date or product.shopify_pushed_qty != available_qty:
+                product._set_shopify_pushed_qty(available_qty)
+            return False
+        if not product.shopify_pushed_qty_date or product.shopify_pushed_qty == available_qty:
+            _logger.info("WSSH Stock de %s distinto en Shopify (%s) y Odoo (%s) sin cambios en Odoo, no se revierte",
+                         product.default_code, inventory_level.get('available'), available_qty)
+            return False
+        _logger.info("WSSH Stock de %s cambiado en Odoo (%s -> %s), se envía a Shopify (tenía %s)",
+                     product.default_code, product.shopify_pushed_qty, available_qty, inventory_level.get('available'))
+        url = self.get_products_url(shopify_instance, 'inventory_levels/set.json')
+        headers = {
+            "X-Shopify-Access-Token": shopify_instance.shopify_shared_secret,
+            "Content-Type": "application/json"
+        }
+        response = shopify_instance._shopify_request('POST', url, headers=headers, json={
+            "location_id": location.shopify_location_id,
+            "inventory_item_id": product.shopify_inventory_item_id,
+            "available": available_qty,
+        })
+        if not response.ok:
+            raise UserError(f"WSSH Error updating stock for {product.default_code}: {response.text}")
+        product._set_shopify_pushed_qty(available_qty)
+        return True
+
+    def _shopify_stock_snapshot(self, since=None, product_ids=None):
+        """
+        Stock de Odoo de las variantes con shopify_inventory_item_id, agrupado en PostgreSQL por producto
+        para no cargar todos los stock.quant en memoria. Con since, solo productos con quants modificados después;
+        con product_ids, solo esas variantes.
+
+        :return: lista de tuplas (product_id, inventory_item_id, cantidad, último write_date) ordenada por fecha
+        """
+        self.env['stock.quant'].flush_model(['product_id', 'quantity', 'write_date'])
+        self.env['product.product'].flush_model(['shopify_inventory_item_id', 'active'])
+        self.env.cr.execute("""
+            SELECT q.product_id, p.shopify_inventory_item_id, SUM(q.quantity), MAX(q.write_date)
+              FROM stock_quant q
+              JOIN product_product p ON p.id = q.product_id
+             WHERE p.active
+               AND p.shopify_inventory_item_id IS NOT NULL AND p.shopify_inventory_item_id != ''
+               AND (%(since)s IS NULL OR q.write_date > %(since)s)
+               AND (%(product_ids)s IS NULL OR q.product_id = ANY(%(product_ids)s))
+             GROUP BY q.product_id, p.shopify_inventory_item_id
+             ORDER BY MAX(q.write_date), q.product_id
+        """, {'since': since or None, 'product_ids': list(product_ids) if product_ids is not None else None})
+        return self.env.cr.fetchall()
+
+    def export_stock_to_shopify(self, shopify_instance, shard=None):
         """
         Exporta el stock a Shopify para las variantes que tienen definido el campo shopify_inventory_item_id.
         Se realiza una única búsqueda de stock.quant en la ubicación definida en la instancia, filtrando:
@@ -487,91 +676,90 @@ class ProductTemplateSplitColor(models.Model):
         Se agrupan los quants por producto para sumar la cantidad disponible y se actualiza el stock en Shopify.
         En caso de superar un timeout predefinido en la iteración, se actualiza la fecha de última exportación con
         el write_date del stock.quant actual.
+        Con shard (shopify.sync.shard) solo se envían sus variantes y esa fecha se guarda en el shard.
         """
-        _logger.info("WSSH Exportar stocks")
-        updated_ids = []
-        location = self.env['shopify.location'].sudo().search([('shopify_location_id', '!=', False)], limit=1)
-    
-        # Dominio en stock.quant usando búsqueda en campo relacionado:
-        domain = [
-            ('product_id.shopify_inventory_item_id', '!=', False)
-        ]
-        if shopify_instance.last_export_stock:
-            domain.append(('write_date', '>', shopify_instance.last_export_stock))
-    
-        # Ordenar los stock.quants por write_date ascendente
-        stock_quants = self.env['stock.quant'].sudo().search(domain, order="write_date asc")
-        _logger.info(f"WSSH Found {len(stock_quants)} quants desde {shopify_instance.last_export_stock}")
+        with self.env['shopify.sync.run']._track(shopify_instance, 'export_stock') as run:
+            _logger.info("WSSH Exportar stocks")
+            updated_ids = []
+            # La ejecución guarda las variantes actualizadas para abrir el resultado al terminar
+            run.result_ids = updated_ids
+            if shard:
+                shard.sync_run_id = run.run_id
+            location = self.env['shopify.location'].sudo().search([('shopify_location_id', '!=', False)], limit=1)
     
-        # Agrupar los quants por producto, sumando cantidades y tomando el máximo write_date para cada producto
-        product_data = {}
-        for quant in stock_quants:
-            product = quant.product_id
-            if product not in product_data:
-                product_data[product] = {'quantity': 0, 'write_date': quant.write_date}
-            product_data[product]['quantity'] += quant.quantity
-            if quant.write_date > product_data[product]['write_date']:
-                product_data[product]['write_date'] = quant.write_date
+            product_data = {product_id: {'quantity': quantity, 'write_date': write_date}
+                            for product_id, inventory_item_id, quantity, write_date
+                            in self._shopify_stock_snapshot(shopify_instance.last_export_stock,
+                                                            shard._record_ids() if shard else None)}
+            _logger.info(f"WSSH Found {len(product_data)} productos con stock desde {shopify_instance.last_export_stock}")
+            run.add(scanned=len(product_data))
+            products = self.env['product.product'].sudo().browse(list(product_data))
+            location_id = location.shopify_location_id
+
+            # Variables para controlar el tiempo entre peticiones y el tiempo total de iteración
+            last_query_time = 0.0
+            iteration_timeout = 500  # Tiempo máximo permitido para la iteración en segundos
+            iteration_start_time = time.time()
     
-        # Ordenar los productos por write_date ascendente (del grupo)
-        sorted_products = sorted(product_data.items(), key=lambda x: x[1]['write_date'])
+            # Actualizar Shopify para cada producto (ya ordenados por write_date), por bloques
+            for product in iter_chunked(products, STOCK_EXPORT_PREFETCH):
+                data = product_data[product.id]
+                available_qty = data['quantity']
+                current_write_date = data['write_date']
+                _logger.info(f"WSSH iterando {product.default_code} cantidad {available_qty} con write_date {current_write_date}")
     
-        # Variables para controlar el tiempo entre peticiones y el tiempo total de iteración
-        last_query_time = 0.0
-        iteration_timeout = 500  # Tiempo máximo permitido para la iteración en segundos
-        iteration_start_time = time.time()
+                # Esperar si la última petición se realizó hace menos de 0.5 segundos (máximo 2 peticiones/segundo)
+                elapsed = time.time() - last_query_time
+                if elapsed < 0.5:
+                    throttle_sleep(0.5 - elapsed)
+                last_query_time = time.time()
     
-        # Actualizar Shopify para cada producto
-        for product, data in sorted_products:    
-            available_qty = data['quantity']
-            current_write_date = data['write_date']
-            _logger.info(f"WSSH iterando {product.default_code} cantidad {available_qty} con write_date {current_write_date}")
+                url = self.get_products_url(shopify_instance, 'inventory_levels/set.json')
+                headers = {
+                    "X-Shopify-Access-Token": shopify_instance.shopify_shared_secret,
+                    "Content-Type": "application/json"
+                }
+                data_payload = {
+                    "location_id": location_id,
+                    "inventory_item_id": product.shopify_inventory_item_id,
+                    "available": int(available_qty),
+                }
     
-            # Esperar si la última petición se realizó hace menos de 0.5 segundos (máximo 2 peticiones/segundo)
-            elapsed = time.time() - last_query_time
-            if elapsed < 0.5:
-                time.sleep(0.5 - elapsed)
-            last_query_time = time.time()
-    
-            url = self.get_products_url(shopify_instance, 'inventory_levels/set.json')
-            headers = {
-                "X-Shopify-Access-Token": shopify_instance.shopify_shared_secret,
-                "Content-Type": "application/json"
-            }
-            data_payload = {
-                "location_id": location.shopify_location_id,
-                "inventory_item_id": product.shopify_inventory_item_id,
-                "available": int(available_qty),
-            }
-    
-            max_retries = 1
-            attempt = 0
-            while attempt <= max_retries:
-                response = requests.post(url, headers=headers, json=data_payload)
-                if response.status_code in (200, 201):
-                    _logger.info("WSSH Stock updated for product %s (variant %s): %s available",
-                                 product.product_tmpl_id.name, product.name, available_qty)
-                    updated_ids.append(product.id)
-                    break  # Salir del loop si la petición fue exitosa
-                elif "Exceeded 2 calls per second" in response.text:
-                    _logger.warning("WSSH Rate limit exceeded for product %s. Esperando 1 segundo y reintentando...", product.default_code)
-                    time.sleep(1)
-                    attempt += 1
-                    last_query_time = time.time()
-                else:
-                    _logger.warning("WSSH Failed to update stock for product %s (variant %s): %s",
-                                    product.product_tmpl_id.name, product.name, response.text)
-                    break
-                        # Comprobar si se ha superado el tiempo máximo permitido en la iteración
+                max_retries = 1
+                attempt = 0
+                while attempt <= max_retries:
+                    response = shopify_instance._shopify_request('POST', url, headers=headers, json=data_payload)
+                    if response.status_code in (200, 201):
+                        _logger.info("WSSH Stock updated for product %s (variant %s): %s available",
+                                     product.product_tmpl_id.name, product.name, available_qty)
+                        updated_ids.append(product.id)
+                        product._set_shopify_pushed_qty(int(available_qty))
+                        run.add(sent=1)
+                        break  # Salir del loop si la petición fue exitosa
+                    elif "Exceeded 2 calls per second" in response.text:
+                        _logger.warning("WSSH Rate limit exceeded for product %s. Esperando 1 segundo y reintentando...", product.default_code)
+                        throttle_sleep(1)
+                        attempt += 1
+                        last_query_time = time.time()
+                    else:
+                        _logger.warning("WSSH Failed to update stock for product %s (variant %s): %s",
+                                        product.product_tmpl_id.name, product.name, response.text)
+                        run.add(failed=1)
+                        break
+                            # Comprobar si se ha superado el tiempo máximo permitido en la iteración
                         
-            # Tras enviar la query, comprobamos si se ha superado el tiempo total de iteración.
-            if time.time() - iteration_start_time > iteration_timeout:
-                adjusted_write_date = current_write_date - timedelta(seconds=1)
-                _logger.error("WSSH Timeout de iteración alcanzado para el producto %s. Actualizando last_export_stock con write_date %s",
-                              product.default_code, adjusted_write_date)
-                shopify_instance.last_export_stock = adjusted_write_date
-                return updated_ids
+                # Tras enviar la query, comprobamos si se ha superado el tiempo total de iteración.
+                if time.time() - iteration_start_time > iteration_timeout:
+                    adjusted_write_date = current_write_date - timedelta(seconds=1)
+                    _logger.error("WSSH Timeout de iteración alcanzado para el producto %s. Actualizando last_export_stock con write_date %s",
+                                  product.default_code, adjusted_write_date)
+                    if shard:
+                        shard.watermark = adjusted_write_date
+                    else:
+                        shopify_instance.last_export_stock = adjusted_write_date
+                    return updated_ids
                 
-        shopify_instance.last_export_stock = fields.Datetime.now()
+            if not shard:
+                shopify_instance.last_export_stock = fields.Datetime.now()
     
-        return updated_ids
+            return updated_ids
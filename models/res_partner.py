@@ -5,12 +5,20 @@ from odoo import api, fields, models, _
 from odoo.exceptions import UserError
 import logging
 
+from .shopify_sync_run import export_chunk_size
+
 _logger = logging.getLogger(__name__)
 
+# Campos del partner que usa la exportación de clientes del conector; se precargan por bloque
+CUSTOMER_EXPORT_PREFETCH = ('name', 'email', 'phone', 'street', 'city', 'zip', 'country_id.code', 'state_id.code')
+
 
 class ResPartner(models.Model):
     _inherit = 'res.partner'
 
+    def get_customer_url(self, shopify_instance_id, endpoint):
+        return shopify_instance_id._get_shopify_api_url(endpoint)
+
     def import_shopify_customers(self, shopify_instance_ids, skip_existing_customer):
         """
         Extiende la importación de clientes para filtrar por fecha de creación,
@@ -23,49 +31,53 @@ class ResPartner(models.Model):
 
         _logger.info("WSSH Import customer %i ", len(shopify_instance_ids))
         for shopify_instance_id in shopify_instance_ids:
-            # Construir la URL para obtener clientes
-            _logger.info("WSSH dentro instance %s ", shopify_instance_id.name)
-            url = self.get_customer_url(shopify_instance_id, endpoint='customers.json')
-            access_token = shopify_instance_id.shopify_shared_secret
-            headers = {
-                "X-Shopify-Access-Token": access_token,
-            }
-            # Se inicia con los parámetros básicos
-            params = {
-                "limit": 250,
-                "page_info": None,
-            }
-            # Si existe shopify_last_date_customer_import (puede ser nulo la primera vez), se añade el filtro.
-            if shopify_instance_id.shopify_last_date_customer_import:
-                params["created_at_min"] = shopify_instance_id.shopify_last_date_customer_import
+            with self.env['shopify.sync.run']._track(shopify_instance_id, 'import_customers') as run:
+                # Construir la URL para obtener clientes
+                _logger.info("WSSH dentro instance %s ", shopify_instance_id.name)
+                url = self.get_customer_url(shopify_instance_id, endpoint='customers.json')
+                access_token = shopify_instance_id.shopify_shared_secret
+                headers = {
+                    "X-Shopify-Access-Token": access_token,
+                }
+                # Se inicia con los parámetros básicos
+                params = {
+                    "limit": 250,
+                    "page_info": None,
+                }
+                # Si existe shopify_last_date_customer_import (puede ser nulo la primera vez), se añade el filtro.
+                if shopify_instance_id.shopify_last_date_customer_import:
+                    params["created_at_min"] = shopify_instance_id.shopify_last_date_customer_import
 
-            all_customers = []
-            while True:
-                _logger.info("WSSH iteracion response")
-                response = requests.get(url, headers=headers, params=params)
-                if response.status_code == 200 and response.content:
-                    shopify_customers = response.json()
-                    customers = shopify_customers.get('customers', [])
-                    all_customers.extend(customers)
-                    _logger.info(f"WSSH iteracion response n {len(all_customers)}")
-                    # Manejo de paginación: suponemos que en tu respuesta se usa page_info.
-                    link_header = response.headers.get('Link')
-                    if link_header:
-                        links = shopify_instance_id._parse_link_header(link_header)
-                        if 'next' in links:
-                            url = links['next']
-                            params = None
-                            continue
-                break
-            _logger.info("WSSH Found %d customer to export for instance %s", len(all_customers), shopify_instance_id.name)
+                all_customers = []
+                while True:
+                    _logger.info("WSSH iteracion response")
+                    response = shopify_instance_id._shopify_request('GET', url, headers=headers, params=params)
+                    if response.status_code == 200 and response.content:
+                        shopify_customers = response.json()
+                        customers = shopify_customers.get('customers', [])
+                        all_customers.extend(customers)
+                        _logger.info(f"WSSH iteracion response n {len(all_customers)}")
+                        # Manejo de paginación: suponemos que en tu respuesta se usa page_info.
+                        link_header = response.headers.get('Link')
+                        if link_header:
+                            links = shopify_instance_id._parse_link_header(link_header)
+                            if 'next' in links:
+                                url = links['next']
+                                params = None
+                                continue
+                    break
+                _logger.info("WSSH Found %d customer to export for instance %s", len(all_customers), shopify_instance_id.name)
             
-            if all_customers:
-                # Aquí usamos super() para delegar en la implementación original de create_customers
-                # y evitar reescribir toda la lógica de creación/actualización de clientes.
-                return self.create_customers(all_customers, shopify_instance_id, skip_existing_customer)
-            else:
-                _logger.info("Customers not found in shopify store")
-                return []
+                run.add(scanned=len(all_customers))
+                if all_customers:
+                    # Aquí usamos super() para delegar en la implementación original de create_customers
+                    # y evitar reescribir toda la lógica de creación/actualización de clientes.
+                    customer_list = self.create_customers(all_customers, shopify_instance_id, skip_existing_customer)
+                    run.add(sent=len(customer_list))
+                    return customer_list
+                else:
+                    _logger.info("Customers not found in shopify store")
+                    return []
                 
     def create_customers(self, shopify_customers, shopify_instance_id, skip_existing_customer):
         """
@@ -81,24 +93,11 @@ class ResPartner(models.Model):
         :return: Lista de IDs de res.partner creados o actualizados.
         """
         customer_list = []
+        country_cache = {}
     
         for shopify_customer in shopify_customers:
-            # Reutilizamos la lógica para obtener el nombre del cliente
-            name = self._get_customer_name(shopify_customer)
-    
-            # Procesamos la dirección
-            address = shopify_customer.get('addresses')
-            street = street2 = city = zip = ""
-            country_id = False
-            if address:
-                street = shopify_customer.get('address1') or address[0].get('address1') or ""
-                street2 = shopify_customer.get('address2') or address[0].get('address2') or ""
-                city = shopify_customer.get('city') or address[0].get('city') or ""
-                zip = shopify_customer.get('zip') or address[0].get('zip') or ""
-                country_code = shopify_customer.get('country_code') or address[0].get('country_code')
-                phone=shopify_customer.get('phone') or address[0].get('phone')
-                country = self.env['res.country'].sudo().search([('code', '=', country_code)], limit=1)
-                country_id = country.id if country else False
+            vals = self._prepare_shopify_customer_vals(shopify_customer, shopify_instance_id, country_cache)
+            name = vals['name']
     
             # Se busca si el partner ya existe
             partner = self._find_existing_partner(shopify_customer, shopify_instance_id)
@@ -108,24 +107,11 @@ class ResPartner(models.Model):
                 if not skip_existing_customer:
                     _logger.info(f"WSSH Dentro skip")
                     # Construimos vals_update solo con los campos que tengan valor
-                    vals_update = {}
-    
-                    if name:
-                        vals_update['name'] = name
-                    if shopify_customer.get('email'):
-                        vals_update['email'] = shopify_customer.get('email')
-                    if phone:
-                        vals_update['phone'] = phone
-                    if street:
-                        vals_update['street'] = street
-                    if street2:
-                        vals_update['street2'] = street2
-                    if city:
-                        vals_update['city'] = city
-                    if zip:
-                        vals_update['zip'] = zip
-                    if country_id:
-                        vals_update['country_id'] = country_id
+                    vals_update = {
+                        field: vals[field]
+                        for field in ('name', 'email', 'phone', 'street', 'street2', 'city', 'zip', 'country_id')
+                        if vals[field]
+                    }
                     
                     # Siempre se actualizan estos campos
                     vals_update['shopify_customer_id'] = shopify_customer.get('id')
@@ -135,30 +121,137 @@ class ResPartner(models.Model):
                     partner.with_context(no_vat_validation=True).write(vals_update)
             else:
                 _logger.info(f"WSSH Partner NO encontrado {name} id {shopify_customer.get('id')}")
-                # Se arma el diccionario completo para la creación del partner
-                vals = {
-                    'name': name,
-                    'customer_rank': 1,
-                    'email': shopify_customer.get('email'),
-                    'vat': shopify_customer.get('vat'),
-                    'shopify_customer_id': shopify_customer.get('id'),
-                    'ref': 'SID' + str(shopify_customer.get('id')),
-                    'is_shopify_customer': True,
-                    'phone': phone,
-                    'shopify_instance_id': shopify_instance_id.id,
-                    'shopify_note': shopify_customer.get('note'),
-                    'street': street,
-                    'street2': street2,
-                    'city': city,
-                    'zip': zip,
-                    'country_id': country_id,
-                }
                 partner = super(ResPartner, self).with_context(no_vat_validation=True).create(vals)
 
             
             customer_list.append(partner.id)
         
         return customer_list
+
+    def _prepare_shopify_customer_vals(self, shopify_customer, shopify_instance_id, country_cache=None):
+        """
+        Construye los valores de creación de un partner a partir de un cliente de Shopify.
+        Acepta tanto el listado 'addresses' de customers.json como el 'default_address'
+        que viene embebido en los pedidos.
+
+        :param country_cache: dict opcional {código país: id} compartido entre llamadas.
+        :return: dict de valores para res.partner.create.
+        """
+        if country_cache is None:
+            country_cache = {}
+        address = shopify_customer.get('addresses') or (
+            [shopify_customer['default_address']] if shopify_customer.get('default_address') else [])
+        street = street2 = city = zip = ""
+        country_id = False
+        phone = shopify_customer.get('phone')
+        if address:
+            street = shopify_customer.get('address1') or address[0].get('address1') or ""
+            street2 = shopify_customer.get('address2') or address[0].get('address2') or ""
+            city = shopify_customer.get('city') or address[0].get('city') or ""
+            zip = shopify_customer.get('zip') or address[0].get('zip') or ""
+            country_code = shopify_customer.get('country_code') or address[0].get('country_code')
+            phone = phone or address[0].get('phone')
+            if country_code not in country_cache:
+                country_cache[country_code] = self.env['res.country'].sudo().search([('code', '=', country_code)], limit=1).id
+            country_id = country_cache[country_code] or False
+
+        return {
+            'name': self._get_customer_name(shopify_customer),
+            'customer_rank': 1,
+            'email': shopify_customer.get('email'),
+            'vat': shopify_customer.get('vat'),
+            'shopify_customer_id': shopify_customer.get('id'),
+            'ref': 'SID' + str(shopify_customer.get('id')),
+            'is_shopify_customer': True,
+            'phone': phone,
+            'shopify_instance_id': shopify_instance_id.id,
+            'shopify_note': shopify_customer.get('note'),
+            'street': street,
+            'street2': street2,
+            'city': city,
+            'zip': zip,
+            'country_id': country_id,
+        }
+
+    def _resolve_shopify_customers(self, shopify_customers, shopify_instance_id):
+        """
+        Resuelve en bloque los clientes de una página de pedidos.
+
+        Busca con una consulta por shopify_customer_id y con otra por email (en partners sin mapping),
+        crea los que faltan con un único create y solo escribe customer_rank, ref y el mapping de Shopify
+        en los partners en los que realmente difieren, para no bloquear filas de res.partner sin necesidad.
+
+        :return: dict {shopify_customer_id (str): res.partner}
+        """
+        customers = {}
+        for shopify_customer in shopify_customers:
+            if shopify_customer and shopify_customer.get('id'):
+                customers.setdefault(str(shopify_customer['id']), shopify_customer)
+        if not customers:
+            return {}
+
+        partners = self._find_existing_partners_batch(list(customers.values()), shopify_instance_id)
+
+        missing = [customer_id for customer_id in customers if customer_id not in partners]
+        if missing:
+            country_cache = {}
+            vals_list = [
+                self._prepare_shopify_customer_vals(customers[customer_id], shopify_instance_id, country_cache)
+                for customer_id in missing
+            ]
+            new_partners = super(ResPartner, self.sudo()).with_context(no_vat_validation=True).create(vals_list)
+            partners.update(zip(missing, new_partners))
+            _logger.info("WSSH Creados %d clientes nuevos desde pedidos", len(new_partners))
+
+        written = set()
+        for customer_id, partner in partners.items():
+            # Si dos clientes de Shopify coinciden por email con el mismo partner, solo mapeamos el primero
+            if partner.id in written:
+                continue
+            written.add(partner.id)
+            vals = {}
+            if partner.customer_rank != 1:
+                vals['customer_rank'] = 1
+            if partner.ref != 'SID' + customer_id:
+                vals['ref'] = 'SID' + customer_id
+            if partner.shopify_customer_id != customer_id:
+                vals['shopify_customer_id'] = customer_id
+                vals['is_shopify_customer'] = True
+            if partner.shopify_instance_id != shopify_instance_id:
+                vals['shopify_instance_id'] = shopify_instance_id.id
+            if vals:
+                partner.sudo().with_context(no_vat_validation=True).write(vals)
+        return partners
+
+    def _find_existing_partners_batch(self, shopify_customers, shopify_instance_id):
+        """
+        Versión por lotes de _find_existing_partner: una consulta por shopify_customer_id y,
+        para los que no tienen mapping, otra por email entre los partners sin shopify_customer_id.
+
+        :return: dict {shopify_customer_id (str): res.partner}
+        """
+        customer_ids = [str(customer.get('id')) for customer in shopify_customers]
+        mapped = self.env['shopify.id.map']._lookup(shopify_instance_id, 'customer', customer_ids)
+        shopify_ids = {partner_id: shopify_id for shopify_id, partner_id in mapped.items()}
+        partners = {shopify_ids[partner.id]: partner for partner in self.sudo().browse(list(shopify_ids))}
+
+        emails = {}
+        for customer in shopify_customers:
+            email = customer.get('email')
+            if str(customer.get('id')) in partners or not email:
+                continue
+            email = shopify_instance_id.clean_string(email)
+            if self._is_valid_email(email):
+                emails[str(customer.get('id'))] = email
+        if emails:
+            partners_by_email = {}
+            for partner in self.sudo().search([('shopify_customer_id', '=', False),
+                                               ('email', 'in', list(set(emails.values())))]):
+                partners_by_email.setdefault(partner.email, partner)
+            for customer_id, email in emails.items():
+                if email in partners_by_email:
+                    partners[customer_id] = partners_by_email[email]
+        return partners
     
     def _get_customer_name(self, shopify_customer):
         """
@@ -195,9 +288,9 @@ class ResPartner(models.Model):
         if phone:
             phone = shopify_instance_id.clean_string(phone)
         # Buscar por mapping de Shopify
-        partner = self.search([('shopify_customer_id', '=', shopify_customer_id)], limit=1)
-        if partner:
-            return partner
+        partner_id = self.env['shopify.id.map']._lookup(shopify_instance_id, 'customer', [shopify_customer_id])
+        if partner_id:
+            return self.browse(list(partner_id.values()))
 
         # Validar email y vat antes de agregarlos al dominio de búsqueda
         if email and not self._is_valid_email(email):
@@ -270,35 +363,37 @@ class ResPartner(models.Model):
         Se filtra la lista de partners y se inyecta en el contexto (active_ids) para luego
         delegar la ejecución original mediante super().
         """
-        # Obtención de los partners a exportar según la lógica original
-        partner_ids = self.sudo().browse(self._context.get("active_ids"))
-        if not partner_ids:
-            if not update:
-                partner_ids = self.sudo().search([('is_shopify_customer', '=', False), ('is_exported', '=', False)])
+        Partner = self.sudo()
+        active_ids = self._context.get("active_ids")
+        result = True
+        chunk_size = export_chunk_size(self.env)
+        for instance in shopify_instance_ids:
+            # Partners a exportar según la lógica original, filtrados en la base de datos (solo ids)
+            if active_ids:
+                domain = [('id', 'in', active_ids)]
+            elif not update:
+                domain = [('is_shopify_customer', '=', False), ('is_exported', '=', False)]
             else:
-                partner_ids = self.sudo().search([])
+                domain = []
+            # En update solo los modificados desde la última exportación de la instancia
+            if update and instance.last_export_customer:
+                domain.append(('write_date', '>', instance.last_export_customer))
+            all_partner_ids = Partner.search(domain, order='id').ids
+            _logger.info("WSSH %d partners a exportar para la instancia %s", len(all_partner_ids), instance.name)
 
-        # Si se está en update y la instancia tiene definida la fecha de última exportación,
-        # se filtran los partners cuyo write_date sea mayor a esa fecha.
-        if update:
-            filtered_partner_ids = self.env['res.partner']
-            for instance in shopify_instance_ids:
-                if instance.last_export_customer:
-                    filtered_partner_ids |= partner_ids.filtered(lambda p: p.write_date > instance.last_export_customer)
-                else:
-                    filtered_partner_ids |= partner_ids
-            partner_ids = filtered_partner_ids
-            _logger.info("Filtered partners for update: %s", partner_ids.mapped('id'))
-
-            # Actualizamos el contexto para que el método original utilice estos partners filtrados
-            self = self.with_context(active_ids=partner_ids.ids)
+            # Llamamos al método original (del conector) por bloques de partners, pasándole cada bloque
+            # en active_ids, para que la caché del ORM no crezca con el número de clientes
+            with self.env['shopify.sync.run']._track(instance, 'export_customers') as run:
+                run.add(scanned=len(all_partner_ids))
+                for start in range(0, len(all_partner_ids), chunk_size):
+                    chunk_ids = all_partner_ids[start:start + chunk_size]
+                    chunk = self.browse(chunk_ids).with_context(active_ids=chunk_ids)
+                    for path in CUSTOMER_EXPORT_PREFETCH:
+                        chunk.mapped(path)
+                    result = super(ResPartner, chunk).export_customers_to_shopify(instance, update)
+                    self.env.invalidate_all()
 
-        # Llamamos al método original (del conector) para que realice la exportación de clientes
-        result = super(ResPartner, self).export_customers_to_shopify(shopify_instance_ids, update)
-
-        # Opcional: actualizar la fecha de exportación de clientes en cada instancia,
-        # por ejemplo, al finalizar la exportación.
-        for instance in shopify_instance_ids:
-            instance.last_export_customer = fields.Datetime.now()
+                # Al terminar: la propia exportación escribe en los partners (is_exported, IDs...)
+                instance.last_export_customer = fields.Datetime.now()
 
         return result
@@ -8,11 +8,131 @@ from odoo.exceptions import UserError
 
 import logging
 
+from .shopify_sync_run import current_collector
+
 _logger = logging.getLogger(__name__)
 
+
+class ShopifyOrderReferenceCache(object):
+    """
+    Caché por ejecución de los datos de referencia que usan las líneas de pedido de Shopify:
+    impuestos por (título, tasa), transportistas por título, variantes por shopify_variant_id,
+    clientes por id de Shopify y el producto genérico. Se carga una sola vez y, con prepare(),
+    cada página resuelve sus variantes y clientes en bloque y crea los registros que faltan.
+    """
+
+    def __init__(self, env, shopify_instance_id):
+        self.env = env
+        self.shopify_instance_id = shopify_instance_id
+        self.taxes = {}
+        self.taxes_by_name = {}
+        for tax in env['account.tax'].sudo().search_read([], ['name', 'amount']):
+            self.taxes.setdefault((tax['name'], round(tax['amount'], 4)), tax['id'])
+            self.taxes_by_name.setdefault(tax['name'], tax['id'])
+        self.carriers = {}
+        for carrier in env['delivery.carrier'].sudo().search_read([], ['name', 'product_id']):
+            if carrier['product_id']:
+                self.carriers.setdefault(carrier['name'], carrier['product_id'][0])
+        self.variants = {}
+        self.partners = {}
+        self._generic_product = None
+
+    @staticmethod
+    def tax_key(tax_line):
+        rate = tax_line.get('rate')
+        return tax_line.get('title'), round(float(rate) * 100, 4) if rate else 0.0
+
+    @staticmethod
+    def shipping_price(lineship):
+        """Precio del envío sin IVA: las líneas gratuitas no generan línea de pedido ni transportista."""
+        return round(float(lineship.get('price') or 0) / 1.21, 2)
+
+    def prepare(self, orders):
+        """Crea en bloque los impuestos y transportistas de la página que aún no existen."""
+        missing_taxes = []
+        missing_carriers = []
+        variant_ids = set()
+        for order in orders:
+            for line in order.get('line_items') or []:
+                if line.get('variant_id') and str(line['variant_id']) not in self.variants:
+                    variant_ids.add(str(line['variant_id']))
+                for tax_line in line.get('tax_lines') or []:
+                    key = self.tax_key(tax_line)
+                    if key[0] and key not in self.taxes and key not in missing_taxes:
+                        missing_taxes.append(key)
+            for lineship in order.get('shipping_lines') or []:
+                title = lineship.get('title')
+                if not title or self.shipping_price(lineship) <= 0:
+                    continue
+                if title not in self.carriers and title not in missing_carriers:
+                    missing_carriers.append(title)
+
+        customers = [order.get('customer') for order in orders
+                     if order.get('customer') and str(order['customer'].get('id')) not in self.partners]
+        if customers:
+            self.partners.update(self.env['res.partner'].sudo()._resolve_shopify_customers(
+                customers, self.shopify_instance_id))
+
+        if variant_ids:
+            self.variants.update(self.env['shopify.id.map']._lookup(self.shopify_instance_id, 'variant', variant_ids))
+
+        # Los impuestos existentes no se modifican (ya están en otros documentos): cada (título, tasa) que
+        # falta se crea aparte y, si el título ya lo usa otro impuesto, con la tasa en el nombre
+        new_taxes = []
+        for key in missing_taxes:
+            name, amount = key
+            if name in self.taxes_by_name:
+                name = "%s (%g%%)" % (name, amount)
+                if (name, amount) in self.taxes:
+                    self.taxes[key] = self.taxes[(name, amount)]
+                    continue
+            new_taxes.append((key, name, amount))
+            self.taxes_by_name.setdefault(name, False)
+        if new_taxes:
+            taxes = self.env['account.tax'].sudo().create([
+                {'name': name, 'amount': amount} for key, name, amount in new_taxes
+            ])
+            for (key, name, amount), tax in zip(new_taxes, taxes):
+                self.taxes[key] = self.taxes[(name, amount)] = tax.id
+                self.taxes_by_name[name] = tax.id
+
+        if missing_carriers:
+            delivery_products = self.env['product.product'].sudo().create([
+                {'name': title, 'detailed_type': 'product'} for title in missing_carriers
+            ])
+            self.env['delivery.carrier'].sudo().create([{
+                'is_shopify': True,
+                'shopify_instance_id': self.shopify_instance_id.id,
+                'name': title,
+                'product_id': product.id,
+            } for title, product in zip(missing_carriers, delivery_products)])
+            for title, product in zip(missing_carriers, delivery_products):
+                self.carriers[title] = product.id
+
+    def get_tax_id(self, tax_line):
+        return self.taxes.get(self.tax_key(tax_line))
+
+    def get_variant_product_id(self, variant_id):
+        return self.variants.get(str(variant_id)) if variant_id else False
+
+    def get_partner(self, customer):
+        return self.partners.get(str(customer.get('id')))
+
+    def get_shipping_product_id(self, title):
+        return self.carriers.get(title)
+
+    @property
+    def generic_product(self):
+        if self._generic_product is None:
+            self._generic_product = self.env.ref('ws_shopify_split_color.product_generic', raise_if_not_found=False)
+        return self._generic_product
+
 class SaleOrder(models.Model):
     _inherit = 'sale.order'
 
+    shopify_updated_at = fields.Datetime(string="Shopify Updated At", copy=False,
+                                         help="Valor de updated_at en Shopify la última vez que se importó el pedido.")
+
     def check_customer(self, customer):
         """
         Extiende el método check_customer para asegurar que siempre se tenga un nombre.
@@ -31,13 +151,24 @@ class SaleOrder(models.Model):
 
         # Llamamos al método original (heredado) que se encargará del resto
         partner= super(SaleOrder, self).check_customer(customer)
-        # Establecemos customer_rank en 1 en el partner obtenido
-        partner.write({'customer_rank': 1})
-        partner.write({'ref': 'SID' + str(customer.get('id'))})        
+        # Establecemos customer_rank en 1 y la referencia, escribiendo solo si cambian
+        vals = {}
+        if partner.customer_rank != 1:
+            vals['customer_rank'] = 1
+        if partner.ref != 'SID' + str(customer.get('id')):
+            vals['ref'] = 'SID' + str(customer.get('id'))
+        if vals:
+            partner.write(vals)
         return partner
         
     
-    def create_shopify_order_line(self, shopify_order_id, order, skip_existing_order, shopify_instance_id):
+    def get_order_url(self, shopify_instance_id, endpoint):
+        return shopify_instance_id._get_shopify_api_url(endpoint)
+
+    def create_shopify_order_line(self, shopify_order_id, order, skip_existing_order, shopify_instance_id, reference_cache=None):
+        if reference_cache is None:
+            reference_cache = ShopifyOrderReferenceCache(self.env, shopify_instance_id)
+            reference_cache.prepare([order])
         amount = 0.00
         discount = 0.00
         if order.get('applied_discount'):
@@ -48,110 +179,93 @@ class SaleOrder(models.Model):
         else:
             discount = amount
 
-        dict_tax = {}
-
         if shopify_order_id.order_line and skip_existing_order == False:
             shopify_order_id.order_line = [(5, 0, 0)]
-            
+
+        # Se construyen todas las líneas del pedido y se crean con una única llamada a create
+        line_vals_list = []
         for line in order.get('line_items'):
             tax_list = []
-            if line.get('tax_lines'):
-                for tax_line in line.get('tax_lines'):
-                    dict_tax['name'] = tax_line.get('title')
-                    if tax_line.get('rate'):
-                        dict_tax['amount'] = tax_line.get('rate') * 100
-                    tax = self.env['account.tax'].sudo().search([('name', '=', tax_line.get('title'))], limit=1)
-                    if tax:
-                        tax.sudo().write(dict_tax)
-                    else:
-                        tax = self.env['account.tax'].sudo().create(dict_tax)
-                    if tax_line.get('price') != '0.00':
-                        tax_list.append(tax.id)
-            product = self.env['product.product'].search([('shopify_variant_id', '=', line.get('variant_id'))],
-                                                         limit=1)
-            if not product:
-                generic_product = self.env.ref('ws_shopify_split_color.product_generic', raise_if_not_found=False)
+            for tax_line in line.get('tax_lines') or []:
+                tax_id = reference_cache.get_tax_id(tax_line)
+                if tax_id and tax_line.get('price') != '0.00':
+                    tax_list.append(tax_id)
+            product_id = reference_cache.get_variant_product_id(line.get('variant_id'))
+            if not product_id:
+                generic_product = reference_cache.generic_product
                 if not generic_product:
                     raise UserError(_(f"No se ha definido el producto {line.get('title')} {line.get('product_id')} variante {line.get('variant_id')}."))
-                product = generic_product
+                product_id = generic_product.id
                 product_name = "{} - {}".format(generic_product.name, line.get('title'))
             else:
                 product_name = line.get('title')
-                
-            if product:
-                # Precio recibido de Shopify (incluye IVA)
-                price_incl = float(line.get('price'))-float(line.get('total_discount'))
-
-                # Calcular la tasa total de IVA a partir de tax_lines, o definir una tasa fija
-                tax_rate_total = 0.0
-                for tax_line in line.get('tax_lines', []):
-                    if tax_line.get('rate'):
-                        tax_rate_total += float(tax_line.get('rate'))
-                # En caso de que no exista información de impuestos, se puede asumir 0%
-                if tax_rate_total:
-                    price_excl = round(price_incl / (1 + tax_rate_total),2)
-                else:
-                    price_excl = price_incl
-
-                subtotal = price_excl * line.get('quantity')
-
-                shopify_order_line_vals = {
-                    'order_id': shopify_order_id.id,
-                    'product_id': product.id,
-                    'name': product_name,
-                    'product_uom_qty': line.get('quantity'),
-                    'price_unit': price_excl,
-                    'discount': (discount / subtotal) * 100 if discount else 0.00,
-                    'tax_id': [(6, 0, tax_list)]
-                }
-                shopify_order_line_id = self.env['sale.order.line'].sudo().create(shopify_order_line_vals)
-        
+
+            # Precio recibido de Shopify (incluye IVA)
+            price_incl = float(line.get('price'))-float(line.get('total_discount'))
+
+            # Calcular la tasa total de IVA a partir de tax_lines, o definir una tasa fija
+            tax_rate_total = 0.0
+            for tax_line in line.get('tax_lines', []):
+                if tax_line.get('rate'):
+                    tax_rate_total += float(tax_line.get('rate'))
+            # En caso de que no exista información de impuestos, se puede asumir 0%
+            if tax_rate_total:
+                price_excl = round(price_incl / (1 + tax_rate_total),2)
+            else:
+                price_excl = price_incl
+
+            subtotal = price_excl * line.get('quantity')
+
+            line_vals_list.append({
+                'order_id': shopify_order_id.id,
+                'product_id': product_id,
+                'name': product_name,
+                'product_uom_qty': line.get('quantity'),
+                'price_unit': price_excl,
+                'discount': (discount / subtotal) * 100 if discount else 0.00,
+                'tax_id': [(6, 0, tax_list)]
+            })
+
         for lineship in order.get('shipping_lines'):
-            price=round(float(lineship.get('price'))/1.21,2)
-            if price>0:
-                shipping = self.env['delivery.carrier'].sudo().search(
-                    [('name', '=', lineship.get('title'))], limit=1)
-                if not shipping:
-                    delivery_product = self.env['product.product'].sudo().create({
-                        'name': lineship.get('title'),
-                        'detailed_type': 'product',
-                    })
-                    vals = {
-                        'is_shopify': True,
-                        'shopify_instance_id': shopify_instance_id.id,
-                        'name': lineship.get('title'),
-                        'product_id': delivery_product.id,
-                    }
-                    shipping = self.env['delivery.carrier'].sudo().create(vals)
-                if shipping and shipping.product_id:
-                    shipping_vals = {
-                        'product_id': shipping.product_id.id,
+            if reference_cache.shipping_price(lineship) > 0:
+                shipping_product_id = reference_cache.get_shipping_product_id(lineship.get('title'))
+                if shipping_product_id:
+                    line_vals_list.append({
+                        'product_id': shipping_product_id,
                         'name': "Shipping",
                         'price_unit': float(lineship.get('price')),
                         'order_id': shopify_order_id.id,
                         'tax_id': [(6, 0, [])]
-                    }
-                    shipping_so_line = self.env['sale.order.line'].sudo().create(shipping_vals)
+                    })
+
+        if line_vals_list:
+            self.env['sale.order.line'].sudo().create(line_vals_list)
 
         return True
 
-    def prepare_shopify_order_vals(self, shopify_instance_id, order, skip_existing_order):
+    def prepare_shopify_order_vals(self, shopify_instance_id, order, skip_existing_order, reference_cache=None, existing_order=None):
         # call a method to check the customer is available or not
         # if not available create a customer
         # if available get the customer id
         # create a sale order
         # create a sale order line
         if order.get('customer'):
-            res_partner = self.check_customer(order.get('customer'))
+            res_partner = reference_cache and reference_cache.get_partner(order.get('customer'))
+            if not res_partner:
+                res_partner = self.check_customer(order.get('customer'))
+                res_partner.shopify_instance_id = shopify_instance_id.id
             if res_partner:
                 dt = parser.isoparse(order.get('created_at'))
                 # Convertir a UTC si es necesario:
                 dt_utc = dt.astimezone(timezone.utc)
                 date_order_value = fields.Datetime.to_string(dt_utc)
-                
-                res_partner.shopify_instance_id = shopify_instance_id.id
-                shopify_order_id = self.env['sale.order'].sudo().search(
-                    [('shopify_order_id', '=', order.get('id'))], limit=1)
+
+                # create_shopify_order ya nos pasa el pedido existente precargado para toda la página
+                if existing_order is None:
+                    shopify_order_id = self.env['sale.order'].sudo().search(
+                        [('shopify_order_id', '=', order.get('id'))], limit=1)
+                else:
+                    shopify_order_id = existing_order
                 shopify_order_vals = {
                     'partner_id': res_partner.id,
                     'name': order.get('name'),
@@ -164,6 +278,7 @@ class SaleOrder(models.Model):
                     'shopify_order_total': order.get('total_price'),
                     'is_shopify_order': True,
                     'order_shopify_id': order.get('order_id'),
+                    'shopify_updated_at': shopify_instance_id._shopify_parse_datetime(order.get('updated_at')),
                 }
                 if not shopify_order_id:
                     shopify_order_id = self.sudo().create(shopify_order_vals)
@@ -175,121 +290,120 @@ class SaleOrder(models.Model):
                 else:
                     if shopify_order_id and shopify_order_id.state == 'draft' and skip_existing_order == False:
                         shopify_order_id.sudo().write(shopify_order_vals)
-                self.create_shopify_order_line(shopify_order_id, order, skip_existing_order, shopify_instance_id)
+                self.create_shopify_order_line(shopify_order_id, order, skip_existing_order, shopify_instance_id,
+                                               reference_cache=reference_cache)
 
                 return shopify_order_id
         
     def import_shopify_orders(self, shopify_instance_ids, skip_existing_order, from_date, to_date):
         if shopify_instance_ids == False:
             shopify_instance_ids = self.env['shopify.instance'].sudo().search([('shopify_active', '=', True)])
+        order_list = []
         for shopify_instance_id in shopify_instance_ids:
-            self.import_shopify_draft_orders(shopify_instance_id, skip_existing_order, from_date, to_date)
-            # import shopify oders from shopify to odoo
-            # call method to connect to shopify
-
-            all_orders = []
-            url = self.get_order_url(shopify_instance_id, endpoint='orders.json')
-            access_token = shopify_instance_id.shopify_shared_secret
-            headers = {
-                "X-Shopify-Access-Token": access_token
-            }
-            
-            effective_from_date = from_date or shopify_instance_id.shopify_last_date_order_import          
-                
-            # Configurar parámetros para la consulta a Shopify
-            params = {
-                "limit": 250,  # Ajusta el tamaño de página según sea necesario
-                "page_info": None,
-                "status": "any"
-            }
-            if effective_from_date:
-                params["created_at_min"] = effective_from_date
-            if to_date:
-                params["created_at_max"] = to_date  
-                
-            while True:
-                response = requests.get(url, headers=headers, params=params)
-                if response.status_code == 200 and response.content:
-                    data = response.json()
-                    orders = data.get('orders', [])
-                    all_orders.extend(orders)
-
-                    page_info = data.get('page_info', {})
-                    if 'has_next_page' in page_info and page_info['has_next_page']:
-                        params['page_info'] = page_info['next_page']
-                    else:
-                        break
-                else:
-                    _logger.info("Error:", response.status_code)
-                    break
-            if all_orders:
-                orders = self.create_shopify_order(all_orders, shopify_instance_id, skip_existing_order, status='open')
-                return orders
-            else:
-                _logger.info("No orders found in shopify")
-                return []        
+            with self.env['shopify.sync.run']._track(shopify_instance_id, 'import_orders'):
+                # Fijamos el inicio antes de los borradores para que ambos flujos partan de la misma marca
+                effective_from_date = from_date or shopify_instance_id.shopify_last_date_order_import
+                self.import_shopify_draft_orders(shopify_instance_id, skip_existing_order, effective_from_date, to_date)
+                order_list += self._import_shopify_order_stream(
+                    shopify_instance_id, 'orders', skip_existing_order, effective_from_date, to_date,
+                    status='open', update_watermark=True)
+        if not order_list:
+            _logger.info("WSSH No orders found in shopify")
+        return order_list
 
     def import_shopify_draft_orders(self, shopify_instance_ids, skip_existing_order, from_date, to_date):
         if shopify_instance_ids == False:
             shopify_instance_ids = self.env['shopify.instance'].sudo().search([('shopify_active', '=', True)])
+        order_list = []
         for shopify_instance_id in shopify_instance_ids:
-            url = self.get_order_url(shopify_instance_id, endpoint='draft_orders.json')
-            access_token = shopify_instance_id.shopify_shared_secret
-            headers = {
-                "X-Shopify-Access-Token": access_token
-            }
-            effective_from_date = from_date or shopify_instance_id.shopify_last_date_order_import          
-                
-            # Configurar parámetros para la consulta a Shopify
-            params = {
-                "limit": 250,  # Ajusta el tamaño de página según sea necesario
-                "page_info": None,
-                "status": "any"
-            }
-            if effective_from_date:
-                params["created_at_min"] = effective_from_date
-            if to_date:
-                params["created_at_max"] = to_date  
-            all_orders = []
-
-            while True:
-                response = requests.get(url, headers=headers, params=params)
-                if response.status_code == 200 and response.content:
-                    draft_orders = response.json()
-                    orders = draft_orders.get('draft_orders', [])
-                    all_orders.extend(orders)
-                    page_info = draft_orders.get('page_info', {})
-                    if 'has_next_page' in page_info and page_info['has_next_page']:
-                        params['page_info'] = page_info['next_page']
-                    else:
-                        break
-                else:
-                    _logger.info("Error:", response.status_code)
-                    break
-            if all_orders:
-                orders = self.create_shopify_order(all_orders, shopify_instance_id, skip_existing_order, status='draft')
-                return orders
-            else:
-                _logger.info("No draft orders found in Shopify.")
-                return []
-                
-    def create_shopify_order(self, orders, shopify_instance_id, skip_existing_order, status):
+            effective_from_date = from_date or shopify_instance_id.shopify_last_date_order_import
+            order_list += self._import_shopify_order_stream(
+                shopify_instance_id, 'draft_orders', skip_existing_order, effective_from_date, to_date,
+                status='draft')
+        if not order_list:
+            _logger.info("WSSH No draft orders found in Shopify.")
+        return order_list
+
+    def _import_shopify_order_stream(self, shopify_instance_id, resource, skip_existing_order, from_date, to_date, status, update_watermark=False):
+        """
+        Importa pedidos (o borradores) página a página siguiendo la cabecera Link de Shopify.
+        Cada página se procesa y se confirma (commit) por separado; si update_watermark está activo,
+        shopify_last_date_order_import avanza hasta el updated_at del último pedido confirmado,
+        de modo que una ejecución interrumpida continúa donde se quedó.
+        """
+        url = self.get_order_url(shopify_instance_id, endpoint=f'{resource}.json')
+        params = {
+            "limit": 250,
+            "status": "any",
+            "order": "updated_at asc",
+        }
+        if from_date:
+            params["updated_at_min"] = shopify_instance_id._shopify_datetime_param(from_date)
+        if to_date:
+            params["updated_at_max"] = shopify_instance_id._shopify_datetime_param(to_date)
+
+        order_list = []
+        # Impuestos, transportistas y producto genérico se cargan una vez para toda la ejecución
+        reference_cache = ShopifyOrderReferenceCache(self.env, shopify_instance_id)
+        for orders in shopify_instance_id._iter_shopify_pages(url, params, resource):
+            if not orders:
+                continue
+            order_list += self.create_shopify_order(orders, shopify_instance_id, skip_existing_order, status=status,
+                                                    reference_cache=reference_cache)
+            if update_watermark:
+                last_updated = shopify_instance_id._shopify_parse_datetime(orders[-1].get('updated_at'))
+                watermark = shopify_instance_id.shopify_last_date_order_import
+                # Nunca retrocedemos la marca (p.ej. en una reimportación manual de un rango antiguo)
+                if last_updated and (not watermark or last_updated > watermark):
+                    shopify_instance_id.shopify_last_date_order_import = last_updated
+            self.env.cr.commit()
+            _logger.info("WSSH Página de %s confirmada: %d pedidos (total %d)", resource, len(orders), len(order_list))
+        return order_list
+
+    def create_shopify_order(self, orders, shopify_instance_id, skip_existing_order, status, reference_cache=None):
         order_list = []
+        # Una sola consulta para todos los pedidos ya importados de la página
+        order_ids = self.env['shopify.id.map']._lookup(shopify_instance_id, 'order', [order.get('id') for order in orders])
+        # Un único recordset para que los pedidos de la página se lean juntos (prefetch)
+        shopify_ids = {order_id: shopify_id for shopify_id, order_id in order_ids.items()}
+        existing_orders = {
+            shopify_ids[sale_order.id]: sale_order
+            for sale_order in self.env['sale.order'].sudo().browse(list(shopify_ids))
+        }
+        pending_orders = []
         for order in orders:
+            existing_order = existing_orders.get(str(order.get('id')))
+            updated_at = shopify_instance_id._shopify_parse_datetime(order.get('updated_at'))
+            if existing_order and existing_order.shopify_updated_at and updated_at \
+                    and updated_at <= existing_order.shopify_updated_at:
+                # Sin cambios en Shopify desde la última importación: no se reescribe nada
+                order_list.append(existing_order.id)
+                continue
+            pending_orders.append((order, existing_order))
+        _logger.info("WSSH %d pedidos sin cambios omitidos de %d", len(orders) - len(pending_orders), len(orders))
+        collector = current_collector()
+        if collector is not None:
+            collector.add(scanned=len(orders), sent=len(pending_orders), skipped=len(orders) - len(pending_orders))
+        if not pending_orders:
+            return order_list
+
+        if reference_cache is None:
+            reference_cache = ShopifyOrderReferenceCache(self.env, shopify_instance_id)
+        reference_cache.prepare([order for order, existing_order in pending_orders])
+        for order, existing_order in pending_orders:
             _logger.info(f"WSSH iterando orden {order.get('name')}")
-            if status == 'open':
-                shopify_order_id = self.env['sale.order'].sudo().search([('shopify_order_id', '=', order.get('id'))],limit=1)
-                if not shopify_order_id:
-                    _logger.info(f"WSSH no existe {order.get('name')}")
-                    shopify_order_id = self.prepare_shopify_order_vals(shopify_instance_id, order, skip_existing_order)
-                else:
-                    _logger.info(f"WSSH Encontrada orden {order.get('name')}")
+            if status == 'open' and existing_order:
+                _logger.info(f"WSSH Encontrada orden {order.get('name')}")
+                shopify_order_id = existing_order
+                shopify_order_id.shopify_updated_at = shopify_instance_id._shopify_parse_datetime(order.get('updated_at'))
             else:
-                shopify_order_id = self.prepare_shopify_order_vals(shopify_instance_id, order, skip_existing_order)
+                if status == 'open':
+                    _logger.info(f"WSSH no existe {order.get('name')}")
+                shopify_order_id = self.prepare_shopify_order_vals(shopify_instance_id, order, skip_existing_order,
+                                                                   reference_cache=reference_cache,
+                                                                   existing_order=existing_order or self.browse())
             if shopify_order_id:
                 order_list.append(shopify_order_id.id)
                 shopify_order_id.name = order.get('name')
-                if status == 'open':
-                    shopify_order_id.name = order.get('name')
 
-        return order_list                
\ No newline at end of file
+        return order_list
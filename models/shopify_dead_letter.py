@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+import json
+from datetime import timedelta
+
+from odoo import api, fields, models, _
+
+import logging
+
+_logger = logging.getLogger(__name__)
+
+# operación -> modelo del registro afectado
+DEAD_LETTER_MODELS = {
+    'export_product': 'product.template',
+    'export_color': 'product.template.attribute.value',
+    'update_variant': 'product.product',
+    'map_variants': 'product.template',
+}
+
+
+class ShopifyDeadLetter(models.Model):
+    _name = 'shopify.dead.letter'
+    _description = 'Shopify Dead Letter'
+    _order = 'id desc'
+
+    shopify_instance_id = fields.Many2one('shopify.instance', string="Shopify Instance", required=True,
+                                          ondelete='cascade', index=True)
+    operation = fields.Selection([
+        ('export_product', 'Export Product'),
+        ('export_color', 'Export Color Product'),
+        ('update_variant', 'Update Variant'),
+        ('map_variants', 'Map Created Variants'),
+    ], string="Operation", required=True)
+    res_model = fields.Char(string="Model", required=True)
+    res_id = fields.Integer(string="Record ID", required=True)
+    reference = fields.Char(string="Reference")
+    payload = fields.Text(string="Payload")
+    response = fields.Text(string="Response")
+    retry_count = fields.Integer(string="Retries", default=0)
+    date_next_retry = fields.Datetime(string="Next Retry", default=fields.Datetime.now)
+    state = fields.Selection([
+        ('pending', 'Pending'),
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+    ], string="State", default='pending', required=True, index=True)
+
+    MAX_RETRIES = 5
+
+    def init(self):
+        self.env.cr.execute("""
+            CREATE INDEX IF NOT EXISTS shopify_dead_letter_record_idx
+            ON shopify_dead_letter (shopify_instance_id, operation, res_id)
+            WHERE state = 'pending'
+        """)
+
+    @api.model
+    def _run_guarded(self, instance, operation, record, func, payload=None):
+        """
+        Ejecuta func dentro de un savepoint. Si falla, solo se deshacen los cambios de este registro,
+        el error queda en la cola de errores con el payload y la respuesta, y la ejecución sigue.
+
+        :return: (ok, resultado de func)
+        """
+        try:
+            with self.env.cr.savepoint():
+                result = func()
+        except Exception as e:
+            _logger.warning("WSSH %s de %s,%s enviado a la cola de errores: %s", operation, record._name, record.id, e)
+            self._push(instance, operation, record, payload, str(e))
+            return False, None
+        self._resolve(instance, operation, record)
+        return True, result
+
+    def _pending_letter(self, instance, operation, record):
+        return self.search([('shopify_instance_id', '=', instance.id), ('operation', '=', operation),
+                            ('res_id', '=', record.id), ('state', '=', 'pending')], limit=1)
+
+    @api.model
+    def _push(self, instance, operation, record, payload, response):
+        vals = {
+            'payload': json.dumps(payload) if payload is not None else False,
+            'response': response,
+        }
+        letter = self._pending_letter(instance, operation, record)
+        if letter:
+            letter.write(vals)
+        else:
+            vals.update({
+                'shopify_instance_id': instance.id,
+                'operation': operation,
+                'res_model': record._name,
+                'res_id': record.id,
+                'reference': record.display_name,
+            })
+            letter = self.create(vals)
+        return letter
+
+    @api.model
+    def _resolve(self, instance, operation, record):
+        """Un envío correcto del mismo registro deja resuelto el error pendiente (si lo había)."""
+        letter = self._pending_letter(instance, operation, record)
+        if letter:
+            letter.write({'state': 'done'})
+
+    @api.model
+    def _cron_retry_dead_letters(self, batch_size=50):
+        """Reintenta por lotes los errores pendientes cuyo plazo ha vencido, con espera exponencial."""
+        letters = self.search([('state', '=', 'pending'), ('date_next_retry', '<=', fields.Datetime.now())],
+                              order='date_next_retry, id', limit=batch_size)
+        for letter in letters:
+            letter._retry()
+            self.env.cr.commit()
+        return len(letters)
+
+    def action_retry(self):
+        for letter in self.filtered(lambda l: l.state != 'done'):
+            letter.state = 'pending'
+            letter._retry()
+        return True
+
+    def _retry(self):
+        """
+        Reconstruye el envío con los datos actuales del registro (el payload guardado es solo informativo),
+        salvo en map_variants, que vuelve a aplicar las variantes de la respuesta de Shopify guardadas.
+        """
+        self.ensure_one()
+        record = self.env[self.res_model].browse(self.res_id).exists()
+        if not record:
+            self.write({'state': 'done', 'response': _("El registro ya no existe")})
+            return
+        instance = self.shopify_instance_id
+        headers = {
+            "X-Shopify-Access-Token": instance.shopify_shared_secret,
+            "Content-Type": "application/json"
+        }
+        Template = self.env['product.template']
+        export_date = fields.Datetime.now()
+        try:
+            with self.env.cr.savepoint():
+                if self.operation == 'export_product':
+                    Template._export_single_product(record, instance, headers, True)
+                    record._clear_shopify_dirty(instance, export_date)
+                elif self.operation == 'export_color':
+                    product = record.product_tmpl_id
+                    for template_attribute_value, variants, variant_data, product_data in Template._plan_shopify_color_units(
+                            product, Template._get_shopify_color_line(product).filtered(
+                                lambda l: record in l.product_template_value_ids), instance, True):
+                        if template_attribute_value == record:
+                            Template._export_shopify_color_unit(product, record, variants, variant_data, product_data,
+                                                                instance, headers, True)
+                    record._clear_shopify_dirty(instance, export_date)
+                elif self.operation == 'update_variant':
+                    Template._update_shopify_variant(record, instance, headers)
+                elif self.operation == 'map_variants':
+                    Template._map_created_shopify_variants(record, record.product_variant_ids,
+                                                           json.loads(self.payload or '[]'), instance)
+        except Exception as e:
+            retry_count = self.retry_count + 1
+            self.write({
+                'retry_count': retry_count,
+                'response': str(e),
+                'state': 'failed' if retry_count >= self.MAX_RETRIES else 'pending',
+                # Espera exponencial entre reintentos: 2, 4, 8, 16... minutos
+                'date_next_retry': fields.Datetime.now() + timedelta(minutes=2 ** retry_count),
+            })
+        else:
+            self.write({'state': 'done', 'retry_count': self.retry_count + 1})
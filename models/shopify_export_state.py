@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+from odoo import api, fields, models, _
+
+import logging
+
+_logger = logging.getLogger(__name__)
+
+
+class ShopifyExportState(models.Model):
+    """
+    Último envío de un registro a una instancia. Las marcas de cambios (shopify_dirty_date) y los precios
+    son globales, pero cada tienda recibe los cambios por separado: lo exportado se guarda por instancia.
+    """
+    _name = 'shopify.export.state'
+    _description = 'Shopify Export State'
+
+    shopify_instance_id = fields.Many2one('shopify.instance', string="Shopify Instance", required=True,
+                                          ondelete='cascade')
+    kind = fields.Selection([
+        ('product', 'Product Payload'),
+        ('price', 'Price'),
+    ], string="Kind", required=True)
+    res_model = fields.Char(string="Model", required=True)
+    res_id = fields.Integer(string="Record ID", required=True)
+    date_exported = fields.Datetime(string="Exported On")
+    value = fields.Float(string="Pushed Value", digits='Product Price',
+                         help="Último valor enviado (en los precios, el precio de la variante).")
+
+    _sql_constraints = [
+        ('instance_kind_record_uniq', 'unique(shopify_instance_id, kind, res_model, res_id)',
+         'El registro ya tiene estado de exportación para esta instancia.'),
+    ]
+
+    @api.model
+    def _get(self, instance, kind, records):
+        """:return: dict {res_id: (date_exported, value)} de los registros con estado en la instancia"""
+        if not records:
+            return {}
+        self.env.cr.execute("""
+            SELECT res_id, date_exported, value FROM shopify_export_state
+             WHERE shopify_instance_id = %s AND kind = %s AND res_model = %s AND res_id IN %s
+        """, (instance.id, kind, records._name, tuple(records.ids)))
+        return {res_id: (date_exported, value) for res_id, date_exported, value in self.env.cr.fetchall()}
+
+    @api.model
+    def _set(self, instance, kind, records, date=None, values=None):
+        """Inserta o actualiza el estado de los registros. values: dict {res_id: valor} opcional."""
+        if not records:
+            return
+        date = date or fields.Datetime.now()
+        values = values or {}
+        rows = [(instance.id, kind, records._name, res_id, date, values.get(res_id, 0.0), self.env.uid, self.env.uid)
+                for res_id in set(records.ids)]
+        self.env.cr.execute("""
+            INSERT INTO shopify_export_state
+                (shopify_instance_id, kind, res_model, res_id, date_exported, value,
+                 create_uid, write_uid, create_date, write_date)
+            SELECT v.instance_id, v.kind, v.res_model, v.res_id, v.date_exported, v.value, v.create_uid, v.write_uid,
+                   now() at time zone 'UTC', now() at time zone 'UTC'
+              FROM (VALUES %s) AS v(instance_id, kind, res_model, res_id, date_exported, value, create_uid, write_uid)
+            ON CONFLICT (shopify_instance_id, kind, res_model, res_id)
+            DO UPDATE SET date_exported = EXCLUDED.date_exported, value = EXCLUDED.value, write_date = EXCLUDED.write_date
+        """ % ', '.join(['%s'] * len(rows)), rows)
+
+    @api.model
+    def _forget(self, instance, kind, records):
+        """
+        Deja el estado sin fecha: en la instancia los registros vuelven a estar pendientes de exportar,
+        aunque no tengan cambios propios (p.ej. productos importados de Shopify).
+        """
+        if not records:
+            return
+        self._set(instance, kind, records)
+        self.env.cr.execute("""
+            UPDATE shopify_export_state SET date_exported = NULL
+             WHERE shopify_instance_id = %s AND kind = %s AND res_model = %s AND res_id IN %s
+        """, (instance.id, kind, records._name, tuple(records.ids)))
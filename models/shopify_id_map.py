@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+from odoo import api, fields, models, _
+
+import logging
+
+_logger = logging.getLogger(__name__)
+
+# resource_type -> (modelo, campo Char donde se guarda el ID de Shopify)
+RESOURCE_FIELDS = {
+    'product': ('product.template', 'shopify_product_id'),
+    'color_product': ('product.template.attribute.value', 'shopify_product_id'),
+    'variant': ('product.product', 'shopify_variant_id'),
+    'inventory_item': ('product.product', 'shopify_inventory_item_id'),
+    'customer': ('res.partner', 'shopify_customer_id'),
+    'order': ('sale.order', 'shopify_order_id'),
+}
+
+
+class ShopifyIdField(fields.Integer):
+    """Entero de 64 bits: los IDs de Shopify no caben en un integer de PostgreSQL."""
+    column_type = ('int8', 'int8')
+
+
+class ShopifyIdMap(models.Model):
+    _name = 'shopify.id.map'
+    _description = 'Shopify ID Mapping'
+
+    shopify_instance_id = fields.Many2one('shopify.instance', string="Shopify Instance", required=True,
+                                          ondelete='cascade')
+    resource_type = fields.Selection([
+        ('product', 'Product'),
+        ('color_product', 'Color Product'),
+        ('variant', 'Variant'),
+        ('inventory_item', 'Inventory Item'),
+        ('customer', 'Customer'),
+        ('order', 'Order'),
+    ], string="Resource Type", required=True)
+    shopify_id = ShopifyIdField(string="Shopify ID", required=True)
+    res_id = fields.Integer(string="Record ID", required=True, index=True)
+
+    _sql_constraints = [
+        ('instance_type_shopify_id_uniq', 'unique(shopify_instance_id, resource_type, shopify_id)',
+         'El ID de Shopify ya está asociado a otro registro.'),
+    ]
+
+    @api.model
+    def _lookup(self, instance, resource_type, shopify_ids):
+        """
+        Traduce IDs de Shopify a ids de Odoo con una consulta sobre el índice único. Los que no están
+        en la tabla (p.ej. antes del backfill) se buscan en el campo original y se registran.
+
+        :return: dict {shopify_id (str): res_id}
+        """
+        wanted = {str(shopify_id) for shopify_id in shopify_ids if shopify_id and str(shopify_id).isdigit()}
+        if not wanted:
+            return {}
+        model_name, field_name = RESOURCE_FIELDS[resource_type]
+        Model = self.env[model_name].sudo()
+        self.env.cr.execute("""
+            SELECT shopify_id, res_id FROM shopify_id_map
+             WHERE shopify_instance_id = %s AND resource_type = %s AND shopify_id IN %s
+        """, (instance.id, resource_type, tuple(int(shopify_id) for shopify_id in wanted)))
+        found = {str(shopify_id): res_id for shopify_id, res_id in self.env.cr.fetchall()}
+        # Descarta los mappings de registros eliminados
+        existing = set(Model.browse(set(found.values())).exists().ids)
+        found = {shopify_id: res_id for shopify_id, res_id in found.items() if res_id in existing}
+        missing = wanted - set(found)
+        if missing:
+            records = Model.search([(field_name, 'in', list(missing))])
+            self._register(instance, resource_type, [(record[field_name], record.id) for record in records])
+            for record in records:
+                found.setdefault(str(record[field_name]), record.id)
+        return found
+
+    @api.model
+    def _register(self, instance, resource_type, pairs):
+        """Inserta o actualiza los mappings (shopify_id, res_id) de la instancia."""
+        pairs = [(int(shopify_id), res_id) for shopify_id, res_id in pairs
+                 if shopify_id and str(shopify_id).isdigit()]
+        if not pairs:
+            return
+        # Un registro solo tiene un ID de Shopify por instancia: se quitan los anteriores
+        self.env.cr.execute("""
+            DELETE FROM shopify_id_map
+             WHERE shopify_instance_id = %s AND resource_type = %s AND res_id IN %s AND shopify_id NOT IN %s
+        """, (instance.id, resource_type, tuple(res_id for shopify_id, res_id in pairs),
+              tuple(shopify_id for shopify_id, res_id in pairs)))
+        values = [(instance.id, resource_type, shopify_id, res_id, self.env.uid, self.env.uid)
+                  for shopify_id, res_id in dict(pairs).items()]
+        self.env.cr.execute("""
+            INSERT INTO shopify_id_map
+                (shopify_instance_id, resource_type, shopify_id, res_id, create_uid, write_uid, create_date, write_date)
+            SELECT v.instance_id, v.resource_type, v.shopify_id, v.res_id, v.create_uid, v.write_uid,
+                   now() at time zone 'UTC', now() at time zone 'UTC'
+              FROM (VALUES %s) AS v(instance_id, resource_type, shopify_id, res_id, create_uid, write_uid)
+            ON CONFLICT (shopify_instance_id, resource_type, shopify_id)
+            DO UPDATE SET res_id = EXCLUDED.res_id, write_date = EXCLUDED.write_date
+        """ % ', '.join(['%s'] * len(values)), values)
+
+    @api.model
+    def _register_records(self, records, fnames):
+        """Mantiene la tabla cuando se crean o escriben los campos de ID de Shopify de los registros."""
+        for resource_type, (model_name, field_name) in RESOURCE_FIELDS.items():
+            if model_name != records._name or field_name not in fnames:
+                continue
+            by_instance = {}
+            cleared = [record.id for record in records if not record[field_name]]
+            default_instance = self._default_instance()
+            for record in records:
+                instance = self._record_instance(record) or default_instance
+                if instance and record[field_name]:
+                    by_instance.setdefault(instance, []).append((record[field_name], record.id))
+            for instance, pairs in by_instance.items():
+                self._register(instance, resource_type, pairs)
+            if cleared:
+                # Se ha borrado el ID de Shopify del registro: su mapping deja de ser válido
+                self.env.cr.execute("DELETE FROM shopify_id_map WHERE resource_type = %s AND res_id IN %s",
+                                    (resource_type, tuple(cleared)))
+
+    @api.model
+    def _record_instance(self, record):
+        """Instancia a la que pertenece el registro: contexto, la del propio registro o la de su template."""
+        if self.env.context.get('shopify_instance_id'):
+            return self.env['shopify.instance'].sudo().browse(self.env.context['shopify_instance_id'])
+        for path in ('shopify_instance_id', 'product_tmpl_id.shopify_instance_id'):
+            if path.split('.')[0] in record._fields:
+                instance = record.mapped(path)
+                if instance:
+                    return instance[:1]
+        return None
+
+    @api.model
+    def _default_instance(self):
+        """Configuración de una sola tienda (la habitual): la única instancia activa."""
+        instances = self.env['shopify.instance'].sudo().search([('shopify_active', '=', True)], limit=2)
+        return instances if len(instances) == 1 else None
+
+    @api.model
+    def _backfill(self, instance):
+        """
+        Rellena la tabla a partir de los campos existentes con un INSERT ... SELECT por tipo de recurso.
+        Es idempotente: los mappings que ya existen no se tocan.
+        """
+        for resource_type, (model_name, field_name) in RESOURCE_FIELDS.items():
+            Model = self.env[model_name]
+            Model.flush_model([field_name])
+            join = ''
+            instance_filter = ''
+            if 'shopify_instance_id' in Model._fields and Model._fields['shopify_instance_id'].store:
+                instance_filter = 'AND (r.shopify_instance_id IS NULL OR r.shopify_instance_id = %(instance)s)'
+            elif 'product_tmpl_id' in Model._fields:
+                join = 'JOIN product_template t ON t.id = r.product_tmpl_id'
+                instance_filter = 'AND (t.shopify_instance_id IS NULL OR t.shopify_instance_id = %(instance)s)'
+            self.env.cr.execute(f"""
+                INSERT INTO shopify_id_map
+                    (shopify_instance_id, resource_type, shopify_id, res_id, create_uid, write_uid, create_date, write_date)
+                SELECT %(instance)s, %(resource_type)s, r.{field_name}::bigint, r.id, %(uid)s, %(uid)s,
+                       now() at time zone 'UTC', now() at time zone 'UTC'
+                  FROM {Model._table} r {join}
+                 WHERE r.{field_name} ~ '^[0-9]{{1,18}}$' {instance_filter}
+                ON CONFLICT (shopify_instance_id, resource_type, shopify_id) DO NOTHING
+            """, {'instance': instance.id, 'resource_type': resource_type, 'uid': self.env.uid})
+            _logger.info("WSSH Mapping %s: %d IDs añadidos para %s", resource_type, self.env.cr.rowcount, instance.name)
+        return True
+
+    @api.model
+    def _cron_backfill(self):
+        for instance in self.env['shopify.instance'].search([('shopify_active', '=', True)]):
+            self._backfill(instance)
+            self.env.cr.commit()
+
+
+class ProductTemplateIdMap(models.Model):
+    _inherit = 'product.template'
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        records = super().create(vals_list)
+        self.env['shopify.id.map']._register_records(records, {f for vals in vals_list for f in vals})
+        return records
+
+    def write(self, vals):
+        res = super().write(vals)
+        self.env['shopify.id.map']._register_records(self, vals)
+        return res
+
+
+class ProductTemplateAttributeValueIdMap(models.Model):
+    _inherit = 'product.template.attribute.value'
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        records = super().create(vals_list)
+        self.env['shopify.id.map']._register_records(records, {f for vals in vals_list for f in vals})
+        return records
+
+    def write(self, vals):
+        res = super().write(vals)
+        self.env['shopify.id.map']._register_records(self, vals)
+        return res
+
+
+class ProductProductIdMap(models.Model):
+    _inherit = 'product.product'
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        records = super().create(vals_list)
+        self.env['shopify.id.map']._register_records(records, {f for vals in vals_list for f in vals})
+        return records
+
+    def write(self, vals):
+        res = super().write(vals)
+        self.env['shopify.id.map']._register_records(self, vals)
+        return res
+
+
+class ResPartnerIdMap(models.Model):
+    _inherit = 'res.partner'
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        records = super().create(vals_list)
+        self.env['shopify.id.map']._register_records(records, {f for vals in vals_list for f in vals})
+        return records
+
+    def write(self, vals):
+        res = super().write(vals)
+        self.env['shopify.id.map']._register_records(self, vals)
+        return res
+
+
+class SaleOrderIdMap(models.Model):
+    _inherit = 'sale.order'
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        records = super().create(vals_list)
+        self.env['shopify.id.map']._register_records(records, {f for vals in vals_list for f in vals})
+        return records
+
+    def write(self, vals):
+        res = super().write(vals)
+        self.env['shopify.id.map']._register_records(self, vals)
+        return res
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+from odoo import api, fields, models, _
+
+import logging
+
+_logger = logging.getLogger(__name__)
+
+# Correcciones por mutación inventorySetQuantities
+INVENTORY_CORRECTION_BATCH = 250
+INVENTORY_SET_MUTATION = """
+mutation set($input: InventorySetQuantitiesInput!) {
+  inventorySetQuantities(input: $input) { userErrors { field message } }
+}
+"""
+INVENTORY_REPORT_COLUMNS = ['kind', 'inventory_item_id', 'sku', 'detail']
+
+
+class ProductTemplateInventoryAudit(models.Model):
+    _inherit = 'product.template'
+
+    def audit_inventory_with_shopify(self, shopify_instance_ids, repair=True):
+        """
+        Red de seguridad de export_stock_to_shopify: lee por páginas los niveles de inventario de la
+        ubicación de Shopify, los compara en memoria con el stock de Odoo agregado por inventory_item_id
+        y, con repair=True, corrige solo los que difieren en lotes de INVENTORY_CORRECTION_BATCH.
+        """
+        location = self.env['shopify.location'].sudo().search([('shopify_location_id', '!=', False)], limit=1)
+        if not location:
+            _logger.warning("WSSH Auditoría de inventario: no hay ubicación de Shopify configurada")
+            return
+        for instance_id in shopify_instance_ids:
+            with self.env['shopify.sync.run']._track(instance_id, 'audit_inventory') as run:
+                # Todas las variantes mapeadas; las que no tienen quants deberían estar a 0 en Shopify
+                self.env['product.product'].flush_model(['default_code', 'shopify_inventory_item_id', 'active'])
+                self.env.cr.execute("""
+                    SELECT shopify_inventory_item_id, default_code FROM product_product
+                     WHERE active AND shopify_inventory_item_id IS NOT NULL AND shopify_inventory_item_id != ''
+                """)
+                skus = dict(self.env.cr.fetchall())
+                expected = dict.fromkeys(skus, 0)
+                for product_id, inventory_item_id, quantity, write_date in self._shopify_stock_snapshot():
+                    expected[inventory_item_id] = int(quantity)
+
+                report = []
+                corrections = []
+                seen = set()
+                url = self.get_products_url(instance_id, 'inventory_levels.json')
+                params = {'location_ids': location.shopify_location_id, 'limit': 250}
+                for page in instance_id._iter_shopify_pages(url, params, 'inventory_levels'):
+                    for level in page:
+                        inventory_item_id = str(level.get('inventory_item_id'))
+                        if inventory_item_id not in expected:
+                            continue
+                        seen.add(inventory_item_id)
+                        run.add(scanned=1)
+                        available = level.get('available')
+                        if available == expected[inventory_item_id]:
+                            run.add(skipped=1)
+                            continue
+                        report.append(('inventory_mismatch', inventory_item_id, skus.get(inventory_item_id),
+                                       f"shopify={available} odoo={expected[inventory_item_id]}"))
+                        corrections.append((inventory_item_id, expected[inventory_item_id]))
+                for inventory_item_id in set(expected) - seen:
+                    report.append(('missing_level', inventory_item_id, skus.get(inventory_item_id),
+                                   _("El artículo no tiene nivel de inventario en la ubicación de Shopify")))
+
+                _logger.info("WSSH Auditoría de inventario %s: %d niveles, %d diferencias, %d sin nivel",
+                             instance_id.name, len(seen), len(corrections), len(report) - len(corrections))
+                self._save_drift_report(instance_id, 'inventory', report, INVENTORY_REPORT_COLUMNS)
+                if repair:
+                    for start in range(0, len(corrections), INVENTORY_CORRECTION_BATCH):
+                        self._push_inventory_corrections(
+                            instance_id, location, corrections[start:start + INVENTORY_CORRECTION_BATCH], run)
+
+    def _push_inventory_corrections(self, instance_id, location, corrections, run):
+        data = instance_id._shopify_graphql(INVENTORY_SET_MUTATION, {'input': {
+            'name': 'available',
+            'reason': 'correction',
+            'ignoreCompareQuantity': True,
+            'quantities': [{
+                'inventoryItemId': f"gid://shopify/InventoryItem/{inventory_item_id}",
+                'locationId': f"gid://shopify/Location/{location.shopify_location_id}",
+                'quantity': quantity,
+            } for inventory_item_id, quantity in corrections],
+        }})
+        errors = (data.get('inventorySetQuantities') or {}).get('userErrors')
+        if errors:
+            _logger.warning("WSSH Error corrigiendo inventario: %s", errors)
+            run.add(failed=len(corrections))
+        else:
+            run.add(sent=len(corrections))
+            quantities = dict(corrections)
+            for product in self.env['product.product'].search([('shopify_inventory_item_id', 'in', list(quantities))]):
+                product._set_shopify_pushed_qty(quantities[product.shopify_inventory_item_id])
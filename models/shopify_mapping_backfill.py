@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+from collections import defaultdict
+
+from odoo import api, fields, models, _
+
+import logging
+
+_logger = logging.getLogger(__name__)
+
+BACKFILL_WRITE_BATCH = 500
+BACKFILL_PRODUCT_FIELDS = 'id,variants'
+MAPPING_REPORT_COLUMNS = ['kind', 'shopify_variant_id', 'sku', 'detail']
+
+
+class ProductTemplateMappingBackfill(models.Model):
+    _inherit = 'product.template'
+
+    def backfill_shopify_variant_mappings(self, shopify_instance_ids):
+        """
+        Completa shopify_variant_id, shopify_inventory_item_id y el shopify_product_id del color (o del
+        template) de las variantes que no los tienen, p.ej. las emparejadas por el conector o creadas en
+        Shopify, para que export_stock_to_shopify deje de omitirlas. Recorre una sola vez los productos de
+        Shopify con una proyección mínima y empareja en memoria por ID de variante y, si no, por SKU.
+        Los SKU de Shopify sin variante en Odoo se dejan en un informe CSV.
+        """
+        for instance_id in shopify_instance_ids:
+            with self.env['shopify.sync.run']._track(instance_id, 'backfill_mappings') as run:
+                # Índice en memoria de las variantes activas: solo tuplas, sin cargar registros
+                self.env['product.product'].flush_model(['default_code', 'shopify_variant_id', 'shopify_inventory_item_id'])
+                self.env.cr.execute("""
+                    SELECT id, default_code, shopify_variant_id, shopify_inventory_item_id
+                      FROM product_product WHERE active
+                """)
+                by_variant_id = {}
+                by_sku = {}
+                current = {}
+                for product_id, default_code, shopify_variant_id, inventory_item_id in self.env.cr.fetchall():
+                    current[product_id] = (shopify_variant_id or '', inventory_item_id or '')
+                    if shopify_variant_id:
+                        by_variant_id[str(shopify_variant_id)] = product_id
+                    if default_code:
+                        by_sku.setdefault(default_code, product_id)
+
+                updates = []
+                product_ids_by_shopify_product = defaultdict(list)
+                report = []
+                url = self.get_products_url(instance_id, 'products.json')
+                for page in instance_id._iter_shopify_pages(url, {'limit': 250, 'fields': BACKFILL_PRODUCT_FIELDS}, 'products'):
+                    for shopify_product in page:
+                        for variant in shopify_product.get('variants') or []:
+                            run.add(scanned=1)
+                            shopify_variant_id = str(variant.get('id'))
+                            inventory_item_id = str(variant.get('inventory_item_id') or '')
+                            sku = variant.get('sku') or ''
+                            product_id = by_variant_id.get(shopify_variant_id) or by_sku.get(sku)
+                            if not product_id:
+                                report.append(('unmatched_sku', shopify_variant_id, sku, shopify_product.get('id')))
+                                run.add(failed=1)
+                                continue
+                            old_variant_id, old_inventory_item_id = current[product_id]
+                            if old_variant_id and old_variant_id != shopify_variant_id:
+                                report.append(('conflict', shopify_variant_id, sku,
+                                               _("La variante de Odoo ya está enlazada a %s") % old_variant_id))
+                                run.add(failed=1)
+                                continue
+                            product_ids_by_shopify_product[str(shopify_product.get('id'))].append(product_id)
+                            if (old_variant_id, old_inventory_item_id) == (shopify_variant_id, inventory_item_id):
+                                run.add(skipped=1)
+                                continue
+                            updates.append((product_id, shopify_variant_id, inventory_item_id or None))
+                            run.add(sent=1)
+
+                for start in range(0, len(updates), BACKFILL_WRITE_BATCH):
+                    self._write_variant_mappings(instance_id, updates[start:start + BACKFILL_WRITE_BATCH])
+                    self.env.cr.commit()
+                self._write_product_mappings(instance_id, product_ids_by_shopify_product)
+                _logger.info("WSSH Backfill de mappings %s: %d variantes actualizadas, %d sin emparejar",
+                             instance_id.name, len(updates), len(report))
+                self._save_drift_report(instance_id, 'mapping', report, MAPPING_REPORT_COLUMNS)
+
+    def _write_variant_mappings(self, instance_id, updates):
+        """Escritura agrupada: un único UPDATE ... FROM (VALUES ...) por lote de variantes."""
+        self.env.cr.execute("""
+            UPDATE product_product p
+               SET shopify_variant_id = v.shopify_variant_id, shopify_inventory_item_id = v.inventory_item_id,
+                   write_uid = %%s, write_date = now() at time zone 'UTC'
+              FROM (VALUES %s) AS v(id, shopify_variant_id, inventory_item_id)
+             WHERE p.id = v.id
+        """ % ', '.join(['%s'] * len(updates)), [self.env.uid] + updates)
+        self.env['product.product'].invalidate_model(['shopify_variant_id', 'shopify_inventory_item_id'])
+        IdMap = self.env['shopify.id.map']
+        IdMap._register(instance_id, 'variant', [(variant_id, product_id) for product_id, variant_id, item_id in updates])
+        IdMap._register(instance_id, 'inventory_item', [(item_id, product_id) for product_id, variant_id, item_id in updates])
+
+    def _write_product_mappings(self, instance_id, product_ids_by_shopify_product):
+        """Enlaza el color (o el template, sin separación por colores) al producto de Shopify si no lo estaba."""
+        Variant = self.env['product.product']
+        for shopify_product_id, product_ids in product_ids_by_shopify_product.items():
+            variants = Variant.browse(product_ids)
+            if instance_id.split_products_by_color:
+                targets = variants.product_template_attribute_value_ids.filtered(
+                    lambda v: v.attribute_id.name.lower() == 'color')
+            else:
+                targets = self.env['product.template.attribute.value']
+            if not targets:
+                targets = variants.product_tmpl_id
+            targets.filtered(lambda t: not t.shopify_product_id).write({'shopify_product_id': shopify_product_id})
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+from odoo import api, fields, models, _
+
+import logging
+
+_logger = logging.getLogger(__name__)
+
+# Límites (segundos) del histograma de latencia HTTP
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Marcas de agua expuestas como retraso respecto a ahora
+WATERMARK_FIELDS = ('last_export_product', 'last_export_stock', 'last_export_customer',
+                    'shopify_last_date_order_import')
+
+
+def _format_labels(labels):
+    return ','.join('{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                    for key, value in sorted(labels.items()))
+
+
+class ShopifyMetricCounter(models.Model):
+    """
+    Contadores agregados de la sincronización (una fila por instancia, métrica y etiquetas).
+    Se incrementan al terminar cada ejecución, de modo que el endpoint de métricas solo lee
+    unas pocas filas en lugar de recorrer las tablas de ejecuciones o de trabajos.
+    """
+    _name = 'shopify.metric.counter'
+    _description = 'Shopify Metric Counter'
+
+    shopify_instance_id = fields.Many2one('shopify.instance', string="Shopify Instance", required=True,
+                                          ondelete='cascade')
+    name = fields.Char(string="Metric", required=True)
+    labels = fields.Char(string="Labels", required=True, default='')
+    value = fields.Float(string="Value", default=0.0)
+
+    def init(self):
+        self.env.cr.execute("""
+            CREATE UNIQUE INDEX IF NOT EXISTS shopify_metric_counter_uniq
+            ON shopify_metric_counter (shopify_instance_id, name, labels)
+        """)
+
+    @api.model
+    def _increment(self, shopify_instance, increments):
+        """
+        Suma los incrementos indicados con un upsert atómico por fila.
+
+        :param increments: lista de tuplas (nombre, dict de etiquetas, valor)
+        """
+        for name, labels, value in increments:
+            if not value:
+                continue
+            self.env.cr.execute("""
+                INSERT INTO shopify_metric_counter (shopify_instance_id, name, labels, value,
+                                                    create_uid, write_uid, create_date, write_date)
+                VALUES (%s, %s, %s, %s, %s, %s, now() at time zone 'UTC', now() at time zone 'UTC')
+                ON CONFLICT (shopify_instance_id, name, labels)
+                DO UPDATE SET value = shopify_metric_counter.value + EXCLUDED.value,
+                              write_date = EXCLUDED.write_date
+            """, (shopify_instance.id, name, _format_labels(labels), value, self.env.uid, self.env.uid))
+
+    @api.model
+    def _collector_increments(self, collector):
+        """Traduce las métricas de una ejecución (SyncRunCollector) a incrementos de contadores."""
+        increments = []
+        for key, count in collector.calls.items():
+            endpoint, status = key.rsplit(' ', 1)
+            increments.append(('shopify_api_calls_total', {'endpoint': endpoint, 'status': status}, count))
+        for endpoint, latencies in collector.latency_by_endpoint.items():
+            for bucket in LATENCY_BUCKETS:
+                increments.append(('shopify_api_latency_seconds_bucket', {'endpoint': endpoint, 'le': bucket},
+                                   sum(1 for latency in latencies if latency <= bucket)))
+            increments.append(('shopify_api_latency_seconds_bucket', {'endpoint': endpoint, 'le': '+Inf'},
+                               len(latencies)))
+            increments.append(('shopify_api_latency_seconds_sum', {'endpoint': endpoint}, sum(latencies)))
+            increments.append(('shopify_api_latency_seconds_count', {'endpoint': endpoint}, len(latencies)))
+        increments.append(('shopify_throttle_wait_seconds_total', {}, collector.throttle_sleep))
+        increments.append(('shopify_throttle_waits_total', {}, collector.throttle_count))
+        increments.append(('shopify_sync_runs_total', {'operation': collector.operation}, 1))
+        increments.append(('shopify_sync_records_failed_total', {'operation': collector.operation},
+                           collector.records_failed))
+        return increments
+
+    @api.model
+    def _render_prometheus(self):
+        """Genera el texto en formato de exposición de Prometheus."""
+        types = {
+            'shopify_api_calls_total': 'counter',
+            'shopify_api_latency_seconds': 'histogram',
+            'shopify_throttle_wait_seconds_total': 'counter',
+            'shopify_throttle_waits_total': 'counter',
+            'shopify_sync_runs_total': 'counter',
+            'shopify_sync_records_failed_total': 'counter',
+            'shopify_sync_queue_depth': 'gauge',
+            'shopify_watermark_lag_seconds': 'gauge',
+        }
+        samples = {name: [] for name in types}
+        instances = self.env['shopify.instance'].sudo().with_context(active_test=False).search([])
+        instance_names = {instance.id: instance.name for instance in instances}
+
+        self.env.cr.execute("SELECT shopify_instance_id, name, labels, value FROM shopify_metric_counter ORDER BY name, labels")
+        for instance_id, name, labels, value in self.env.cr.fetchall():
+            # Las series _bucket/_sum/_count del histograma comparten familia
+            family = 'shopify_api_latency_seconds' if name.startswith('shopify_api_latency_seconds') else name
+            instance_label = 'instance="{}"'.format(instance_names.get(instance_id, instance_id))
+            samples.setdefault(family, []).append(
+                '{}{{{}}} {}'.format(name, ','.join(filter(None, [instance_label, labels])), repr(float(value))))
+
+        # Profundidad de la cola: solo se cuentan los estados activos, que usan el índice de state
+        groups = self.env['shopify.sync.job'].sudo().read_group(
+            [('state', 'in', ('pending', 'running', 'failed'))],
+            ['shopify_instance_id', 'job_type', 'state'], ['shopify_instance_id', 'job_type', 'state'], lazy=False)
+        for group in groups:
+            labels = {
+                'instance': group['shopify_instance_id'][1],
+                'job_type': group['job_type'],
+                'state': group['state'],
+            }
+            samples['shopify_sync_queue_depth'].append(
+                'shopify_sync_queue_depth{{{}}} {}'.format(_format_labels(labels), group['__count']))
+
+        now = fields.Datetime.now()
+        for instance in instances:
+            for field_name in WATERMARK_FIELDS:
+                value = instance[field_name]
+                if value:
+                    samples['shopify_watermark_lag_seconds'].append('shopify_watermark_lag_seconds{{{}}} {}'.format(
+                        _format_labels({'instance': instance.name, 'watermark': field_name}),
+                        (now - value).total_seconds()))
+
+        lines = []
+        for family, family_samples in samples.items():
+            if not family_samples:
+                continue
+            if family in types:
+                lines.append(f'# TYPE {family} {types[family]}')
+            lines.extend(family_samples)
+        return '\n'.join(lines) + '\n'
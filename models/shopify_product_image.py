@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+import base64
+from concurrent.futures import ThreadPoolExecutor
+
+from odoo import api, fields, models, _
+
+import logging
+
+from .shopify_sync_run import (RateLimiter, SHOPIFY_REST_CALLS_PER_SECOND, current_collector, iter_chunked,
+                               shopify_http_request)
+
+_logger = logging.getLogger(__name__)
+
+IMAGE_PREFETCH = (
+    'shopify_product_id',
+    'attribute_line_ids.attribute_id.name',
+    'attribute_line_ids.product_template_value_ids.shopify_product_id',
+    'product_variant_ids.product_template_attribute_value_ids',
+)
+IMAGE_FIELDS = ('image_1920', 'image_variant_1920')
+IMAGE_MAX_RETRIES = 3
+
+
+class ShopifyProductImage(models.Model):
+    _name = 'shopify.product.image'
+    _description = 'Shopify Product Image'
+
+    shopify_instance_id = fields.Many2one('shopify.instance', string="Shopify Instance", required=True,
+                                          ondelete='cascade', index=True)
+    shopify_product_id = fields.Char(string="Shopify Product ID", required=True, index=True)
+    shopify_image_id = fields.Char(string="Shopify Image ID")
+    checksum = fields.Char(string="Checksum", required=True,
+                           help="SHA1 del contenido (el checksum de ir.attachment): si no cambia, la imagen no se vuelve a subir.")
+
+    _sql_constraints = [
+        ('instance_product_checksum_uniq', 'unique(shopify_instance_id, shopify_product_id, checksum)',
+         'La imagen ya está registrada para este producto de Shopify.'),
+    ]
+
+
+def _upload_image(url, headers, upload, limiter, collector):
+    """
+    Sube una imagen desde un hilo auxiliar. Solo se lee del filestore el fichero de esta imagen,
+    y no se usa el ORM (el entorno no es seguro entre hilos): recibe ya calculados la URL y las
+    cabeceras con el token de la instancia.
+    """
+    if upload['path']:
+        with open(upload['path'], 'rb') as image_file:
+            attachment = base64.b64encode(image_file.read()).decode()
+    else:
+        attachment = upload['datas']
+    payload = {"image": {"attachment": attachment, "filename": upload['filename'], "position": 1}}
+    response = None
+    for attempt in range(IMAGE_MAX_RETRIES):
+        limiter.wait()
+        response = shopify_http_request('POST', url, headers=headers, json=payload, collector=collector)
+        if response.status_code != 429:
+            break
+        limiter.backoff(float(response.headers.get('Retry-After') or 2))
+    if response.ok:
+        return str(response.json().get('image', {}).get('id')), None
+    return None, response.text
+
+
+class ProductTemplateImage(models.Model):
+    _inherit = 'product.template'
+
+    def _plan_shopify_images(self, instance_id):
+        """
+        Para cada producto de Shopify ya creado devuelve (shopify_product_id, candidatos), siendo
+        candidatos las imágenes posibles por orden de preferencia: (modelo, res_id, campo).
+        En la separación por colores se usa la imagen de una variante del color y, si no tiene, la del template.
+        """
+        for product in iter_chunked(self, IMAGE_PREFETCH):
+            color_line = instance_id.split_products_by_color and self._get_shopify_color_line(product)
+            if color_line:
+                for template_attribute_value in color_line.product_template_value_ids:
+                    if not template_attribute_value.shopify_product_id:
+                        continue
+                    variants = product.product_variant_ids.filtered(
+                        lambda v: template_attribute_value in v.product_template_attribute_value_ids)
+                    candidates = [('product.product', variant.id, 'image_variant_1920') for variant in variants]
+                    candidates.append(('product.template', product.id, 'image_1920'))
+                    yield str(template_attribute_value.shopify_product_id), candidates
+            elif product.shopify_product_id:
+                yield str(product.shopify_product_id), [('product.template', product.id, 'image_1920')]
+
+    def _resolve_shopify_image_uploads(self, instance_id, plan):
+        """
+        Elige la imagen de cada producto de Shopify a partir del checksum de su adjunto (sin leer el
+        fichero) y descarta las que ya están subidas. Devuelve (subidas pendientes, omitidas).
+        """
+        keys = {candidate for shopify_product_id, candidates in plan for candidate in candidates}
+        attachments = {}
+        for res_model in ('product.template', 'product.product'):
+            res_ids = [res_id for model, res_id, field in keys if model == res_model]
+            if not res_ids:
+                continue
+            for attachment in self.env['ir.attachment'].sudo().search_read(
+                    [('res_model', '=', res_model), ('res_id', 'in', res_ids), ('res_field', 'in', IMAGE_FIELDS)],
+                    ['res_model', 'res_id', 'res_field', 'checksum', 'store_fname', 'mimetype']):
+                attachments[(attachment['res_model'], attachment['res_id'], attachment['res_field'])] = attachment
+
+        uploaded = {}
+        for image in self.env['shopify.product.image'].search_read(
+                [('shopify_instance_id', '=', instance_id.id),
+                 ('shopify_product_id', 'in', [shopify_product_id for shopify_product_id, candidates in plan])],
+                ['shopify_product_id', 'checksum', 'shopify_image_id']):
+            uploaded.setdefault(image['shopify_product_id'], {})[image['checksum']] = image
+
+        uploads = []
+        skipped = 0
+        Attachment = self.env['ir.attachment'].sudo()
+        for shopify_product_id, candidates in plan:
+            attachment = next((attachments[key] for key in candidates if key in attachments), None)
+            if not attachment:
+                continue
+            previous = uploaded.get(shopify_product_id, {})
+            if attachment['checksum'] in previous:
+                skipped += 1
+                continue
+            extension = (attachment['mimetype'] or 'image/png').split('/')[-1]
+            uploads.append({
+                'shopify_product_id': shopify_product_id,
+                'checksum': attachment['checksum'],
+                'filename': f"{shopify_product_id}_{attachment['checksum'][:12]}.{extension}",
+                'path': attachment['store_fname'] and Attachment._full_path(attachment['store_fname']),
+                # Adjuntos guardados en base de datos: solo el id, su contenido se lee con la tanda que lo sube
+                'attachment_id': not attachment['store_fname'] and attachment['id'],
+                'superseded': list(previous.values()),
+            })
+        return uploads, skipped
+
+    def export_images_to_shopify(self, shopify_instance_ids):
+        """
+        Exporta a Shopify la imagen del template (o la de cada color si se separa por colores).
+        Las imágenes ya subidas se reconocen por el checksum del adjunto y no se vuelven a enviar;
+        las nuevas se suben en paralelo respetando el límite de llamadas de la API.
+        """
+        templates = self or self.search([('is_published', '=', True)])
+        for instance_id in shopify_instance_ids:
+            with self.env['shopify.sync.run']._track(instance_id, 'export_images') as run:
+                plan = list(templates._plan_shopify_images(instance_id))
+                uploads, skipped = self._resolve_shopify_image_uploads(instance_id, plan)
+                run.add(scanned=len(plan), skipped=skipped)
+                _logger.info("WSSH Imágenes: %d por subir, %d sin cambios para %s", len(uploads), skipped, instance_id.name)
+                if uploads:
+                    self._upload_shopify_images(instance_id, uploads, run)
+
+    def _upload_shopify_images(self, instance_id, uploads, run):
+        headers = {
+            "X-Shopify-Access-Token": instance_id.shopify_shared_secret,
+            "Content-Type": "application/json"
+        }
+        collector = current_collector()
+        limiter = RateLimiter(SHOPIFY_REST_CALLS_PER_SECOND, collector)
+        workers = max(instance_id.image_upload_workers, 1)
+        Image = self.env['shopify.product.image']
+        Attachment = self.env['ir.attachment'].sudo()
+        # Se envían por tandas para no tener más de unas pocas imágenes en memoria a la vez
+        for start in range(0, len(uploads), workers):
+            batch = uploads[start:start + workers]
+            for upload in batch:
+                upload['url'] = self.get_products_url(instance_id, f"products/{upload['shopify_product_id']}/images.json")
+                # Adjuntos en base de datos: se leen en el hilo principal, solo los de esta tanda
+                if upload['attachment_id']:
+                    upload['datas'] = Attachment.browse(upload['attachment_id']).datas.decode()
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                results = list(executor.map(
+                    lambda upload: _upload_image(upload['url'], headers, upload, limiter, collector),
+                    batch))
+            # Fuera de memoria el contenido de la tanda: ni en las subidas ni en la caché del ORM
+            for upload in batch:
+                upload.pop('datas', None)
+            Attachment.invalidate_model(['datas', 'db_datas', 'raw'])
+            for upload, (image_id, error) in zip(batch, results):
+                if error:
+                    _logger.warning("WSSH Error subiendo imagen del producto %s: %s", upload['shopify_product_id'], error)
+                    run.add(failed=1)
+                    continue
+                run.add(sent=1)
+                Image.create({
+                    'shopify_instance_id': instance_id.id,
+                    'shopify_product_id': upload['shopify_product_id'],
+                    'shopify_image_id': image_id,
+                    'checksum': upload['checksum'],
+                })
+                # La imagen anterior del producto queda sustituida por la nueva
+                for previous in upload['superseded']:
+                    if previous['shopify_image_id']:
+                        limiter.wait()
+                        instance_id._shopify_request('DELETE', self.get_products_url(
+                            instance_id, f"products/{upload['shopify_product_id']}/images/{previous['shopify_image_id']}.json"),
+                            headers=headers)
+                    Image.browse(previous['id']).unlink()
+            self.env.cr.commit()
@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+import csv
+import hashlib
+import html
+import io
+import json
+import re
+
+from odoo import api, fields, models, _
+
+import logging
+
+from .shopify_sync_run import iter_chunked
+from .product_split import PRODUCT_EXPORT_PREFETCH
+
+_logger = logging.getLogger(__name__)
+
+# Proyección mínima para comparar: con 250 productos por página, 4 llamadas por cada 1000 productos
+RECONCILE_PRODUCT_FIELDS = 'id,title,body_html,tags,variants'
+DRIFT_REPORT_COLUMNS = ['kind', 'shopify_product_id', 'odoo_reference', 'detail']
+
+
+def normalize_body_html(body_html):
+    """
+    Texto visible de una descripción HTML. Shopify reescribe el body_html que recibe (etiquetas,
+    atributos, entidades y espacios), así que solo se compara el texto con los espacios colapsados.
+    """
+    text = re.sub(r'<[^>]*>', ' ', body_html or '')
+    return ' '.join(html.unescape(text).split())
+
+
+def shopify_product_checksum(title, body_html, tags, variants):
+    """
+    Checksum de un producto de Shopify normalizado igual en ambos lados: variantes ordenadas por SKU
+    con precio a 2 decimales, código de barras y valores de opción; etiquetas ordenadas y sin espacios;
+    de la descripción, solo su texto.
+    """
+    if isinstance(tags, str):
+        tags = tags.split(',')
+    normalized = {
+        'title': (title or '').strip(),
+        'body_html': normalize_body_html(body_html),
+        'tags': sorted(tag.strip() for tag in tags or [] if tag.strip()),
+        'variants': sorted(
+            [
+                variant.get('sku') or '',
+                '%.2f' % float(variant.get('price') or 0),
+                variant.get('barcode') or '',
+                sorted(str(variant.get(f'option{position}')) for position in (1, 2, 3)
+                       if variant.get(f'option{position}') not in (None, '', 'Default Title')),
+            ]
+            for variant in variants
+        ),
+    }
+    return hashlib.sha1(json.dumps(normalized, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class ProductTemplateReconcile(models.Model):
+    _inherit = 'product.template'
+
+    def _shopify_catalog_checksums(self, instance_id):
+        """
+        Checksums del lado de Odoo, calculados con los mismos builders que la exportación.
+
+        :return: dict {shopify_product_id: (checksum, template_id, ptav_id, referencia)}
+        """
+        expected = {}
+        templates = self.search([('id', 'in', self._shopify_instance_template_ids(instance_id)),
+                                 '|', ('shopify_product_id', '!=', False),
+                                 ('attribute_line_ids.product_template_value_ids.shopify_product_id', '!=', False)])
+        for product in iter_chunked(templates, PRODUCT_EXPORT_PREFETCH):
+            color_line = instance_id.split_products_by_color and self._get_shopify_color_line(product)
+            if color_line:
+                for template_attribute_value, variants, variant_data, product_data in self._plan_shopify_color_units(
+                        product, color_line, instance_id, False):
+                    if not template_attribute_value.shopify_product_id:
+                        continue
+                    data = product_data['product']
+                    expected[str(template_attribute_value.shopify_product_id)] = (
+                        shopify_product_checksum(data['title'], data['body_html'], data['tags'], variant_data),
+                        product.id, template_attribute_value.id, data['title'])
+            elif product.shopify_product_id:
+                variant_data = [self._prepare_shopify_variant_data(variant, instance_id)
+                                for variant in product.product_variant_ids if variant.default_code]
+                data = self._prepare_shopify_single_product_data(product)['product']
+                expected[str(product.shopify_product_id)] = (
+                    shopify_product_checksum(data['title'], data['body_html'], data['tags'], variant_data),
+                    product.id, False, data['title'])
+        return expected
+
+    def _shopify_instance_template_ids(self, instance_id):
+        """
+        Templates de la instancia: los asociados a ella y los que tienen estado de exportación en ella
+        (el template o alguno de sus colores). Con varias tiendas, los de otra no cuentan como ausentes.
+        """
+        self.flush_model(['shopify_instance_id'])
+        self.env['shopify.export.state'].flush_model()
+        self.env.cr.execute("""
+            SELECT id FROM product_template WHERE shopify_instance_id = %(instance)s
+            UNION
+            SELECT s.res_id FROM shopify_export_state s
+             WHERE s.shopify_instance_id = %(instance)s AND s.kind = 'product' AND s.res_model = 'product.template'
+            UNION
+            SELECT v.product_tmpl_id FROM shopify_export_state s
+              JOIN product_template_attribute_value v ON v.id = s.res_id
+             WHERE s.shopify_instance_id = %(instance)s AND s.kind = 'product'
+               AND s.res_model = 'product.template.attribute.value'
+        """, {'instance': instance_id.id})
+        return [row[0] for row in self.env.cr.fetchall()]
+
+    def reconcile_catalog_with_shopify(self, shopify_instance_ids, repair=True):
+        """
+        Compara el catálogo de Odoo con el de Shopify por checksums y deja un informe de diferencias
+        (CSV adjunto a la instancia). Con repair=True, los productos distintos se marcan como
+        pendientes de exportar y los que ya no existen en Shopify pierden su mapping para volver a crearse;
+        la reexportación se encola como un único trabajo export_products.
+        """
+        for instance_id in shopify_instance_ids:
+            with self.env['shopify.sync.run']._track(instance_id, 'reconcile_catalog') as run:
+                expected = self._shopify_catalog_checksums(instance_id)
+                report = []
+                seen = set()
+                matched = 0
+                url = self.get_products_url(instance_id, 'products.json')
+                # _iter_shopify_pages lanza UserError si el listado se corta: solo con el listado completo
+                # se puede afirmar que un producto falta en Shopify (y quitarle el mapping)
+                for page in instance_id._iter_shopify_pages(
+                        url, {'limit': 250, 'fields': RECONCILE_PRODUCT_FIELDS}, 'products'):
+                    for shopify_product in page:
+                        shopify_product_id = str(shopify_product.get('id'))
+                        seen.add(shopify_product_id)
+                        run.add(scanned=1)
+                        if shopify_product_id not in expected:
+                            report.append(('orphan_in_shopify', shopify_product_id, '', shopify_product.get('title')))
+                            continue
+                        checksum = shopify_product_checksum(
+                            shopify_product.get('title'), shopify_product.get('body_html'),
+                            shopify_product.get('tags'), shopify_product.get('variants') or [])
+                        if checksum != expected[shopify_product_id][0]:
+                            report.append(('mismatch', shopify_product_id, expected[shopify_product_id][3], ''))
+                        else:
+                            matched += 1
+
+                for shopify_product_id, (checksum, template_id, ptav_id, reference) in expected.items():
+                    if shopify_product_id not in seen:
+                        report.append(('missing_in_shopify', shopify_product_id, reference, ''))
+
+                run.add(skipped=matched, failed=len(report))
+                _logger.info("WSSH Reconciliación %s: %d productos en Shopify, %d diferencias",
+                             instance_id.name, len(seen), len(report))
+                self._save_drift_report(instance_id, 'catalog', report)
+                if repair and report:
+                    self._repair_catalog_drift(instance_id, expected, report)
+
+    def _repair_catalog_drift(self, instance_id, expected, report):
+        Value = self.env['product.template.attribute.value']
+        repaired = False
+        for kind, shopify_product_id, reference, detail in report:
+            if kind == 'orphan_in_shopify':
+                continue
+            checksum, template_id, ptav_id, reference = expected[shopify_product_id]
+            template = self.browse(template_id)
+            if ptav_id:
+                target = Value.browse(ptav_id)
+                variants = template.product_variant_ids.filtered(lambda v: target in v.product_template_attribute_value_ids)
+            else:
+                target = template
+                variants = template.product_variant_ids
+            if kind == 'missing_in_shopify':
+                # El producto ya no existe en Shopify: se quita el mapping para que se vuelva a crear
+                target.write({'shopify_product_id': False})
+                variants.write({'shopify_variant_id': False, 'shopify_inventory_item_id': False})
+            # Sin estado de exportación en la instancia, el registro vuelve a estar pendiente solo para ella
+            self.env['shopify.export.state']._forget(instance_id, 'product', target)
+            repaired = True
+        if repaired:
+            self.env['shopify.sync.job']._enqueue(instance_id, 'export_products')
+
+    def _save_drift_report(self, instance_id, scope, report, columns=DRIFT_REPORT_COLUMNS):
+        """Adjunta a la instancia el informe de diferencias en CSV (shopify_drift_<ámbito>_<fecha>.csv)."""
+        output = io.StringIO()
+        writer = csv.writer(output)
+        writer.writerow(columns)
+        writer.writerows(report)
+        stamp = fields.Datetime.now().strftime('%Y%m%d_%H%M%S')
+        return self.env['ir.attachment'].sudo().create({
+            'name': f'shopify_drift_{scope}_{stamp}.csv',
+            'res_model': 'shopify.instance',
+            'res_id': instance_id.id,
+            'mimetype': 'text/csv',
+            'raw': output.getvalue().encode('utf-8'),
+        })
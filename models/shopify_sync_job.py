@@ -0,0 +1,303 @@
+# -*- coding: utf-8 -*-
+import json
+from datetime import timedelta
+
+from odoo import api, fields, models, _
+
+from .shopify_sync_run import release_sync_lock, sync_lock_key, try_sync_lock
+from .shopify_sync_shard import SHARDED_OPERATIONS
+
+import logging
+import time
+
+_logger = logging.getLogger(__name__)
+
+# resource_id usado por los trabajos que no se refieren a un recurso concreto (exportaciones completas),
+# de forma que también se fusionan: basta con un único trabajo pendiente por instancia y tipo.
+ALL_RESOURCES = '*'
+
+
+class ShopifySyncJob(models.Model):
+    _name = 'shopify.sync.job'
+    _description = 'Shopify Sync Job'
+    _order = 'priority, id'
+
+    shopify_instance_id = fields.Many2one('shopify.instance', string="Shopify Instance", required=True,
+                                          ondelete='cascade', index=True)
+    job_type = fields.Selection([
+        ('order', 'Order'),
+        ('customer', 'Customer'),
+        ('product', 'Product'),
+        ('inventory', 'Inventory Level'),
+        ('import_orders', 'Import Orders'),
+        ('import_customers', 'Import Customers'),
+        ('export_products', 'Export Products'),
+        ('export_stock', 'Export Stock'),
+        ('export_customers', 'Export Customers'),
+        ('export_images', 'Export Images'),
+        ('export_prices', 'Export Prices'),
+        ('reconcile_catalog', 'Reconcile Catalog'),
+        ('audit_inventory', 'Audit Inventory'),
+        ('backfill_mappings', 'Backfill Mappings'),
+        ('export_shard', 'Export Shard'),
+    ], string="Job Type", required=True)
+    resource_id = fields.Char(string="Resource ID", required=True, default=ALL_RESOURCES)
+    payload = fields.Text(string="Payload")
+    priority = fields.Integer(string="Priority", default=10)
+    state = fields.Selection([
+        ('pending', 'Pending'),
+        ('running', 'Running'),
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+    ], string="State", default='pending', required=True, index=True)
+    attempts = fields.Integer(string="Attempts", default=0)
+    coalesced_count = fields.Integer(string="Coalesced Payloads", default=0,
+                                     help="Número de payloads posteriores que han sustituido al original mientras estaba pendiente.")
+    date_next_try = fields.Datetime(string="Next Try")
+    date_started = fields.Datetime(string="Started")
+    date_done = fields.Datetime(string="Done")
+    error = fields.Text(string="Error")
+
+    MAX_ATTEMPTS = 5
+    STALE_RUNNING_MINUTES = 60
+    LOCKED_RETRY_SECONDS = 60
+
+    def init(self):
+        # Un único trabajo pendiente por recurso: los nuevos payloads sustituyen al pendiente (coalescing)
+        self.env.cr.execute("""
+            CREATE UNIQUE INDEX IF NOT EXISTS shopify_sync_job_pending_uniq
+            ON shopify_sync_job (shopify_instance_id, job_type, resource_id)
+            WHERE state = 'pending'
+        """)
+
+    @api.model
+    def _enqueue(self, shopify_instance, job_type, resource_id=ALL_RESOURCES, payload=None, priority=10):
+        """
+        Encola un trabajo de sincronización. Si ya hay uno pendiente para el mismo recurso,
+        se actualiza su payload en lugar de crear otro, así solo se procesa el último.
+
+        :return: shopify.sync.job
+        """
+        if payload is not None and not isinstance(payload, str):
+            payload = json.dumps(payload)
+        self.env.cr.execute("""
+            INSERT INTO shopify_sync_job
+                (shopify_instance_id, job_type, resource_id, payload, priority, state, attempts, coalesced_count,
+                 create_uid, write_uid, create_date, write_date)
+            VALUES (%s, %s, %s, %s, %s, 'pending', 0, 0, %s, %s, now() at time zone 'UTC', now() at time zone 'UTC')
+            ON CONFLICT (shopify_instance_id, job_type, resource_id) WHERE state = 'pending'
+            DO UPDATE SET payload = EXCLUDED.payload,
+                          priority = LEAST(shopify_sync_job.priority, EXCLUDED.priority),
+                          coalesced_count = shopify_sync_job.coalesced_count + 1,
+                          write_date = EXCLUDED.write_date
+            RETURNING id
+        """, (shopify_instance.id, job_type, str(resource_id or ALL_RESOURCES), payload, priority,
+              self.env.uid, self.env.uid))
+        job_id = self.env.cr.fetchone()[0]
+        self.invalidate_model()
+        return self.browse(job_id)
+
+    @api.model
+    def _claim_next(self):
+        """
+        Reserva el siguiente trabajo pendiente con SELECT ... FOR UPDATE SKIP LOCKED, de modo que
+        varios workers (en el mismo nodo o en otros) nunca reciben el mismo trabajo.
+        El estado 'running' se confirma de inmediato porque el procesado puede hacer commits propios.
+        """
+        self.env.cr.execute("""
+            UPDATE shopify_sync_job
+               SET state = 'running', attempts = attempts + 1,
+                   date_started = now() at time zone 'UTC', write_date = now() at time zone 'UTC'
+             WHERE id = (
+                SELECT id FROM shopify_sync_job
+                 WHERE state = 'pending'
+                   AND (date_next_try IS NULL OR date_next_try <= now() at time zone 'UTC')
+                 ORDER BY priority, id
+                 LIMIT 1
+                 FOR UPDATE SKIP LOCKED)
+            RETURNING id
+        """)
+        row = self.env.cr.fetchone()
+        self.env.cr.commit()
+        self.invalidate_model()
+        return self.browse(row[0]) if row else self.browse()
+
+    def _pending_twin(self):
+        """Otro trabajo pendiente para el mismo recurso (un payload posterior fusionado mientras este corría)."""
+        self.ensure_one()
+        return self.search([('state', '=', 'pending'), ('shopify_instance_id', '=', self.shopify_instance_id.id),
+                            ('job_type', '=', self.job_type), ('resource_id', '=', self.resource_id),
+                            ('id', '!=', self.id)], limit=1)
+
+    def _has_pending_twin(self):
+        return bool(self._pending_twin())
+
+    def write(self, vals):
+        res = super().write(vals)
+        if vals.get('state') in ('done', 'failed'):
+            self._close_webhook_events()
+        return res
+
+    def _close_webhook_events(self):
+        """
+        Cierra los webhooks encolados en los trabajos terminados. Si el trabajo no llegó a procesar su
+        payload (fusionado o sustituido) y hay otro pendiente para el recurso, los webhooks pasan a ese.
+        """
+        Event = self.env['shopify.webhook.event'].sudo()
+        for job in self:
+            events = Event.search([('job_id', '=', job.id), ('state', '=', 'queued')])
+            if not events:
+                continue
+            if job.state == 'done' and not job.error:
+                events.write({'state': 'done'})
+                continue
+            twin = job._pending_twin()
+            if twin:
+                events.write({'job_id': twin.id})
+            else:
+                events.write({'state': 'error'})
+
+    @api.model
+    def _requeue_stale_jobs(self):
+        """Devuelve a pendiente los trabajos 'running' de workers que murieron sin terminar."""
+        limit_date = fields.Datetime.now() - timedelta(minutes=self.STALE_RUNNING_MINUTES)
+        stale = self.search([('state', '=', 'running'), ('date_started', '<', limit_date)])
+        for job in stale:
+            # Si mientras tanto se ha encolado un payload más reciente, el antiguo ya no hace falta
+            if job._has_pending_twin():
+                job.write({'state': 'done', 'date_done': fields.Datetime.now(), 'error': _("Sustituido por un payload posterior")})
+            else:
+                job.write({'state': 'pending'})
+        if stale:
+            _logger.warning("WSSH %d trabajos de sincronización bloqueados devueltos a la cola", len(stale))
+
+    @api.model
+    def _cron_process_sync_jobs(self, time_limit=240):
+        """
+        Worker de la cola. Se puede duplicar el cron (o lanzarlo desde varios nodos) para
+        repartir la carga: cada worker reserva sus trabajos con SKIP LOCKED.
+        """
+        self._requeue_stale_jobs()
+        self.env.cr.commit()
+        start = time.time()
+        processed = 0
+        while time.time() - start < time_limit:
+            job = self._claim_next()
+            if not job:
+                break
+            job._run()
+            processed += 1
+        if processed:
+            _logger.info("WSSH Worker de sincronización: %d trabajos procesados", processed)
+        return processed
+
+    def _sync_lock(self):
+        """
+        (clave, compartido) del advisory lock del trabajo, o None. Las operaciones completas se serializan
+        por instancia; los shards toman compartido el de su operación, para no solaparse con una
+        ejecución completa pero sí entre ellos.
+        """
+        self.ensure_one()
+        instance_id = self.shopify_instance_id.id
+        if self.job_type == 'export_shard':
+            shard = self.env['shopify.sync.shard'].browse(int(self.resource_id)).exists()
+            return (sync_lock_key(instance_id, shard.operation), True) if shard else None
+        if self.resource_id == ALL_RESOURCES:
+            return sync_lock_key(instance_id, self.job_type), False
+        return None
+
+    def _requeue_locked(self):
+        """
+        La misma operación se está ejecutando en otro worker para esta instancia: el trabajo vuelve a
+        la cola (sin gastar intento) o, si ya hay otro pendiente equivalente, se da por fusionado con él.
+        """
+        self.ensure_one()
+        if self._has_pending_twin():
+            self.write({'state': 'done', 'date_done': fields.Datetime.now(), 'error': _("Fusionado con un trabajo pendiente")})
+        else:
+            self.write({
+                'state': 'pending',
+                'attempts': self.attempts - 1,
+                'date_next_try': fields.Datetime.now() + timedelta(seconds=self.LOCKED_RETRY_SECONDS),
+            })
+        self.env.cr.commit()
+
+    def _run(self):
+        self.ensure_one()
+        # Advisory lock de sesión: sobrevive a los commits intermedios y PostgreSQL lo libera si el worker muere
+        lock = self._sync_lock()
+        if lock is not None:
+            if not try_sync_lock(self.env.cr, *lock):
+                _logger.info("WSSH %s ya en ejecución para la instancia %s, trabajo %s reprogramado",
+                             self.job_type, self.shopify_instance_id.name, self.id)
+                self._requeue_locked()
+                return
+        try:
+            self._run_locked()
+        finally:
+            if lock is not None:
+                release_sync_lock(self.env.cr, *lock)
+                self.env.cr.commit()
+
+    def _run_locked(self):
+        try:
+            self._process()
+        except Exception as e:
+            self.env.cr.rollback()
+            self.invalidate_model()
+            _logger.exception("WSSH Error en trabajo de sincronización %s (%s %s)", self.id, self.job_type, self.resource_id)
+            if self.attempts >= self.MAX_ATTEMPTS:
+                self.write({'state': 'failed', 'error': str(e)})
+            elif self._has_pending_twin():
+                # Volver a pendiente violaría shopify_sync_job_pending_uniq: el payload posterior ya lo sustituye
+                self.write({'state': 'done', 'date_done': fields.Datetime.now(),
+                            'error': _("Sustituido por un payload posterior tras el error: %s") % e})
+            else:
+                self.write({
+                    'state': 'pending',
+                    'error': str(e),
+                    # Espera exponencial entre reintentos: 1, 2, 4, 8... minutos
+                    'date_next_try': fields.Datetime.now() + timedelta(minutes=2 ** (self.attempts - 1)),
+                })
+        else:
+            self.write({'state': 'done', 'date_done': fields.Datetime.now(), 'error': False})
+        self.env.cr.commit()
+
+    def _process(self):
+        """Delega el trabajo en la lógica de importación/exportación existente."""
+        self.ensure_one()
+        instance = self.shopify_instance_id
+        payload = json.loads(self.payload) if self.payload else {}
+        if self.job_type in SHARDED_OPERATIONS and instance.export_shard_count > 1:
+            # Se reparte en trabajos export_shard que puede reservar cualquier nodo
+            self.env['shopify.sync.shard']._plan(instance, self.job_type)
+        elif self.job_type == 'order':
+            self.env['sale.order'].create_shopify_order([payload], instance, False, status='open')
+        elif self.job_type == 'customer':
+            self.env['res.partner'].create_customers([payload], instance, False)
+        elif self.job_type == 'product':
+            self.env['product.template'].with_context(shopify_sync=True)._process_imported_products([payload], instance, True)
+        elif self.job_type == 'inventory':
+            self.env['product.template']._sync_shopify_inventory_level(instance, payload)
+        elif self.job_type == 'import_orders':
+            self.env['sale.order'].import_shopify_orders(instance, False, False, False)
+        elif self.job_type == 'import_customers':
+            self.env['res.partner'].import_shopify_customers(instance, False)
+        elif self.job_type == 'export_products':
+            self.env['product.template'].export_products_to_shopify(instance, update=True)
+        elif self.job_type == 'export_stock':
+            self.env['product.template'].export_stock_to_shopify(instance)
+        elif self.job_type == 'export_customers':
+            self.env['res.partner'].export_customers_to_shopify(instance, True)
+        elif self.job_type == 'export_images':
+            self.env['product.template'].export_images_to_shopify(instance)
+        elif self.job_type == 'export_prices':
+            self.env['product.template'].export_prices_to_shopify(instance)
+        elif self.job_type == 'reconcile_catalog':
+            self.env['product.template'].reconcile_catalog_with_shopify(instance)
+        elif self.job_type == 'audit_inventory':
+            self.env['product.template'].audit_inventory_with_shopify(instance)
+        elif self.job_type == 'backfill_mappings':
+            self.env['product.template'].backfill_shopify_variant_mappings(instance)
+        elif self.job_type == 'export_shard':
+            self.env['shopify.sync.shard'].browse(int(self.resource_id)).exists()._run_shard()
@@ -0,0 +1,493 @@
+# -*- coding: utf-8 -*-
+import json
+import math
+import re
+import threading
+import time
+import zlib
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from datetime import timedelta
+
+import psycopg2
+import requests
+
+from odoo import api, fields, models, _
+from odoo.exceptions import UserError
+from odoo.tools.profiler import Profiler, PeriodicCollector, SQLCollector
+
+import logging
+
+_logger = logging.getLogger(__name__)
+
+_local = threading.local()
+
+OPERATIONS = [
+    ('export_products', 'Export Products'),
+    ('export_stock', 'Export Stock'),
+    ('export_customers', 'Export Customers'),
+    ('import_orders', 'Import Orders'),
+    ('import_customers', 'Import Customers'),
+    ('import_products', 'Import Products'),
+    ('export_images', 'Export Images'),
+    ('export_prices', 'Export Prices'),
+    ('reconcile_catalog', 'Reconcile Catalog'),
+    ('audit_inventory', 'Audit Inventory'),
+    ('backfill_mappings', 'Backfill Mappings'),
+]
+
+
+# Operaciones que avanzan una marca de agua de la instancia: no pueden solaparse para una misma instancia,
+# vengan de la cola, del asistente o de los crons del conector (ver _track)
+WATERMARK_OPERATIONS = ('export_products', 'export_stock', 'export_customers',
+                        'import_orders', 'import_customers', 'import_products')
+
+# Operaciones que se pueden perfilar con shopify.instance.profile_next_run
+PROFILED_OPERATIONS = ('export_products', 'export_stock', 'export_images', 'import_orders', 'import_customers')
+PROFILE_TOP_QUERIES = 30
+
+# Registros por bloque en las exportaciones de productos, stock y clientes
+EXPORT_CHUNK_SIZE = 200
+
+# Cada cuántos segundos se vuelca el progreso de una ejecución en curso
+PROGRESS_FLUSH_SECONDS = 5
+
+# Límite de llamadas por segundo de la Admin API REST (plan estándar)
+SHOPIFY_REST_CALLS_PER_SECOND = 2
+
+
+def current_collector():
+    """Devuelve el colector de la ejecución en curso en este hilo (o None)."""
+    stack = getattr(_local, 'stack', None)
+    return stack[-1] if stack else None
+
+
+def sync_lock_key(instance_id, operation):
+    """Clave bigint del advisory lock de PostgreSQL para la pareja (instancia, operación)."""
+    return (instance_id << 32) | zlib.crc32(('shopify.sync.job:' + operation).encode())
+
+
+def try_sync_lock(cr, key, shared=False):
+    """
+    Toma sin esperar el advisory lock de sesión de una operación. Es reentrante en la misma conexión,
+    así que _track puede volver a tomarlo dentro de un trabajo de la cola que ya lo tiene.
+    Los shards de una exportación lo toman compartido: entre ellos no se bloquean.
+    """
+    cr.execute("SELECT pg_try_advisory_lock_shared(%s)" if shared else "SELECT pg_try_advisory_lock(%s)", (key,))
+    return cr.fetchone()[0]
+
+
+def release_sync_lock(cr, key, shared=False):
+    """
+    Libera el advisory lock de sesión. Si la operación ha dejado la transacción abortada, el unlock
+    fallaría y el lock seguiría retenido en la conexión del pool, que no se cierra: se deshace antes.
+    """
+    if cr._cnx.get_transaction_status() == psycopg2.extensions.TRANSACTION_STATUS_INERROR:
+        cr.rollback()
+    cr.execute("SELECT pg_advisory_unlock_shared(%s)" if shared else "SELECT pg_advisory_unlock(%s)", (key,))
+
+
+class SyncRunCollector(object):
+    """Acumula en memoria las métricas de una ejecución; se vuelcan a shopify.sync.run al terminar."""
+
+    def __init__(self, env, instance, operation):
+        self.env = env
+        self.instance = instance
+        self.operation = operation
+        self.run_id = None
+        self.result_ids = None
+        # Presupuesto de llamadas compartido entre nodos (solo en las exportaciones repartidas en shards)
+        self.rate_limiter = None
+        self.last_progress_flush = time.monotonic()
+        self.date_start = fields.Datetime.now()
+        self.queries_start = env.cr.sql_log_count
+        self.records_scanned = 0
+        self.records_sent = 0
+        self.records_skipped = 0
+        self.records_failed = 0
+        self.throttle_sleep = 0.0
+        self.throttle_count = 0
+        self.latencies = []
+        self.latency_by_endpoint = {}
+        self.calls = {}
+
+    def add(self, scanned=0, sent=0, skipped=0, failed=0):
+        self.records_scanned += scanned
+        self.records_sent += sent
+        self.records_skipped += skipped
+        self.records_failed += failed
+        if self.run_id and time.monotonic() - self.last_progress_flush >= PROGRESS_FLUSH_SECONDS:
+            self.flush_progress()
+
+    def progress_vals(self):
+        """Progreso de la ejecución: procesados/total (total = registros escaneados), ritmo y fin estimado."""
+        done = self.records_sent + self.records_skipped + self.records_failed
+        now = fields.Datetime.now()
+        elapsed = (now - self.date_start).total_seconds()
+        rate = done / elapsed if elapsed > 0 else 0.0
+        remaining = max(self.records_scanned - done, 0)
+        return {
+            'progress_total': self.records_scanned,
+            'progress_done': done,
+            'progress_rate': round(rate, 2),
+            'progress_eta': now + timedelta(seconds=remaining / rate) if rate and remaining else False,
+        }
+
+    def flush_progress(self):
+        """Escribe el progreso en un cursor aparte para que se vea mientras la ejecución sigue en curso."""
+        self.last_progress_flush = time.monotonic()
+        try:
+            with self.env.registry.cursor() as cr:
+                self.env(cr=cr)['shopify.sync.run'].sudo().browse(self.run_id).write(self.progress_vals())
+        except Exception:
+            _logger.warning("WSSH No se pudo actualizar el progreso de la ejecución %s", self.run_id, exc_info=True)
+
+    def record_call(self, endpoint, status, latency):
+        self.latencies.append(latency)
+        self.latency_by_endpoint.setdefault(endpoint, []).append(latency)
+        key = f'{endpoint} {status}'
+        self.calls[key] = self.calls.get(key, 0) + 1
+
+    def record_throttle(self, seconds):
+        self.throttle_sleep += seconds
+        self.throttle_count += 1
+
+    def p95_latency(self):
+        if not self.latencies:
+            return 0.0
+        ordered = sorted(self.latencies)
+        return ordered[max(0, math.ceil(0.95 * len(ordered)) - 1)]
+
+
+def shopify_endpoint(url):
+    """Normaliza una URL de la Admin API a un nombre de endpoint estable (p.ej. 'variants/<id>')."""
+    path = url.split('?', 1)[0]
+    path = re.sub(r'^.*/admin/api/[^/]+/', '', path)
+    path = re.sub(r'\.json$', '', path)
+    return re.sub(r'/\d+', '/<id>', path)
+
+
+def shopify_http_request(method, url, collector=None, **kwargs):
+    """
+    Llamada HTTP a Shopify sin ORM, utilizable desde hilos auxiliares: respeta el presupuesto de
+    llamadas del colector (si tiene) y registra la latencia en él.
+    """
+    # En las exportaciones repartidas todos los nodos consumen el mismo presupuesto de llamadas
+    limiter = collector is not None and collector.rate_limiter
+    if limiter:
+        limiter.wait()
+    start = time.perf_counter()
+    response = requests.request(method, url, **kwargs)
+    if collector is not None:
+        collector.record_call(shopify_endpoint(url), response.status_code, time.perf_counter() - start)
+    if limiter and response.status_code == 429:
+        limiter.backoff(float(response.headers.get('Retry-After') or 1))
+    return response
+
+
+def throttle_sleep(seconds):
+    """time.sleep que además contabiliza la espera por límite de peticiones en la ejecución actual."""
+    if seconds <= 0:
+        return
+    time.sleep(seconds)
+    collector = current_collector()
+    if collector:
+        collector.record_throttle(seconds)
+
+
+class RateLimiter(object):
+    """
+    Reparte las llamadas a Shopify entre varios hilos respetando un máximo de llamadas por segundo.
+    Las esperas se contabilizan en el colector indicado (los hilos no ven el colector del hilo principal).
+    """
+
+    def __init__(self, calls_per_second, collector=None):
+        self.interval = 1.0 / calls_per_second
+        self.collector = collector
+        self.lock = threading.Lock()
+        self.next_slot = 0.0
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot)
+            self.next_slot = slot + self.interval
+        delay = slot - now
+        if delay > 0:
+            time.sleep(delay)
+            if self.collector:
+                self.collector.record_throttle(delay)
+
+    def backoff(self, seconds):
+        """Tras un 429 retrasa también el siguiente hueco de todos los hilos."""
+        with self.lock:
+            self.next_slot = max(self.next_slot, time.monotonic() + seconds)
+
+
+class SharedRateLimiter(object):
+    """
+    Igual que RateLimiter pero con el siguiente hueco guardado en PostgreSQL (tabla shopify_api_budget),
+    de modo que todos los workers y nodos que trabajan para una instancia comparten su límite de llamadas.
+    Cada reserva usa un cursor propio y se confirma en el acto para no retener el bloqueo de la fila.
+    """
+
+    def __init__(self, registry, instance_id, calls_per_second, collector=None):
+        self.registry = registry
+        self.instance_id = instance_id
+        self.interval = 1.0 / calls_per_second
+        self.collector = collector
+
+    def wait(self):
+        with self.registry.cursor() as cr:
+            cr.execute("""
+                INSERT INTO shopify_api_budget (instance_id, next_slot)
+                VALUES (%(instance)s, clock_timestamp() + make_interval(secs => %(interval)s))
+                ON CONFLICT (instance_id) DO UPDATE
+                   SET next_slot = GREATEST(shopify_api_budget.next_slot, clock_timestamp())
+                                   + make_interval(secs => %(interval)s)
+                RETURNING EXTRACT(EPOCH FROM next_slot - clock_timestamp())
+            """, {'instance': self.instance_id, 'interval': self.interval})
+            delay = float(cr.fetchone()[0]) - self.interval
+        if delay > 0:
+            time.sleep(delay)
+            if self.collector:
+                self.collector.record_throttle(delay)
+
+    def backoff(self, seconds):
+        """Tras un 429 retrasa el siguiente hueco de todos los nodos."""
+        with self.registry.cursor() as cr:
+            cr.execute("""
+                UPDATE shopify_api_budget
+                   SET next_slot = GREATEST(next_slot, clock_timestamp() + make_interval(secs => %s))
+                 WHERE instance_id = %s
+            """, (seconds, self.instance_id))
+
+
+def export_chunk_size(env):
+    """Tamaño de bloque de las exportaciones (parámetro ws_shopify_split_color.export_chunk_size)."""
+    return int(env['ir.config_parameter'].sudo().get_param('ws_shopify_split_color.export_chunk_size', EXPORT_CHUNK_SIZE))
+
+
+def iter_chunked(records, prefetch_fields=(), chunk_size=None, commit=False):
+    """
+    Recorre los registros de uno en uno pero en bloques de ids de tamaño fijo, para que la memoria
+    no crezca con el tamaño del catálogo. En cada bloque se precargan solo los campos indicados
+    (admite rutas tipo 'product_variant_ids.default_code'); al terminarlo se hace commit si se pide
+    y se vacía la caché del ORM antes de pasar al siguiente.
+    """
+    env = records.env
+    ids = records.ids
+    chunk_size = chunk_size or export_chunk_size(env)
+    for start in range(0, len(ids), chunk_size):
+        # browse() con solo los ids del bloque: el prefetch no se extiende al resto del listado
+        chunk = records.browse(ids[start:start + chunk_size])
+        for path in prefetch_fields:
+            chunk.mapped(path)
+        for record in chunk:
+            yield record
+        if commit:
+            env.cr.commit()
+        env.invalidate_all()
+
+
+class ShopifySyncRun(models.Model):
+    _name = 'shopify.sync.run'
+    _description = 'Shopify Sync Run'
+    _order = 'date_start desc, id desc'
+
+    def init(self):
+        # Siguiente hueco libre del presupuesto de llamadas de cada instancia (ver SharedRateLimiter)
+        self.env.cr.execute("""
+            CREATE TABLE IF NOT EXISTS shopify_api_budget (
+                instance_id integer PRIMARY KEY REFERENCES shopify_instance (id) ON DELETE CASCADE,
+                next_slot timestamp with time zone NOT NULL
+            )
+        """)
+
+    shopify_instance_id = fields.Many2one('shopify.instance', string="Shopify Instance", required=True,
+                                          ondelete='cascade', index=True)
+    operation = fields.Selection(OPERATIONS, string="Operation", required=True, index=True)
+    state = fields.Selection([
+        ('running', 'Running'),
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+    ], string="State", default='done')
+    date_start = fields.Datetime(string="Start")
+    date_end = fields.Datetime(string="End")
+    duration = fields.Float(string="Duration (s)")
+    records_scanned = fields.Integer(string="Scanned")
+    records_sent = fields.Integer(string="Sent")
+    records_skipped = fields.Integer(string="Skipped")
+    records_failed = fields.Integer(string="Failed")
+    api_calls = fields.Integer(string="API Calls")
+    throttle_sleep = fields.Float(string="Throttle Sleep (s)")
+    avg_latency = fields.Float(string="Avg HTTP Latency (ms)")
+    p95_latency = fields.Float(string="P95 HTTP Latency (ms)")
+    sql_queries = fields.Integer(string="SQL Queries")
+    api_calls_detail = fields.Text(string="API Calls by Endpoint")
+    error = fields.Text(string="Error")
+    progress_total = fields.Integer(string="Total")
+    progress_done = fields.Integer(string="Processed")
+    progress_rate = fields.Float(string="Rate (records/s)")
+    progress_eta = fields.Datetime(string="ETA")
+    progress_percent = fields.Float(string="Progress", compute='_compute_progress_percent')
+    result_ids = fields.Text(string="Result Records",
+                             help="Ids (JSON) de los registros afectados, para abrir el resultado al terminar.")
+
+    def _compute_progress_percent(self):
+        for run in self:
+            if run.state != 'running':
+                run.progress_percent = 100.0
+            elif run.progress_total:
+                run.progress_percent = min(100.0, 100.0 * run.progress_done / run.progress_total)
+            else:
+                run.progress_percent = 0.0
+
+    def action_view_result(self):
+        """Abre las variantes afectadas, igual que al ejecutar la operación desde el asistente."""
+        self.ensure_one()
+        action = self.env.ref("pragtech_odoo_shopify_connector.action_product_product_shopify").sudo().read()[0]
+        action["domain"] = [("id", "in", json.loads(self.result_ids or '[]'))]
+        return action
+
+    @contextmanager
+    def _track(self, instance, operation):
+        """
+        Registra una ejecución de sincronización. Si ya hay una ejecución en curso en el hilo
+        (p.ej. import_shopify_orders llama a import_shopify_draft_orders) se reutiliza su colector.
+        El registro se crea en un cursor aparte para que sobreviva aunque la operación falle.
+        Las operaciones con marca de agua toman el advisory lock de la operación, se lancen desde donde se lancen.
+        """
+        collector = current_collector()
+        if collector is not None or not instance:
+            yield collector or SyncRunCollector(self.env, instance, operation)
+            return
+        shard = bool(self.env.context.get('shopify_shard'))
+        lock_key = sync_lock_key(instance.id, operation) if operation in WATERMARK_OPERATIONS else None
+        if lock_key is not None and not try_sync_lock(self.env.cr, lock_key, shard):
+            raise UserError(_("WSSH %s ya se está ejecutando para la instancia %s") % (operation, instance.name))
+        collector = SyncRunCollector(self.env, instance, operation)
+        collector.run_id = self._create_running(collector)
+        if shard:
+            collector.rate_limiter = SharedRateLimiter(self.env.registry, instance.id,
+                                                       SHOPIFY_REST_CALLS_PER_SECOND, collector)
+        _local.stack = [collector]
+        # Solo se crea el profiler si se ha pedido: el resto de ejecuciones no tienen coste añadido
+        profiler = None
+        if operation in PROFILED_OPERATIONS and instance.profile_next_run:
+            profiler = Profiler(collectors=[SQLCollector(), PeriodicCollector(interval=0.005)], db=None,
+                                description=f'shopify {operation}')
+            profiler.__enter__()
+        start = time.perf_counter()
+        error = None
+        try:
+            yield collector
+        except Exception as e:
+            error = str(e)
+            raise
+        finally:
+            _local.stack = []
+            if profiler is not None:
+                profiler.__exit__(None, None, None)
+                self._save_profile(profiler, instance, operation)
+            self._save_run(collector, time.perf_counter() - start, error)
+            if lock_key is not None:
+                release_sync_lock(self.env.cr, lock_key, shard)
+
+    def _save_profile(self, profiler, instance, operation):
+        """
+        Guarda el resultado del profiler como adjuntos de la instancia: las pilas muestreadas en
+        formato 'collapsed' (para flamegraph.pl o speedscope) y las consultas SQL con más tiempo
+        acumulado. Desactiva además profile_next_run.
+        """
+        stacks = Counter()
+        queries = defaultdict(lambda: [0, 0.0])
+        for collector in profiler.collectors:
+            if isinstance(collector, PeriodicCollector):
+                for entry in collector.entries:
+                    frames = ['{} ({}:{})'.format(frame[2], frame[0], frame[1]) for frame in entry.get('stack') or []]
+                    if frames:
+                        stacks[';'.join(frames)] += 1
+            elif isinstance(collector, SQLCollector):
+                for entry in collector.entries:
+                    stats = queries[entry['query']]
+                    stats[0] += 1
+                    stats[1] += entry['time']
+        collapsed = '\n'.join(f'{stack} {count}' for stack, count in stacks.most_common())
+        top_queries = sorted(queries.items(), key=lambda item: item[1][1], reverse=True)[:PROFILE_TOP_QUERIES]
+        sql_report = '\n\n'.join(
+            f'-- {count} ejecuciones, {total * 1000:.1f} ms acumulados\n{query}'
+            for query, (count, total) in top_queries)
+        stamp = fields.Datetime.now().strftime('%Y%m%d_%H%M%S')
+        try:
+            with self.env.registry.cursor() as cr:
+                env = self.env(cr=cr)
+                env['ir.attachment'].sudo().create([{
+                    'name': f'shopify_profile_{operation}_{stamp}.collapsed',
+                    'res_model': 'shopify.instance',
+                    'res_id': instance.id,
+                    'mimetype': 'text/plain',
+                    'raw': collapsed.encode('utf-8'),
+                }, {
+                    'name': f'shopify_profile_{operation}_{stamp}_sql.txt',
+                    'res_model': 'shopify.instance',
+                    'res_id': instance.id,
+                    'mimetype': 'text/plain',
+                    'raw': sql_report.encode('utf-8'),
+                }])
+                env['shopify.instance'].sudo().browse(instance.id).profile_next_run = False
+        except Exception:
+            _logger.exception("WSSH No se pudo guardar el perfil de %s", operation)
+        instance.invalidate_recordset(['profile_next_run'])
+
+    def _create_running(self, collector):
+        """Crea el registro en estado 'running' (en un cursor aparte) para poder seguir su progreso."""
+        try:
+            with self.env.registry.cursor() as cr:
+                return self.env(cr=cr)['shopify.sync.run'].sudo().create({
+                    'shopify_instance_id': collector.instance.id,
+                    'operation': collector.operation,
+                    'state': 'running',
+                    'date_start': collector.date_start,
+                }).id
+        except Exception:
+            _logger.exception("WSSH No se pudo crear la ejecución de sincronización %s", collector.operation)
+            return None
+
+    def _save_run(self, collector, duration, error=None):
+        latencies = collector.latencies
+        vals = {
+            'shopify_instance_id': collector.instance.id,
+            'operation': collector.operation,
+            'state': 'failed' if error else 'done',
+            'date_start': collector.date_start,
+            'date_end': fields.Datetime.now(),
+            'duration': round(duration, 3),
+            'records_scanned': collector.records_scanned,
+            'records_sent': collector.records_sent,
+            'records_skipped': collector.records_skipped,
+            'records_failed': collector.records_failed,
+            'api_calls': len(latencies),
+            'throttle_sleep': round(collector.throttle_sleep, 3),
+            'avg_latency': round(1000 * sum(latencies) / len(latencies), 1) if latencies else 0.0,
+            'p95_latency': round(1000 * collector.p95_latency(), 1),
+            'sql_queries': self.env.cr.sql_log_count - collector.queries_start,
+            'api_calls_detail': json.dumps(collector.calls, indent=1, sort_keys=True),
+            'error': error,
+            'result_ids': json.dumps(collector.result_ids) if collector.result_ids is not None else False,
+        }
+        vals.update(collector.progress_vals())
+        try:
+            with self.env.registry.cursor() as cr:
+                env = self.env(cr=cr)
+                if collector.run_id:
+                    env['shopify.sync.run'].sudo().browse(collector.run_id).write(vals)
+                else:
+                    env['shopify.sync.run'].sudo().create(vals)
+                # Agregados para el endpoint de métricas (/shopify/metrics)
+                metrics = env['shopify.metric.counter'].sudo()
+                metrics._increment(collector.instance, metrics._collector_increments(collector))
+        except Exception:
+            _logger.exception("WSSH No se pudo guardar la ejecución de sincronización %s", collector.operation)
+        _logger.info("WSSH Ejecución %s: %d llamadas, %.1fs de espera por límite, %d consultas SQL en %.1fs",
+                     collector.operation, vals['api_calls'], vals['throttle_sleep'], vals['sql_queries'], duration)
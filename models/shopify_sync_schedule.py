@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+from dateutil.relativedelta import relativedelta
+
+from odoo import api, fields, models, _
+
+import logging
+
+_logger = logging.getLogger(__name__)
+
+# Operaciones completas que se pueden programar (mismos valores que shopify.sync.job.job_type)
+SCHEDULED_OPERATIONS = [
+    ('import_orders', 'Import Orders'),
+    ('import_customers', 'Import Customers'),
+    ('export_products', 'Export Products'),
+    ('export_stock', 'Export Stock'),
+    ('export_customers', 'Export Customers'),
+    ('export_images', 'Export Images'),
+    ('export_prices', 'Export Prices'),
+    ('reconcile_catalog', 'Reconcile Catalog'),
+    ('audit_inventory', 'Audit Inventory'),
+    ('backfill_mappings', 'Backfill Mappings'),
+]
+
+
+class ShopifySyncSchedule(models.Model):
+    _name = 'shopify.sync.schedule'
+    _description = 'Shopify Sync Schedule'
+    _order = 'shopify_instance_id, job_type'
+
+    shopify_instance_id = fields.Many2one('shopify.instance', string="Shopify Instance", required=True,
+                                          ondelete='cascade', index=True)
+    job_type = fields.Selection(SCHEDULED_OPERATIONS, string="Operation", required=True)
+    active = fields.Boolean(default=True)
+    interval_number = fields.Integer(string="Every", default=15, required=True)
+    interval_type = fields.Selection([
+        ('minutes', 'Minutes'),
+        ('hours', 'Hours'),
+        ('days', 'Days'),
+    ], string="Interval Unit", default='minutes', required=True)
+    overlap_policy = fields.Selection([
+        ('skip', 'Skip'),
+        ('queue', 'Queue'),
+    ], string="If Still Running", default='skip', required=True,
+        help="Skip: no se encola una nueva ejecución mientras la anterior esté pendiente o en curso.\n"
+             "Queue: se deja encolada una (única) ejecución más, que arranca en cuanto termine la actual.")
+    nextcall = fields.Datetime(string="Next Execution", default=fields.Datetime.now, required=True)
+    lastcall = fields.Datetime(string="Last Enqueued", readonly=True)
+
+    _sql_constraints = [
+        ('instance_job_type_uniq', 'unique(shopify_instance_id, job_type)',
+         'Solo puede haber una programación por instancia y operación.'),
+        ('interval_positive', 'CHECK(interval_number > 0)', 'El intervalo debe ser positivo.'),
+    ]
+
+    @api.model
+    def _cron_run_schedules(self):
+        """
+        Encola en shopify.sync.job las operaciones programadas que han vencido. Las ejecuciones
+        las hacen los workers de la cola, que impiden con un advisory lock que se solapen dos
+        ejecuciones de la misma operación en la misma instancia (instancias distintas van en paralelo).
+        """
+        now = fields.Datetime.now()
+        schedules = self.search([('nextcall', '<=', now), ('shopify_instance_id.shopify_active', '=', True)])
+        Job = self.env['shopify.sync.job']
+        for schedule in schedules:
+            busy_states = ['pending', 'running'] if schedule.overlap_policy == 'skip' else ['pending']
+            busy = Job.search_count([
+                ('shopify_instance_id', '=', schedule.shopify_instance_id.id),
+                ('job_type', '=', schedule.job_type),
+                ('state', 'in', busy_states),
+            ])
+            if busy and schedule.overlap_policy == 'skip':
+                _logger.info("WSSH %s de %s sigue en curso, se omite esta ejecución",
+                             schedule.job_type, schedule.shopify_instance_id.name)
+            else:
+                # En modo queue el pendiente se fusiona con el existente, nunca se acumulan ejecuciones
+                Job._enqueue(schedule.shopify_instance_id, schedule.job_type)
+                schedule.lastcall = now
+            # Se calcula desde ahora y no desde nextcall para no encadenar ejecuciones atrasadas
+            schedule.nextcall = now + relativedelta(**{schedule.interval_type: schedule.interval_number})
+        return True
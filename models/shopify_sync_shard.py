@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+import json
+import socket
+import uuid
+from collections import defaultdict
+
+import psycopg2
+
+from odoo import api, fields, models, _
+
+import logging
+
+_logger = logging.getLogger(__name__)
+
+# Exportaciones que pueden repartirse en shards y fecha de la instancia que actúa como marca de agua
+SHARDED_OPERATIONS = {
+    'export_products': 'last_export_product',
+    'export_stock': 'last_export_stock',
+}
+
+
+class ShopifySyncShard(models.Model):
+    """
+    Parte de una exportación repartida. La exportación se planifica en un único trabajo, que divide los
+    candidatos por id módulo el número de shards y encola un trabajo export_shard por cada parte; así
+    cualquier worker de cualquier nodo puede reservar un shard con la cola shopify.sync.job.
+    Las marcas de agua y los resultados solo se consolidan cuando han terminado todos los shards del lote.
+    """
+    _name = 'shopify.sync.shard'
+    _description = 'Shopify Sync Shard'
+    _order = 'date_planned desc, batch, shard_index'
+
+    shopify_instance_id = fields.Many2one('shopify.instance', string="Shopify Instance", required=True,
+                                          ondelete='cascade', index=True)
+    operation = fields.Selection([
+        ('export_products', 'Export Products'),
+        ('export_stock', 'Export Stock'),
+    ], string="Operation", required=True)
+    batch = fields.Char(string="Batch", required=True, index=True)
+    shard_index = fields.Integer(string="Shard")
+    shard_count = fields.Integer(string="Shards")
+    date_planned = fields.Datetime(string="Planned")
+    record_ids = fields.Text(string="Records", help="Ids (JSON) de los templates o variantes del shard, en orden de envío.")
+    record_count = fields.Integer(string="Record Count")
+    state = fields.Selection([
+        ('pending', 'Pending'),
+        ('done', 'Done'),
+    ], string="State", default='pending', required=True, index=True)
+    node = fields.Char(string="Node", help="Servidor que ha procesado el shard.")
+    job_id = fields.Many2one('shopify.sync.job', string="Job", ondelete='set null')
+    sync_run_id = fields.Many2one('shopify.sync.run', string="Sync Run", ondelete='set null')
+    watermark = fields.Datetime(string="Watermark",
+                                help="Si el shard no terminó su lista (timeout), fecha hasta la que se ha exportado.")
+    result_ids = fields.Text(string="Result Records")
+    merged = fields.Boolean(string="Merged", default=False)
+
+    def _record_ids(self):
+        self.ensure_one()
+        return json.loads(self.record_ids or '[]')
+
+    def _records(self):
+        model = 'product.template' if self.operation == 'export_products' else 'product.product'
+        return self.env[model].browse(self._record_ids())
+
+    @api.model
+    def _plan(self, instance, operation):
+        """
+        Divide los candidatos de la exportación en instance.export_shard_count partes deterministas
+        (id % N, manteniendo el orden de envío dentro de cada parte) y encola un trabajo por shard.
+
+        :return: shopify.sync.shard creados
+        """
+        Job = self.env['shopify.sync.job']
+        # Mientras quede un lote en curso no se planifica otro: repetiría los mismos registros
+        if self.search_count([('shopify_instance_id', '=', instance.id), ('operation', '=', operation),
+                              ('state', '=', 'pending'), ('job_id.state', 'in', ('pending', 'running'))]):
+            _logger.info("WSSH %s repartida aún en curso para la instancia %s, no se planifica otra", operation, instance.name)
+            return self.browse()
+
+        date_planned = fields.Datetime.now()
+        Template = self.env['product.template']
+        if operation == 'export_products':
+            ids = Template._shopify_export_candidates(instance).ids
+        else:
+            ids = [row[0] for row in Template._shopify_stock_snapshot(instance.last_export_stock)]
+        if not ids:
+            _logger.info("WSSH Nada que exportar en %s para la instancia %s", operation, instance.name)
+            return self.browse()
+
+        shard_count = max(instance.export_shard_count, 1)
+        buckets = defaultdict(list)
+        for record_id in ids:
+            buckets[record_id % shard_count].append(record_id)
+        batch = uuid.uuid4().hex
+        shards = self.create([{
+            'shopify_instance_id': instance.id,
+            'operation': operation,
+            'batch': batch,
+            'shard_index': index,
+            'shard_count': shard_count,
+            'date_planned': date_planned,
+            'record_ids': json.dumps(buckets[index]),
+            'record_count': len(buckets[index]),
+        } for index in sorted(buckets)])
+        for shard in shards:
+            shard.job_id = Job._enqueue(instance, 'export_shard', resource_id=shard.id)
+        _logger.info("WSSH %s de la instancia %s repartida en %d shards (%d registros)",
+                     operation, instance.name, len(shards), len(ids))
+        return shards
+
+    def _run_shard(self):
+        """Procesa el shard compartiendo el presupuesto de llamadas de la instancia y consolida el lote si es el último."""
+        self.ensure_one()
+        if self.state == 'done':
+            return
+        instance = self.shopify_instance_id
+        self.node = socket.gethostname()
+        # shopify_shard: presupuesto de llamadas compartido y lock de la operación en modo compartido
+        Template = self.env['product.template'].with_context(shopify_shard=True)
+        if self.operation == 'export_products':
+            Template.export_products_to_shopify(instance, update=True, shard=self)
+        else:
+            self.result_ids = json.dumps(Template.export_stock_to_shopify(instance, shard=self) or [])
+        self.state = 'done'
+        # El estado se confirma antes de consolidar para que el último shard en terminar vea el lote completo
+        self.env.cr.commit()
+        self._merge_batch()
+
+    def _merge_batch(self):
+        """
+        Si todos los shards del lote han terminado, actualiza la marca de agua de la instancia: la fecha de
+        planificación o, si algún shard se cortó por timeout, la menor de sus marcas. Solo un shard lo hace:
+        el que consigue marcar el lote como consolidado.
+        """
+        self.ensure_one()
+        try:
+            with self.env.cr.savepoint():
+                self.env.cr.execute("""
+                    UPDATE shopify_sync_shard SET merged = true
+                     WHERE batch = %(batch)s AND NOT merged
+                       AND NOT EXISTS (SELECT 1 FROM shopify_sync_shard
+                                        WHERE batch = %(batch)s AND state != 'done')
+                    RETURNING id
+                """, {'batch': self.batch})
+                merged_ids = [row[0] for row in self.env.cr.fetchall()]
+        except psycopg2.errors.SerializationFailure:
+            # Otro shard del lote lo está consolidando a la vez
+            return
+        if not merged_ids:
+            return
+        self.invalidate_model()
+        shards = self.browse(merged_ids)
+        watermarks = [shard.watermark for shard in shards if shard.watermark]
+        watermark = min(watermarks) if watermarks else self.date_planned
+        self.shopify_instance_id.write({SHARDED_OPERATIONS[self.operation]: watermark})
+        runs = shards.sync_run_id
+        _logger.info("WSSH %s repartida en %d shards terminada para la instancia %s: %d enviados, %d omitidos, "
+                     "%d fallidos. Marca de agua %s", self.operation, len(shards), self.shopify_instance_id.name,
+                     sum(runs.mapped('records_sent')), sum(runs.mapped('records_skipped')),
+                     sum(runs.mapped('records_failed')), watermark)
+
+    def action_view_result(self):
+        """Abre las variantes actualizadas por todos los shards del lote."""
+        self.ensure_one()
+        shards = self.search([('batch', '=', self.batch)])
+        ids = [record_id for shard in shards for record_id in json.loads(shard.result_ids or '[]')]
+        action = self.env.ref("pragtech_odoo_shopify_connector.action_product_product_shopify").sudo().read()[0]
+        action["domain"] = [("id", "in", ids)]
+        return action
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+import json
+
+from odoo import api, fields, models, _
+
+import logging
+
+_logger = logging.getLogger(__name__)
+
+# Topics de Shopify que se reciben y, para cada uno, la clave del payload que identifica el recurso
+# y el tipo de trabajo de shopify.sync.job que lo procesa
+WEBHOOK_TOPICS = {
+    'orders/create': ('id', 'order'),
+    'orders/updated': ('id', 'order'),
+    'products/update': ('id', 'product'),
+    'customers/update': ('id', 'customer'),
+    'inventory_levels/update': ('inventory_item_id', 'inventory'),
+}
+
+
+class ShopifyWebhookEvent(models.Model):
+    _name = 'shopify.webhook.event'
+    _description = 'Shopify Webhook Event'
+    _order = 'id desc'
+
+    shopify_instance_id = fields.Many2one('shopify.instance', string="Shopify Instance", required=True,
+                                          ondelete='cascade', index=True)
+    topic = fields.Char(string="Topic", required=True, index=True)
+    webhook_id = fields.Char(string="Webhook ID", index=True, help="Cabecera X-Shopify-Webhook-Id, usada para descartar reenvíos.")
+    resource_id = fields.Char(string="Resource ID", index=True)
+    payload = fields.Text(string="Payload")
+    received_at = fields.Datetime(string="Received At", default=fields.Datetime.now, readonly=True)
+    state = fields.Selection([
+        ('pending', 'Pending'),
+        ('queued', 'Queued'),
+        ('done', 'Done'),
+        ('error', 'Error'),
+    ], string="State", default='pending', index=True)
+    job_id = fields.Many2one('shopify.sync.job', string="Sync Job", ondelete='set null', index=True, readonly=True,
+                             help="Trabajo que procesa el webhook; al terminar pasa el evento a hecho o error.")
+
+    # Shopify reenvía el mismo X-Shopify-Webhook-Id si no recibe respuesta a tiempo: solo se guarda uno
+    _sql_constraints = [
+        ('instance_webhook_uniq', 'unique(shopify_instance_id, webhook_id)',
+         'El webhook ya se ha recibido para esta instancia.'),
+    ]
+
+    @api.model
+    def _store_webhook(self, shopify_instance, topic, webhook_id, raw_payload):
+        """
+        Guarda el payload recibido tal cual y lo encola en shopify.sync.job, sin procesarlo,
+        para poder responder a Shopify inmediatamente. Los reenvíos de un mismo
+        X-Shopify-Webhook-Id se ignoran: el índice único descarta también los que llegan a la vez.
+        """
+        payload = raw_payload.decode('utf-8')
+        resource_key, job_type = WEBHOOK_TOPICS[topic]
+        resource_id = False
+        try:
+            resource_id = json.loads(payload).get(resource_key)
+        except ValueError:
+            _logger.warning("WSSH Webhook %s con payload no JSON", topic)
+        self.env.cr.execute("""
+            INSERT INTO shopify_webhook_event
+                (shopify_instance_id, topic, webhook_id, resource_id, payload, received_at, state,
+                 create_uid, write_uid, create_date, write_date)
+            VALUES (%s, %s, %s, %s, %s, now() at time zone 'UTC', %s, %s, %s,
+                    now() at time zone 'UTC', now() at time zone 'UTC')
+            ON CONFLICT (shopify_instance_id, webhook_id) DO NOTHING
+            RETURNING id
+        """, (shopify_instance.id, topic, webhook_id or None, str(resource_id) if resource_id else None, payload,
+              'queued' if resource_id else 'error', self.env.uid, self.env.uid))
+        row = self.env.cr.fetchone()
+        if not row:
+            _logger.info("WSSH Webhook %s %s duplicado, se ignora", topic, webhook_id)
+            return self.browse()
+        event = self.browse(row[0])
+        if resource_id:
+            event.job_id = self.env['shopify.sync.job']._enqueue(shopify_instance, job_type, resource_id, payload,
+                                                                 priority=5)
+        return event
@@ -1,13 +1,25 @@
+import base64
+import hashlib
+import hmac
 import json
 
 import requests,re
+from dateutil import parser
+from datetime import timezone
 from odoo import api, fields, models, _
 from odoo.exceptions import UserError
 
+from .shopify_webhook import WEBHOOK_TOPICS
+from .shopify_sync_run import current_collector, shopify_http_request, throttle_sleep
+
 import logging
 
 _logger = logging.getLogger(__name__)
 
+# Reintentos de una página de un listado tras un 429 (Retry-After) antes de dar el listado por fallido
+PAGE_MAX_RETRIES = 5
+
+
 class ShopifyInstance(models.Model):
     _inherit = 'shopify.instance'
 
@@ -17,7 +29,118 @@ class ShopifyInstance(models.Model):
     split_products_by_color = fields.Boolean(string="Split Products by Color", default=False)
     color_option_position = fields.Integer(string="Color Option Position", default=1, help="Define en qué opción de Shopify se mapeará el color (por defecto, en la opción 1).")
     size_option_position = fields.Integer(string="Size Option Position", default=2, help="Define en qué opción de Shopify se mapeará la talla (por defecto, en la opción 2).")
-    
+    shopify_webhook_secret = fields.Char(string="Webhook Secret", groups="base.group_system",
+                                         help="Clave secreta de la app de Shopify con la que se firman los webhooks (HMAC-SHA256).")
+    profile_next_run = fields.Boolean(string="Profile Next Run", copy=False,
+                                      help="Perfila la próxima exportación de productos/stock o importación de pedidos/clientes "
+                                           "y guarda el resultado como adjunto de la instancia.")
+    sync_run_ids = fields.One2many('shopify.sync.run', 'shopify_instance_id', string="Sync Runs")
+    sync_schedule_ids = fields.One2many('shopify.sync.schedule', 'shopify_instance_id', string="Sync Schedules")
+    image_upload_workers = fields.Integer(string="Image Upload Workers", default=4,
+                                          help="Número de imágenes que se suben a Shopify en paralelo.")
+    export_shard_count = fields.Integer(string="Export Shards", default=1,
+                                        help="Con más de 1, las exportaciones de productos y stock se reparten en este número "
+                                             "de shards que cualquier nodo puede procesar en paralelo.")
+    webhook_event_count = fields.Integer(string="Webhook Events", compute='_compute_webhook_event_count')
+
+    def _compute_webhook_event_count(self):
+        groups = self.env['shopify.webhook.event'].sudo().read_group(
+            [('shopify_instance_id', 'in', self.ids)],
+            ['shopify_instance_id'], ['shopify_instance_id'], lazy=False)
+        counts = {group['shopify_instance_id'][0]: group['__count'] for group in groups}
+        for instance in self:
+            instance.webhook_event_count = counts.get(instance.id, 0)
+
+    def _verify_webhook_hmac(self, raw_payload, hmac_header):
+        """Comprueba la firma X-Shopify-Hmac-Sha256 del payload con la clave secreta de la instancia."""
+        self.ensure_one()
+        secret = self.sudo().shopify_webhook_secret
+        if not secret or not hmac_header:
+            return False
+        digest = hmac.new(secret.encode('utf-8'), raw_payload, hashlib.sha256).digest()
+        return hmac.compare_digest(base64.b64encode(digest), hmac_header.encode('utf-8'))
+
+    def action_register_shopify_webhooks(self):
+        """Da de alta en Shopify los webhooks que atiende este módulo apuntando a /shopify/webhook/<id>."""
+        base_url = self.env['ir.config_parameter'].sudo().get_param('web.base.url')
+        for instance in self:
+            url = self.env['product.template'].get_products_url(instance, 'webhooks.json')
+            headers = {
+                "X-Shopify-Access-Token": instance.shopify_shared_secret,
+                "Content-Type": "application/json"
+            }
+            address = f"{base_url}/shopify/webhook/{instance.id}"
+            for topic in WEBHOOK_TOPICS:
+                payload = {"webhook": {"topic": topic, "address": address, "format": "json"}}
+                response = instance._shopify_request('POST', url, headers=headers, data=json.dumps(payload))
+                if response.ok:
+                    _logger.info("WSSH Webhook %s registrado en %s", topic, address)
+                elif response.status_code == 422:
+                    # Shopify devuelve 422 si el webhook ya existe para esa dirección
+                    _logger.info("WSSH Webhook %s ya registrado: %s", topic, response.text)
+                else:
+                    raise UserError(_("WSSH Error registrando el webhook %s: %s") % (topic, response.text))
+        return True
+
+    def _cron_enqueue_sync_jobs(self, job_types):
+        """Punto de entrada para crons: encola los trabajos indicados en todas las instancias activas."""
+        instances = self or self.search([('shopify_active', '=', True)])
+        for instance in instances:
+            for job_type in job_types:
+                self.env['shopify.sync.job']._enqueue(instance, job_type)
+        return True
+
+    def action_push_shopify_prices(self):
+        """Encola con prioridad el envío rápido de precios (solo variantes con precio cambiado)."""
+        for instance in self:
+            self.env['shopify.sync.job']._enqueue(instance, 'export_prices', priority=1)
+        return True
+
+    def action_backfill_id_map(self):
+        for instance in self:
+            self.env['shopify.id.map']._backfill(instance)
+        return True
+
+    def action_backfill_variant_mappings(self):
+        """Encola la recuperación de IDs de variantes e inventory items desde Shopify."""
+        for instance in self:
+            self.env['shopify.sync.job']._enqueue(instance, 'backfill_mappings', priority=1)
+        return True
+
+    def action_view_profiles(self):
+        self.ensure_one()
+        return {
+            'type': 'ir.actions.act_window',
+            'name': _('Sync Profiles'),
+            'res_model': 'ir.attachment',
+            'view_mode': 'tree,form',
+            'domain': [('res_model', '=', 'shopify.instance'), ('res_id', '=', self.id),
+                       ('name', '=like', 'shopify_profile_%')],
+        }
+
+    def action_view_export_shards(self):
+        self.ensure_one()
+        action = self.env.ref('ws_shopify_split_color.action_shopify_sync_shard').sudo().read()[0]
+        action['domain'] = [('shopify_instance_id', '=', self.id)]
+        return action
+
+    def action_view_drift_reports(self):
+        self.ensure_one()
+        return {
+            'type': 'ir.actions.act_window',
+            'name': _('Drift Reports'),
+            'res_model': 'ir.attachment',
+            'view_mode': 'tree,form',
+            'domain': [('res_model', '=', 'shopify.instance'), ('res_id', '=', self.id),
+                       ('name', '=like', 'shopify_drift_%')],
+        }
+
+    def action_view_webhook_events(self):
+        self.ensure_one()
+        action = self.env.ref('ws_shopify_split_color.action_shopify_webhook_event').sudo().read()[0]
+        action['domain'] = [('shopify_instance_id', '=', self.id)]
+        return action
+
     def _parse_link_header(self,link_header):
         # Busca patrones del tipo:
         # <URL>; rel="next", <URL>; rel="previous", etc.
@@ -27,8 +150,78 @@ class ShopifyInstance(models.Model):
         links = {}
         for url, rel in matches:
             links[rel] = url
-        return links    
-        
+        return links
+
+    def _get_shopify_api_url(self, endpoint):
+        """
+        URL de la Admin API para el endpoint indicado. El parámetro de sistema
+        ws_shopify_split_color.api_base_url permite apuntar a otra URL base (p.ej. el servidor
+        simulado de tools/shopify_mock_server.py para pruebas y benchmarks).
+        """
+        self.ensure_one()
+        base_url = self.env['ir.config_parameter'].sudo().get_param('ws_shopify_split_color.api_base_url')
+        if base_url:
+            return "{}/admin/api/{}/{}".format(base_url.rstrip('/'), self.shopify_version, endpoint)
+        return "https://{}.myshopify.com/admin/api/{}/{}".format(self.shopify_host, self.shopify_version, endpoint)
+
+    def _shopify_request(self, method, url, **kwargs):
+        """
+        Punto único de salida de las llamadas HTTP a Shopify. Mide la latencia y, si hay una
+        ejecución de sincronización en curso, la registra junto con el endpoint y el estado.
+        """
+        collector = kwargs.pop('collector', None) or current_collector()
+        return shopify_http_request(method, url, collector=collector, **kwargs)
+
+    def _iter_shopify_pages(self, url, params, resource_key):
+        """
+        Recorre un listado paginado de Shopify siguiendo la cabecera Link (rel="next").
+        Devuelve cada página por separado (lista de dicts) para que el llamante pueda
+        procesarla y hacer commit sin acumular todo el listado en memoria.
+        Los 429 se reintentan (PAGE_MAX_RETRIES veces) esperando lo que indica Retry-After; cualquier
+        otro error lanza UserError, de modo que el listado nunca se da por completo si no lo está.
+        """
+        self.ensure_one()
+        headers = {
+            "X-Shopify-Access-Token": self.shopify_shared_secret,
+        }
+        while url:
+            response = self._get_shopify_page(url, headers, params)
+            if response.status_code != 200 or not response.content:
+                _logger.warning("WSSH Error %s paginando %s: %s", response.status_code, url, response.text)
+                raise UserError(_("WSSH Listado de Shopify incompleto (%s) en %s: %s")
+                                % (response.status_code, url, response.text[:500]))
+            yield response.json().get(resource_key, [])
+            # Shopify solo admite page_info (incluido en la URL next) a partir de la segunda página
+            links = self._parse_link_header(response.headers.get('Link') or '')
+            url = links.get('next')
+            params = None
+
+    def _get_shopify_page(self, url, headers, params):
+        """GET de una página; tras un 429 espera Retry-After (en el limitador compartido si lo hay) y reintenta."""
+        for attempt in range(PAGE_MAX_RETRIES):
+            response = self._shopify_request('GET', url, headers=headers, params=params)
+            if response.status_code != 429:
+                break
+            retry_after = float(response.headers.get('Retry-After') or 2)
+            _logger.info("WSSH 429 paginando %s, reintento %d en %.1f s", url, attempt + 1, retry_after)
+            collector = current_collector()
+            # Con limitador compartido _shopify_request ya ha retrasado el siguiente hueco de todos los nodos
+            if collector is None or not collector.rate_limiter:
+                throttle_sleep(retry_after)
+        return response
+
+    def _shopify_datetime_param(self, value):
+        """Formatea un Datetime de Odoo (UTC naive) como parámetro ISO 8601 para Shopify."""
+        if not value or isinstance(value, str):
+            return value
+        return value.strftime('%Y-%m-%dT%H:%M:%S+00:00')
+
+    def _shopify_parse_datetime(self, value):
+        """Convierte una fecha ISO 8601 de Shopify a Datetime de Odoo (UTC naive)."""
+        if not value:
+            return False
+        return parser.isoparse(value).astimezone(timezone.utc).replace(tzinfo=None)
+
     def clean_string(self,text):
         """
         Elimina los backslashes que generan secuencias de escape no deseadas,
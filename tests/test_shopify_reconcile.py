@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+import json
+from unittest.mock import Mock, patch
+
+from odoo.exceptions import UserError
+from odoo.tests.common import TransactionCase, tagged
+
+SHOPINSTANCE = 'odoo.addons.ws_shopify_split_color.models.shopinstance'
+
+
+def _response(status_code, products=None, next_url=None):
+    body = json.dumps({'products': products or []}).encode() if status_code == 200 else b'error'
+    return Mock(status_code=status_code, ok=status_code == 200, content=body, text=body.decode(),
+                headers={'Link': f'<{next_url}>; rel="next"'} if next_url else {},
+                json=lambda: json.loads(body))
+
+
+@tagged('post_install', '-at_install')
+class TestShopifyReconcile(TransactionCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        # _track guarda la ejecución en un cursor aparte: en modo test comparte la transacción del test
+        cls.registry.enter_test_mode(cls.cr)
+        cls.addClassCleanup(cls.registry.leave_test_mode)
+        Instance = cls.env['shopify.instance'].sudo()
+        cls.instance = Instance.create({
+            'name': 'Reconcile Shop',
+            'shopify_host': 'reconcile',
+            'shopify_version': '2024-01',
+            'shopify_shared_secret': 'token',
+            'shopify_active': True,
+            'split_products_by_color': False,
+        })
+        cls.other_instance = Instance.create({
+            'name': 'Other Shop',
+            'shopify_host': 'other',
+            'shopify_version': '2024-01',
+            'shopify_shared_secret': 'token',
+            'shopify_active': True,
+            'split_products_by_color': False,
+        })
+        Template = cls.env['product.template']
+        cls.first = Template.create({'name': 'First', 'shopify_product_id': '111',
+                                     'shopify_instance_id': cls.instance.id})
+        cls.second = Template.create({'name': 'Second', 'shopify_product_id': '222',
+                                      'shopify_instance_id': cls.instance.id})
+        cls.foreign = Template.create({'name': 'Foreign', 'shopify_product_id': '333',
+                                       'shopify_instance_id': cls.other_instance.id})
+        cls.second.product_variant_ids.write({'shopify_variant_id': '2221', 'shopify_inventory_item_id': '2222'})
+
+    def test_failed_page_keeps_mappings(self):
+        """Si la segunda página falla, no se informa nada como ausente ni se toca ningún mapping."""
+        responses = iter([
+            _response(200, [{'id': 111, 'title': 'First', 'variants': []}], next_url='https://reconcile/page2'),
+            _response(500),
+        ])
+        with patch(f'{SHOPINSTANCE}.shopify_http_request', side_effect=lambda *args, **kwargs: next(responses)), \
+                self.assertRaises(UserError):
+            self.env['product.template'].reconcile_catalog_with_shopify(self.instance)
+        self.assertEqual(self.second.shopify_product_id, '222')
+        self.assertEqual(self.second.product_variant_ids.shopify_variant_id, '2221')
+        self.assertEqual(self.second.product_variant_ids.shopify_inventory_item_id, '2222')
+        run = self.env['shopify.sync.run'].search([('shopify_instance_id', '=', self.instance.id),
+                                                   ('operation', '=', 'reconcile_catalog')], limit=1)
+        self.assertEqual(run.state, 'failed')
+        self.assertFalse(self.env['shopify.sync.job'].search([('shopify_instance_id', '=', self.instance.id),
+                                                                ('job_type', '=', 'export_products')]))
+
+    def test_checksums_only_include_instance_products(self):
+        expected = self.env['product.template']._shopify_catalog_checksums(self.instance)
+        self.assertEqual(set(expected), {'111', '222'})
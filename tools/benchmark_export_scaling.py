@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks de escalado del exportador con la capa HTTP simulada.
+
+Para cada tamaño de catálogo (BENCH_SIZES, por defecto 1000,10000,100000 templates) genera
+un catálogo sintético con tools/catalog_generator.py y mide, por fase, tiempo, pico de RSS
+y número de consultas SQL:
+  - plan: búsqueda de candidatos y agrupación por color,
+  - payload: _prepare_shopify_variant_data y payloads de producto (serializados a JSON),
+  - export_stock: export_stock_to_shopify con requests y time.sleep sustituidos.
+
+Los resultados se escriben en JSON (BENCH_OUTPUT) para compararlos entre versiones.
+Usar una base de datos desechable:
+
+    BENCH_SIZES=1000,10000 BENCH_OUTPUT=bench.json odoo-bin shell -d bench_db --no-http \\
+        < tools/benchmark_export_scaling.py
+"""
+import json
+import os
+import resource
+import sys
+import time
+from unittest import mock
+
+from odoo.addons.ws_shopify_split_color.tools.catalog_generator import generate_catalog
+
+
+class _FakeResponse(object):
+    status_code = 200
+    ok = True
+    text = '{}'
+    content = b'{}'
+    headers = {}
+
+    def json(self):
+        return {}
+
+
+def _measure(env, func):
+    """Ejecuta func y devuelve (resultado, métricas)."""
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    queries_before = env.cr.sql_log_count
+    start = time.perf_counter()
+    result = func()
+    metrics = {
+        'wall_time': round(time.perf_counter() - start, 3),
+        'sql_queries': env.cr.sql_log_count - queries_before,
+        # ru_maxrss es el pico del proceso (KB en Linux): se informa el pico absoluto y su crecimiento
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'peak_rss_growth_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_before,
+    }
+    return result, metrics
+
+
+def _plan(env, instance, templates):
+    Template = env['product.template']
+    candidates = Template.search([('id', 'in', templates.ids), ('is_published', '=', True)],
+                                 order='is_shopify_product,create_date')
+    # Igual que export_products_to_shopify: sin split por colores no se busca la línea de color
+    return [(product, instance.split_products_by_color and Template._get_shopify_color_line(product))
+            for product in candidates]
+
+
+def _build_payloads(env, instance, plan):
+    Template = env['product.template']
+    size = 0
+    for product, color_line in plan:
+        if color_line:
+            for unit in Template._plan_shopify_color_units(product, color_line, instance, False):
+                size += len(json.dumps(unit[3]))
+        else:
+            product_data = Template._prepare_shopify_single_product_data(product)
+            product_data['product']['variants'] = [
+                Template._prepare_shopify_variant_data(variant, instance)
+                for variant in product.product_variant_ids if variant.default_code
+            ]
+            size += len(json.dumps(product_data))
+    return size
+
+
+def run_size(env, instance, templates, colors, sizes, locations):
+    catalog = generate_catalog(env, templates=templates, colors=colors, sizes=sizes, locations=locations,
+                               prefix=f'BENCH{templates}')
+    env.invalidate_all()
+    result = {'templates': templates, 'variants': catalog['variants']}
+    plan, result['plan'] = _measure(env, lambda: _plan(env, instance, catalog['templates']))
+    result['payload_bytes'], result['payload'] = _measure(env, lambda: _build_payloads(env, instance, plan))
+    # Los variants generados no tienen inventory_item_id: se asigna uno ficticio para que el stock entre en juego
+    catalog['templates'].product_variant_ids.write({'shopify_inventory_item_id': '1'})
+    instance.last_export_stock = False
+    env.invalidate_all()
+    module = 'odoo.addons.ws_shopify_split_color.models'
+    with mock.patch(f'{module}.shopinstance.requests.request', return_value=_FakeResponse()), \
+            mock.patch(f'{module}.shopify_sync_run.time.sleep'):
+        updated, result['export_stock'] = _measure(
+            env, lambda: env['product.template'].export_stock_to_shopify(instance))
+    result['stock_items_sent'] = len(updated)
+    env.cr.rollback()
+    return result
+
+
+def main(env):
+    sizes = [int(size) for size in os.environ.get('BENCH_SIZES', '1000,10000,100000').split(',')]
+    instance = env['shopify.instance'].sudo().search([], limit=1)
+    if not instance:
+        print("Se necesita al menos una shopify.instance configurada")
+        return 1
+    instance.split_products_by_color = os.environ.get('BENCH_SPLIT', '1') == '1'
+    results = [
+        run_size(env, instance, size,
+                 int(os.environ.get('BENCH_COLORS', 4)), int(os.environ.get('BENCH_SIZES_PER_COLOR', 5)),
+                 int(os.environ.get('BENCH_LOCATIONS', 3)))
+        for size in sizes
+    ]
+    output = json.dumps(results, indent=2)
+    print(output)
+    if os.environ.get('BENCH_OUTPUT'):
+        with open(os.environ['BENCH_OUTPUT'], 'w') as output_file:
+            output_file.write(output)
+    return 0
+
+
+if 'env' in globals():
+    sys.exit(main(env))
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark de las sincronizaciones contra el servidor simulado de tools/shopify_mock_server.py.
+
+Para cada operación mide llamadas a la API (según /_mock/stats), consultas SQL y tiempo,
+normalizados por cada 1000 registros, y falla si las llamadas a la API superan las de
+tools/benchmark_baseline.json (con un margen de BENCH_TOLERANCE, 10% por defecto).
+
+Las importaciones hacen commit por página: usar siempre una base de datos desechable.
+
+Uso:
+    python tools/shopify_mock_server.py --port 8765 --orders 1000 --customers 1000 &
+    MOCK_URL=http://127.0.0.1:8765 odoo-bin shell -d bench_db --no-http < tools/benchmark_sync.py
+
+Variables de entorno: MOCK_URL, BENCH_OPERATIONS (lista separada por comas),
+BENCH_BASELINE, BENCH_OUTPUT (fichero JSON de resultados), BENCH_TOLERANCE.
+"""
+import json
+import os
+import sys
+import time
+import urllib.request
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_baseline.json')
+
+
+def _mock_call(base_url, path, method='GET'):
+    request = urllib.request.Request(base_url.rstrip('/') + path, method=method, data=b'' if method == 'POST' else None)
+    with urllib.request.urlopen(request) as response:
+        return json.loads(response.read())
+
+
+def _exported_templates(env, instance):
+    return env['product.template'].search_count([('shopify_instance_id', '=', instance.id), ('is_exported', '=', True)])
+
+
+# nombre -> (operación, función opcional que cuenta los registros afectados cuando la operación no los devuelve)
+OPERATIONS = {
+    'import_customers': (lambda env, instance: env['res.partner'].import_shopify_customers(instance, False), None),
+    'import_products': (lambda env, instance: env['product.template'].import_shopify_products(instance, True, False, False), None),
+    'import_orders': (lambda env, instance: env['sale.order'].import_shopify_orders(instance, False, False, False), None),
+    'export_stock': (lambda env, instance: env['product.template'].export_stock_to_shopify(instance), None),
+    'export_products': (lambda env, instance: env['product.template'].export_products_to_shopify(instance, update=True),
+                        _exported_templates),
+}
+
+
+def get_mock_instance(env, base_url):
+    env['ir.config_parameter'].sudo().set_param('ws_shopify_split_color.api_base_url', base_url)
+    instance = env['shopify.instance'].sudo().search([('name', '=', 'Mock Shopify')], limit=1)
+    if not instance:
+        instance = env['shopify.instance'].sudo().create({
+            'name': 'Mock Shopify',
+            'shopify_host': 'mock',
+            'shopify_version': '2024-01',
+            'shopify_shared_secret': 'mock-token',
+            'shopify_active': True,
+        })
+    return instance
+
+
+def run_benchmarks(env, base_url, operations=None):
+    instance = get_mock_instance(env, base_url)
+    results = {}
+    for name in operations or OPERATIONS:
+        operation, counter = OPERATIONS[name]
+        before = counter(env, instance) if counter else 0
+        _mock_call(base_url, '/_mock/reset', 'POST')
+        queries_before = env.cr.sql_log_count
+        start = time.perf_counter()
+        records = operation(env, instance)
+        wall_time = time.perf_counter() - start
+        sql_queries = env.cr.sql_log_count - queries_before
+        stats = _mock_call(base_url, '/_mock/stats')
+        count = counter(env, instance) - before if counter else len(records or [])
+        factor = 1000.0 / count if count else 0.0
+        results[name] = {
+            'records': count,
+            'api_calls': stats['total'],
+            'throttled': stats['throttled'],
+            'endpoints': stats['endpoints'],
+            'sql_queries': sql_queries,
+            'wall_time': round(wall_time, 3),
+            'api_calls_per_1k': round(stats['total'] * factor, 2),
+            'sql_queries_per_1k': round(sql_queries * factor, 2),
+            'wall_time_per_1k': round(wall_time * factor, 3),
+        }
+        env.cr.commit()
+    return results
+
+
+def check_regressions(results, baseline, tolerance=0.10):
+    """Devuelve la lista de operaciones cuyas llamadas a la API por 1k registros superan la referencia."""
+    failures = []
+    for name, result in results.items():
+        limit = baseline.get(name, {}).get('api_calls_per_1k')
+        if limit is not None and result['records'] and result['api_calls_per_1k'] > limit * (1 + tolerance):
+            failures.append(f"{name}: {result['api_calls_per_1k']} llamadas/1k > referencia {limit}")
+    return failures
+
+
+def main(env):
+    base_url = os.environ.get('MOCK_URL', 'http://127.0.0.1:8765')
+    operations = [op for op in os.environ.get('BENCH_OPERATIONS', '').split(',') if op] or None
+    results = run_benchmarks(env, base_url, operations)
+    output = json.dumps(results, indent=2, sort_keys=True)
+    print(output)
+    if os.environ.get('BENCH_OUTPUT'):
+        with open(os.environ['BENCH_OUTPUT'], 'w') as output_file:
+            output_file.write(output)
+    with open(os.environ.get('BENCH_BASELINE', BASELINE_PATH)) as baseline_file:
+        baseline = json.load(baseline_file)
+    failures = check_regressions(results, baseline, float(os.environ.get('BENCH_TOLERANCE', '0.10')))
+    for failure in failures:
+        print("REGRESIÓN", failure)
+    return 1 if failures else 0
+
+
+if 'env' in globals():
+    # Ejecutado desde odoo-bin shell
+    sys.exit(main(env))
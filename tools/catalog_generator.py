@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+"""
+Generador de catálogos sintéticos para medir el exportador sin copiar datos de producción.
+
+Crea templates publicados con atributos Color × Talla, reparte stock entre varias ubicaciones
+internas y genera partners con duplicados realistas (mismo email con distinta capitalización,
+mismo teléfono, sin nombre) junto con pedidos en formato JSON de Shopify que los referencian.
+
+Se usa desde odoo-bin shell (con una base de datos desechable):
+
+    from odoo.addons.ws_shopify_split_color.tools.catalog_generator import generate_catalog
+    generate_catalog(env, templates=1000, colors=4, sizes=5)
+
+o mediante tools/benchmark_export_scaling.py.
+"""
+import random
+
+BATCH_SIZE = 500
+
+
+def _get_attribute(env, name, count):
+    attribute = env['product.attribute'].search([('name', '=', name)], limit=1)
+    if not attribute:
+        attribute = env['product.attribute'].create({'name': name, 'create_variant': 'always'})
+    existing = len(attribute.value_ids)
+    if existing < count:
+        env['product.attribute.value'].create([
+            {'attribute_id': attribute.id, 'name': f'{name} {i}'} for i in range(existing, count)
+        ])
+    return attribute, attribute.value_ids[:count]
+
+
+def generate_templates(env, templates, colors, sizes, prefix='BENCH', seed=0):
+    """Crea los templates en bloques y asigna un default_code único a cada variante."""
+    rng = random.Random(seed)
+    color_attribute, color_values = _get_attribute(env, 'Color', colors)
+    size_attribute, size_values = _get_attribute(env, 'Talla', sizes)
+    tag = env['product.tag'].search([('name', '=', prefix)], limit=1) or env['product.tag'].create({'name': prefix})
+    created = env['product.template']
+    for start in range(0, templates, BATCH_SIZE):
+        vals_list = []
+        for index in range(start, min(start + BATCH_SIZE, templates)):
+            vals_list.append({
+                'name': f'{prefix} Product {index}',
+                'detailed_type': 'product',
+                'is_published': True,
+                'list_price': round(rng.uniform(5, 150), 2),
+                'description': f'<p>{prefix} description {index}</p>',
+                'product_tag_ids': [(6, 0, tag.ids)],
+                'attribute_line_ids': [
+                    (0, 0, {'attribute_id': color_attribute.id, 'value_ids': [(6, 0, color_values.ids)]}),
+                    (0, 0, {'attribute_id': size_attribute.id, 'value_ids': [(6, 0, size_values.ids)]}),
+                ],
+            })
+        batch = env['product.template'].create(vals_list)
+        for variant in batch.product_variant_ids:
+            variant.default_code = f'{prefix}-{variant.product_tmpl_id.id}-{variant.id}'
+        created |= batch
+        env.cr.commit()
+        env.invalidate_all()
+    return created
+
+
+def generate_quants(env, variants, locations=3, seed=0):
+    """Reparte stock aleatorio de cada variante entre varias ubicaciones internas."""
+    rng = random.Random(seed)
+    warehouse = env['stock.warehouse'].search([], limit=1)
+    parent = warehouse.lot_stock_id
+    location_ids = env['stock.location'].search([('location_id', '=', parent.id), ('name', '=like', 'BENCH%')]).ids
+    for index in range(len(location_ids), locations):
+        location_ids.append(env['stock.location'].create({'name': f'BENCH {index}', 'location_id': parent.id}).id)
+    Quant = env['stock.quant'].sudo()
+    for start in range(0, len(variants), BATCH_SIZE):
+        for variant in variants[start:start + BATCH_SIZE]:
+            for location_id in rng.sample(location_ids, rng.randint(1, len(location_ids))):
+                Quant._update_available_quantity(variant, env['stock.location'].browse(location_id), rng.randint(0, 50))
+        env.cr.commit()
+        env.invalidate_all()
+
+
+def generate_partners(env, partners, duplicate_rate=0.1, prefix='BENCH', seed=0):
+    """
+    Crea partners y devuelve la lista de clientes en formato Shopify. Un porcentaje
+    (duplicate_rate) son duplicados: mismo email en mayúsculas, mismo teléfono o sin nombre.
+    """
+    rng = random.Random(seed)
+    customers = []
+    vals_list = []
+    for index in range(partners):
+        email = f'{prefix.lower()}{index}@example.com'
+        phone = f'+34 600 {index:06d}'
+        first_name, last_name = f'Name{index}', f'Surname{index}'
+        if customers and rng.random() < duplicate_rate:
+            original = rng.choice(customers)
+            kind = rng.choice(('email_case', 'phone', 'anonymous'))
+            if kind == 'email_case':
+                email = original['email'].upper()
+            elif kind == 'phone':
+                phone = original['phone']
+            else:
+                first_name = last_name = None
+        customer = {'id': 7 * 10 ** 9 + index, 'email': email, 'phone': phone,
+                    'first_name': first_name, 'last_name': last_name,
+                    'default_address': {'address1': f'Calle {index}', 'city': 'Madrid', 'zip': '28001',
+                                        'country_code': 'ES'}}
+        customers.append(customer)
+        vals_list.append({'name': f'{first_name or ""} {last_name or ""}'.strip() or email,
+                          'email': email, 'phone': phone, 'customer_rank': 1})
+    for start in range(0, len(vals_list), BATCH_SIZE):
+        env['res.partner'].create(vals_list[start:start + BATCH_SIZE])
+        env.cr.commit()
+    return customers
+
+
+def generate_orders(variants, customers, orders, lines_per_order=6, seed=0):
+    """Genera pedidos en formato JSON de Shopify; algunos repiten cliente y variantes."""
+    rng = random.Random(seed)
+    variant_list = [(variant.default_code, variant.shopify_variant_id) for variant in variants]
+    result = []
+    for index in range(orders):
+        line_items = []
+        for sku, variant_id in rng.sample(variant_list, min(lines_per_order, len(variant_list))):
+            line_items.append({
+                'variant_id': variant_id, 'title': sku, 'quantity': rng.randint(1, 3),
+                'price': '29.95', 'total_discount': '0.00',
+                'tax_lines': [{'title': 'IVA 21%', 'rate': 0.21, 'price': '5.20'}],
+            })
+        updated_at = f'2024-01-01T{(index // 3600) % 24:02d}:{(index // 60) % 60:02d}:{index % 60:02d}+00:00'
+        result.append({
+            'id': 8 * 10 ** 9 + index, 'name': f'#B{index}', 'order_number': index, 'status': 'open',
+            'created_at': updated_at, 'updated_at': updated_at, 'total_price': '100.00',
+            'customer': rng.choice(customers) if customers else None,
+            'line_items': line_items,
+            'shipping_lines': [{'title': 'Standard', 'price': '4.95'}],
+        })
+    return result
+
+
+def generate_catalog(env, templates=1000, colors=4, sizes=5, locations=3, partners=0, orders=0,
+                     duplicate_rate=0.1, prefix='BENCH', seed=0):
+    """Genera el catálogo completo y devuelve un resumen con los registros creados."""
+    created = generate_templates(env, templates, colors, sizes, prefix, seed)
+    variants = created.product_variant_ids
+    if locations:
+        generate_quants(env, variants, locations, seed)
+    customers = generate_partners(env, partners, duplicate_rate, prefix, seed) if partners else []
+    shopify_orders = generate_orders(variants, customers, orders, seed=seed) if orders else []
+    return {
+        'templates': created,
+        'variants': len(variants),
+        'customers': customers,
+        'orders': shopify_orders,
+    }
@@ -0,0 +1,350 @@
+# -*- coding: utf-8 -*-
+"""
+Servidor local que imita la Admin REST API de Shopify para medir las sincronizaciones
+sin tocar una tienda real.
+
+Uso:
+    python tools/shopify_mock_server.py --port 8765 --products 1000 --customers 1000 --orders 1000
+
+y en Odoo:
+    ir.config_parameter  ws_shopify_split_color.api_base_url = http://127.0.0.1:8765
+
+Implementa:
+  - Listados paginados por cursor (page_info + cabecera Link) de products, customers,
+    orders, draft_orders, inventory_levels y variants.
+  - Alta/actualización de productos y variantes, inventory_levels/set y webhooks.
+  - Cabecera X-Shopify-Shop-Api-Call-Limit con un leaky bucket de 40 llamadas a 2/s.
+  - Respuestas 429 inyectables (--throttle-every N o POST /_mock/config).
+  - GET /_mock/stats con el número de llamadas por método y endpoint; POST /_mock/reset.
+"""
+import argparse
+import base64
+import json
+import re
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs, urlencode
+
+API_PATH = re.compile(r'^/admin/api/[^/]+/(?P<endpoint>.+)\.json$')
+BUCKET_SIZE = 40
+LEAK_RATE = 2.0
+
+
+class MockShop(object):
+    """Estado en memoria de la tienda simulada."""
+
+    def __init__(self, products=100, variants_per_product=6, customers=100, orders=100, draft_orders=10,
+                 location_id=1000001, throttle_every=0):
+        self.lock = threading.Lock()
+        self.location_id = location_id
+        self.throttle_every = throttle_every
+        self.next_id = 10 ** 9
+        self.reset_stats()
+        self.bucket = 0.0
+        self.bucket_time = time.time()
+        base_date = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+        self.products = {}
+        self.variants = {}
+        self.inventory_levels = {}
+        for p in range(products):
+            product_id = self._new_id()
+            product = {
+                'id': product_id,
+                'title': f'Product {p}',
+                'body_html': f'<p>Description {p}</p>',
+                'tags': 'mock',
+                'status': 'active',
+                'updated_at': (base_date + timedelta(minutes=p)).isoformat(),
+                'options': [{'name': 'Color'}, {'name': 'Size'}],
+                'variants': [],
+            }
+            for v in range(variants_per_product):
+                variant = self._make_variant(product_id, {
+                    'sku': f'SKU-{p}-{v}',
+                    'price': '19.95',
+                    'option1': f'Color {p % 5}',
+                    'option2': f'Size {v}',
+                })
+                product['variants'].append(variant)
+            self.products[product_id] = product
+
+        self.customers = {}
+        for c in range(customers):
+            customer_id = self._new_id()
+            self.customers[customer_id] = self._make_customer(customer_id, c, base_date + timedelta(minutes=c))
+
+        skus = list(self.variants.values())
+        self.orders = {}
+        for o in range(orders):
+            order_id = self._new_id()
+            self.orders[order_id] = self._make_order(order_id, o, skus, list(self.customers.values()),
+                                                     base_date + timedelta(minutes=o))
+        self.draft_orders = {}
+        for o in range(draft_orders):
+            order_id = self._new_id()
+            self.draft_orders[order_id] = self._make_order(order_id, o, skus, list(self.customers.values()),
+                                                           base_date + timedelta(minutes=o), draft=True)
+
+    def _new_id(self):
+        self.next_id += 1
+        return self.next_id
+
+    def _make_variant(self, product_id, vals):
+        variant = dict(vals)
+        variant.update({
+            'id': self._new_id(),
+            'product_id': product_id,
+            'inventory_item_id': self._new_id(),
+        })
+        self.variants[variant['id']] = variant
+        self.inventory_levels[variant['inventory_item_id']] = {
+            'inventory_item_id': variant['inventory_item_id'],
+            'location_id': self.location_id,
+            'available': 0,
+        }
+        return variant
+
+    def _make_customer(self, customer_id, index, updated_at):
+        return {
+            'id': customer_id,
+            'email': f'customer{index}@example.com',
+            'first_name': f'First{index}',
+            'last_name': f'Last{index}',
+            'phone': None,
+            'note': None,
+            'updated_at': updated_at.isoformat(),
+            'addresses': [{'address1': f'Street {index}', 'city': 'Madrid', 'zip': '28001', 'country_code': 'ES'}],
+            'default_address': {'address1': f'Street {index}', 'city': 'Madrid', 'zip': '28001', 'country_code': 'ES'},
+        }
+
+    def _make_order(self, order_id, index, variants, customers, updated_at, draft=False):
+        line_items = []
+        for n in range(6):
+            variant = variants[(index * 6 + n) % len(variants)] if variants else {}
+            line_items.append({
+                'variant_id': variant.get('id'),
+                'product_id': variant.get('product_id'),
+                'title': variant.get('sku', 'Item'),
+                'quantity': 1,
+                'price': '19.95',
+                'total_discount': '0.00',
+                'tax_lines': [{'title': 'IVA 21%', 'rate': 0.21, 'price': '3.46'}],
+            })
+        return {
+            'id': order_id,
+            'name': f'{"D" if draft else "#"}{1000 + index}',
+            'order_number': 1000 + index,
+            'status': 'open',
+            'created_at': updated_at.isoformat(),
+            'updated_at': updated_at.isoformat(),
+            'total_price': '119.70',
+            'customer': customers[index % len(customers)] if customers else None,
+            'line_items': line_items,
+            'shipping_lines': [{'title': 'Standard', 'price': '4.95'}],
+        }
+
+    def reset_stats(self):
+        self.stats = {'total': 0, 'throttled': 0, 'endpoints': {}}
+
+    def count(self, method, endpoint):
+        # Los IDs numéricos se agrupan para que las estadísticas sean por tipo de endpoint
+        key = f"{method} {re.sub(r'/[0-9]+', '/<id>', endpoint)}"
+        self.stats['total'] += 1
+        self.stats['endpoints'][key] = self.stats['endpoints'].get(key, 0) + 1
+
+    def take_call(self):
+        """Leaky bucket; devuelve (permitida, llamadas en el bucket)."""
+        now = time.time()
+        self.bucket = max(0.0, self.bucket - (now - self.bucket_time) * LEAK_RATE)
+        self.bucket_time = now
+        forced = self.throttle_every and self.stats['total'] % self.throttle_every == 0
+        if forced or self.bucket + 1 > BUCKET_SIZE:
+            self.stats['throttled'] += 1
+            return False, int(self.bucket)
+        self.bucket += 1
+        return True, int(self.bucket)
+
+
+class MockShopifyHandler(BaseHTTPRequestHandler):
+    shop = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, body=None, headers=None):
+        data = json.dumps(body if body is not None else {}).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _read_json(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return json.loads(self.rfile.read(length) or b'{}') if length else {}
+
+    def _handle(self, method):
+        parsed = urlparse(self.path)
+        shop = self.shop
+        if parsed.path.startswith('/_mock/'):
+            return self._handle_control(method, parsed.path)
+        match = API_PATH.match(parsed.path)
+        if not match:
+            return self._send(404, {'errors': 'Not Found'})
+        endpoint = match.group('endpoint')
+        with shop.lock:
+            shop.count(method, endpoint)
+            allowed, used = shop.take_call()
+            limit_header = {'X-Shopify-Shop-Api-Call-Limit': f'{used}/{BUCKET_SIZE}'}
+            if not allowed:
+                limit_header['Retry-After'] = '1.0'
+                return self._send(429, {'errors': 'Exceeded 2 calls per second for api client. '
+                                                  'Reduce request rates to resume uninterrupted service.'},
+                                  limit_header)
+            params = {key: values[0] for key, values in parse_qs(parsed.query).items()}
+            body = self._read_json() if method in ('POST', 'PUT') else {}
+            status, payload, headers = self._route(method, endpoint, params, body, parsed.path)
+        headers.update(limit_header)
+        return self._send(status, payload, headers)
+
+    def _handle_control(self, method, path):
+        shop = self.shop
+        with shop.lock:
+            if path == '/_mock/stats':
+                return self._send(200, shop.stats)
+            if path == '/_mock/reset' and method == 'POST':
+                shop.reset_stats()
+                return self._send(200, shop.stats)
+            if path == '/_mock/config' and method == 'POST':
+                config = self._read_json()
+                shop.throttle_every = int(config.get('throttle_every', shop.throttle_every))
+                return self._send(200, {'throttle_every': shop.throttle_every})
+        return self._send(404, {'errors': 'Not Found'})
+
+    def _paginate(self, records, resource_key, params, path):
+        records = sorted(records, key=lambda r: (r.get('updated_at', ''), r.get('id')))
+        if 'page_info' in params:
+            cursor = json.loads(base64.urlsafe_b64decode(params['page_info']).decode('utf-8'))
+            offset, filters = cursor['offset'], cursor['filters']
+        else:
+            offset = 0
+            filters = {key: value for key, value in params.items() if key.endswith(('_min', '_max'))
+                       or key in ('ids', 'inventory_item_ids', 'location_ids')}
+        for key, value in filters.items():
+            if key.endswith('_min'):
+                records = [r for r in records if r.get(key[:-4], '') >= value]
+            elif key.endswith('_max'):
+                records = [r for r in records if r.get(key[:-4], '') <= value]
+            elif key == 'ids':
+                ids = {int(v) for v in value.split(',')}
+                records = [r for r in records if r['id'] in ids]
+            elif key == 'inventory_item_ids':
+                ids = {int(v) for v in value.split(',')}
+                records = [r for r in records if r['inventory_item_id'] in ids]
+        limit = min(int(params.get('limit', 50)), 250)
+        page = records[offset:offset + limit]
+        headers = {}
+        if offset + limit < len(records):
+            next_cursor = base64.urlsafe_b64encode(json.dumps(
+                {'offset': offset + limit, 'filters': filters}).encode('utf-8')).decode('ascii')
+            host = self.headers.get('Host')
+            headers['Link'] = '<http://{}{}?{}>; rel="next"'.format(
+                host, path, urlencode({'limit': limit, 'page_info': next_cursor}))
+        fields = params.get('fields')
+        if fields:
+            wanted = fields.split(',')
+            page = [{key: r.get(key) for key in wanted} for r in page]
+        return 200, {resource_key: page}, headers
+
+    def _route(self, method, endpoint, params, body, path):
+        shop = self.shop
+        listings = {
+            'products': shop.products,
+            'customers': shop.customers,
+            'orders': shop.orders,
+            'draft_orders': shop.draft_orders,
+            'variants': shop.variants,
+        }
+        if method == 'GET' and endpoint in listings:
+            return self._paginate(listings[endpoint].values(), endpoint, params, path)
+        if method == 'GET' and endpoint == 'inventory_levels':
+            return self._paginate(shop.inventory_levels.values(), 'inventory_levels', params, path)
+        if method == 'GET' and endpoint.endswith('/count'):
+            return 200, {'count': len(listings.get(endpoint[:-6], {}))}, {}
+        if method == 'POST' and endpoint == 'products':
+            product_vals = body.get('product', {})
+            product_id = shop._new_id()
+            product = dict(product_vals, id=product_id, variants=[])
+            for variant_vals in product_vals.get('variants', []):
+                product['variants'].append(shop._make_variant(product_id, variant_vals))
+            shop.products[product_id] = product
+            return 201, {'product': product}, {}
+        match = re.match(r'^products/(\d+)$', endpoint)
+        if match:
+            product = shop.products.get(int(match.group(1)))
+            if not product:
+                return 404, {'errors': 'Not Found'}, {}
+            if method == 'PUT':
+                product.update({k: v for k, v in body.get('product', {}).items() if k != 'variants'})
+            return 200, {'product': product}, {}
+        match = re.match(r'^variants/(\d+)$', endpoint)
+        if match:
+            variant = shop.variants.get(int(match.group(1)))
+            if not variant:
+                return 404, {'errors': 'Not Found'}, {}
+            if method == 'PUT':
+                variant.update(body.get('variant', {}))
+            return 200, {'variant': variant}, {}
+        if method == 'POST' and endpoint == 'inventory_levels/set':
+            item_id = int(body.get('inventory_item_id') or 0)
+            level = shop.inventory_levels.setdefault(item_id, {
+                'inventory_item_id': item_id, 'location_id': body.get('location_id')})
+            level['available'] = body.get('available')
+            return 200, {'inventory_level': level}, {}
+        if method == 'POST' and endpoint == 'webhooks':
+            return 201, {'webhook': dict(body.get('webhook', {}), id=shop._new_id())}, {}
+        return 404, {'errors': 'Not Found'}, {}
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+    def do_PUT(self):
+        self._handle('PUT')
+
+
+def make_server(port=8765, **shop_kwargs):
+    handler = type('Handler', (MockShopifyHandler,), {'shop': MockShop(**shop_kwargs)})
+    return ThreadingHTTPServer(('127.0.0.1', port), handler)
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg_parser.add_argument('--port', type=int, default=8765)
+    arg_parser.add_argument('--products', type=int, default=100)
+    arg_parser.add_argument('--variants-per-product', type=int, default=6)
+    arg_parser.add_argument('--customers', type=int, default=100)
+    arg_parser.add_argument('--orders', type=int, default=100)
+    arg_parser.add_argument('--draft-orders', type=int, default=10)
+    arg_parser.add_argument('--location-id', type=int, default=1000001)
+    arg_parser.add_argument('--throttle-every', type=int, default=0, help="Devuelve un 429 cada N llamadas (0 = nunca)")
+    args = arg_parser.parse_args()
+    server = make_server(args.port, products=args.products, variants_per_product=args.variants_per_product,
+                         customers=args.customers, orders=args.orders, draft_orders=args.draft_orders,
+                         location_id=args.location_id, throttle_every=args.throttle_every)
+    print(f"Mock Shopify escuchando en http://127.0.0.1:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -3,14 +3,29 @@ import logging
 
 _logger = logging.getLogger(__name__)
 
+# Operaciones del asistente que pueden delegarse en la cola shopify.sync.job
+BACKGROUND_OPERATIONS = {
+    'export_shopify_stock': 'export_stock',
+}
+
 class ShopifyOperation(models.TransientModel):
     _inherit = 'shopify.operation'
     
     export_shopify_operation = fields.Selection(
         selection_add=[('export_shopify_stock', 'Export Stock')]
     )
+    run_in_background = fields.Boolean(string="Run in Background", default=True,
+                                       help="Encola la operación en la cola de sincronización en lugar de ejecutarla ahora. "
+                                            "El progreso y el resultado se consultan en la ejecución correspondiente.")
     
     def perform_export_shopify_operation(self):
+        if self.run_in_background and self.export_shopify_operation in BACKGROUND_OPERATIONS:
+            operation = BACKGROUND_OPERATIONS[self.export_shopify_operation]
+            self.env['shopify.sync.job']._enqueue(self.shopify_instance_id, operation, priority=1)
+            # Se vuelve enseguida a las ejecuciones de la operación, donde se sigue el progreso
+            action = self.env.ref("ws_shopify_split_color.action_shopify_sync_run").sudo().read()[0]
+            action["domain"] = [("shopify_instance_id", "=", self.shopify_instance_id.id), ("operation", "=", operation)]
+            return action
         if self.export_shopify_operation == 'export_shopify_stock':
             updated_products = self.env['product.template'].export_stock_to_shopify(self.shopify_instance_id)
             if updated_products: